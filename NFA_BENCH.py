@@ -0,0 +1,701 @@
+import io
+import logging
+import mmap
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from sys import getsizeof
+
+from graphviz import Digraph
+
+from NFA_CODE import (NFA, CompileTrace, ast_to_nfa, logger as compile_logger, nfa_to_dot, parse_regex, regex_to_nfa,
+                      remove_epsilons)
+from NFA_DFA import DFA, DenseDFA, LazyDFA
+from NFA_BITPAR import BitParallelMatcher, matcher_for
+from NFA_BINARY import load as load_binary
+from NFA_CACHE import Pattern, PatternCache
+from NFA_PARALLEL import scan_file_parallel
+from NFA_PIKE import PikeVM
+from NFA_SET import PatternSet
+from NFA_STREAM import search_mmap, search_stream
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_pathological(re_limit=24):
+    # (a|a)*b against a run of a's with no b: Python's backtracking engine
+    # is exponential here, the Thompson simulation stays linear
+    pattern = "(a|a)*b"
+    nfa = regex_to_nfa(pattern)
+    compiled = re.compile(pattern)
+
+    print(f"Pattern {pattern} on 'a' * n (no match)")
+    print(f"{'n':>8} {'NFA.matches':>14} {'NFA.search':>14} {'re.match':>14}")
+    for n in (10, 16, 20, 22, re_limit, 1000, 10000, 100000):
+        text = "a" * n
+        t_match, _ = timed(nfa.matches, text)
+        t_search, _ = timed(nfa.search, text)
+        if n <= re_limit:
+            t_re, _ = timed(compiled.match, text)
+            re_col = f"{t_re * 1000:12.2f}ms"
+        else:
+            re_col = f"{'(skipped)':>14}"
+        print(f"{n:>8} {t_match * 1000:12.2f}ms {t_search * 1000:12.2f}ms {re_col}")
+
+
+def bench_lazy_dfa(count=100000):
+    # Same compiled pattern against many short strings: the lazy DFA only
+    # pays for subset construction the first time it sees a (state, char)
+    pattern = "[a-z]+(ing|ed)[0-9]*"
+    nfa = regex_to_nfa(pattern)
+    dfa = LazyDFA(nfa)
+    words = ["walking", "talked", "run", "jumped42", "singing7", "x1", "played", "zzz"]
+    strings = [words[i % len(words)] for i in range(count)]
+
+    t_nfa, _ = timed(lambda: [nfa.matches(s) for s in strings])
+    t_dfa, _ = timed(lambda: [dfa.matches(s) for s in strings])
+    print(f"Pattern {pattern}, {count} strings")
+    print(f"  NFA simulation: {t_nfa * 1000:10.1f}ms")
+    print(f"  lazy DFA:       {t_dfa * 1000:10.1f}ms  {dfa.stats}")
+
+
+def transitions_bytes(nfa):
+    size = getsizeof(nfa.transitions)
+    for key, targets in nfa.transitions.items():
+        size += getsizeof(key) + getsizeof(targets)
+    return size
+
+
+def dense_bytes(dense):
+    classes = dense.classes
+    return dense.table_bytes + getsizeof(dense.accepting) + getsizeof(classes.bounds) + getsizeof(classes.ids)
+
+
+def bench_dense(length=200000):
+    # Dict-of-sets NFA against the minimized, array-backed DFA table
+    print(f"{'pattern':<22} {'NFA edges':>9} {'NFA bytes':>10} {'DFA':>4} {'min':>4} "
+          f"{'classes':>7} {'table bytes':>11} {'build':>9} {'NFA ns/ch':>9} {'DFA ns/ch':>9}")
+    for pattern in ("[a-zA-Z0-9]+", "[a-z]+(ing|ed)[0-9]*", "(a|b)*abb", "![ab]+c"):
+        nfa = regex_to_nfa(pattern)
+        nfa._simulation()
+        t_build, dfa = timed(DFA.from_nfa, nfa)
+        t_min, minimal = timed(dfa.minimize)
+        t_dense, dense = timed(minimal.to_dense)
+
+        text = ("abcXYZ019" * (length // 9 + 1))[:length]
+        if not nfa.matches(text):
+            text = "a" * (length - 3) + "abb" if pattern == "(a|b)*abb" else "d" * (length - 1) + "c"
+        t_nfa, _ = timed(nfa.matches, text)
+        t_dfa, _ = timed(dense.matches, text)
+        print(f"{pattern:<22} {len(nfa.transitions):>9} {transitions_bytes(nfa):>10} {len(dfa.rows):>4} "
+              f"{len(minimal.rows):>4} {dense.width:>7} {dense_bytes(dense):>11} "
+              f"{(t_build + t_min + t_dense) * 1000:7.2f}ms "
+              f"{t_nfa / length * 1e9:9.0f} {t_dfa / length * 1e9:9.0f}")
+
+
+def keyword(i):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    word = letters[i % 26]
+    i //= 26
+    while i:
+        word += letters[i % 26]
+        i //= 26
+    return word
+
+
+def keyword_regex(tokens):
+    # kw0|kw1|kw2|... with roughly `tokens` characters in it
+    parts = []
+    length = 0
+    i = 0
+    while length < tokens:
+        parts.append(keyword(i))
+        length += len(parts[-1]) + 1
+        i += 1
+    return "|".join(parts)
+
+
+def bench_construction(sizes=(10, 100, 1000, 10000, 100000)):
+    # Thompson construction time against pattern length (parsed up front)
+    print(f"{'tokens':>8} {'states':>8} {'edges':>8} {'time':>10} {'us/token':>9}")
+    for size in sizes:
+        regex = keyword_regex(size)
+        tree = parse_regex(regex)
+        t_build, nfa = timed(ast_to_nfa, tree)
+        print(f"{len(regex):>8} {len(nfa.states()):>8} {len(nfa.transitions):>8} "
+              f"{t_build * 1000:8.1f}ms {t_build / len(regex) * 1e6:9.2f}")
+
+
+def generated_pattern(size):
+    # Alternation of keyword[0-9a-f]+(x|![yz])? branches, about size chars
+    parts = []
+    length = 0
+    i = 0
+    while length < size:
+        parts.append(f"{keyword(i)}[0-9a-f]+(x|![yz])?")
+        length += len(parts[-1]) + 1
+        i += 1
+    return "|".join(parts)
+
+
+def bench_parse(sizes=(10000, 100000, 1000000)):
+    # Parser throughput on large generated patterns, and the whole compile
+    print(f"{'chars':>8} {'parse':>9} {'M chars/s':>9} {'compile':>9} {'M chars/s':>9}")
+    for size in sizes:
+        regex = generated_pattern(size)
+        t_parse, _ = timed(parse_regex, regex)
+        t_compile, _ = timed(regex_to_nfa, regex)
+        print(f"{len(regex):>8} {t_parse * 1000:7.0f}ms {len(regex) / t_parse / 1e6:9.2f} "
+              f"{t_compile * 1000:7.0f}ms {len(regex) / t_compile / 1e6:9.2f}")
+
+
+def bench_tracing(tokens=20000, rounds=5):
+    # Compile throughput with tracing off, collecting counters only, and
+    # with every step formatted into a DEBUG log. The optimizer is left out:
+    # it does no per-token tracing and would otherwise take most of the time.
+    regex = "|".join(keyword(i) for i in range(tokens // 3))
+    handler = logging.StreamHandler(io.StringIO())
+
+    def compile_with(mode):
+        if mode == "debug log":
+            compile_logger.addHandler(handler)
+            compile_logger.setLevel(logging.DEBUG)
+        best = None
+        try:
+            for _ in range(rounds):
+                trace = None if mode == "off" else CompileTrace()
+                seconds, _ = timed(lambda: regex_to_nfa(regex, trace, optimize=False))
+                best = seconds if best is None else min(best, seconds)
+        finally:
+            compile_logger.removeHandler(handler)
+            compile_logger.setLevel(logging.NOTSET)
+        return best, trace
+
+    print(f"Compiling a {len(regex)}-character alternation")
+    for mode in ("off", "counters", "debug log"):
+        seconds, trace = compile_with(mode)
+        print(f"  {mode:<10} {seconds * 1000:8.1f}ms {len(regex) / seconds / 1e6:6.2f}M chars/s")
+        if mode == "counters":
+            timings = ", ".join(f"{phase} {t * 1000:.1f}ms" for phase, t in trace.timings.items())
+            print(f"             phases: {timings}")
+            print(f"             counters: {trace.counters}")
+
+
+def bench_cache(count=2000):
+    # Cold compile, LRU hits, and a restarted worker warm-starting from disk
+    regexes = [f"{keyword(i)}[0-9]+(x|y)*{keyword(i + 1)}" for i in range(count)]
+    directory = tempfile.mkdtemp()
+    try:
+        cache = PatternCache(maxsize=count, directory=directory)
+        t_cold, _ = timed(lambda: [cache.compile(r, dfa=True) for r in regexes])
+        t_hot, _ = timed(lambda: [cache.compile(r, dfa=True) for r in regexes])
+        restarted = PatternCache(maxsize=count, directory=directory)
+        t_warm, _ = timed(lambda: [restarted.compile(r, dfa=True) for r in regexes])
+    finally:
+        shutil.rmtree(directory)
+    print(f"{count} patterns, NFA + minimized DFA each")
+    print(f"  cold compile (+ disk write): {t_cold * 1000:8.1f}ms")
+    print(f"  LRU hits:                    {t_hot * 1000:8.1f}ms  {cache.stats}")
+    print(f"  warm start from disk:        {t_warm * 1000:8.1f}ms  {restarted.stats}")
+
+
+def bench_binary(counts=(100, 1000, 2500)):
+    # Worker cold start on an alternation of random words: compiling it
+    # (NFA plus the minimized DFAs of matches and search) against mapping a
+    # binary file in with NFA_BINARY.load. Both include the first match and
+    # the first search.
+    import random
+    import string
+    print(f"{'words':>8} {'states':>7} {'file':>8} {'compile':>10} {'load':>10} {'speedup':>8}")
+    for count in counts:
+        rng = random.Random(count)
+        words = ["".join(rng.choice(string.ascii_lowercase) for _ in range(8)) for _ in range(count)]
+        regex = "(" + "|".join(words) + ")[0-9]*"
+        probe = words[-1] + "42"
+        line = f"user {words[0][:5]} sent {probe} bytes"
+        span = (len(line) - len(probe) - 6, len(line) - 6)
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "pattern.nfab")
+
+            def first_use(pattern):
+                return pattern.matches(probe) and pattern.search(line) == span
+
+            def compile_cold():
+                pattern = Pattern(regex, regex_to_nfa(regex))
+                pattern.build_dfa()
+                return pattern, first_use(pattern)
+            t_compile, (pattern, found) = timed(compile_cold)
+            pattern.save(path)
+            t_load, loaded = timed(lambda: first_use(load_binary(path)))
+            assert found and loaded
+            states = pattern.dense_dfa.num_states + pattern.dense_search.forward.num_states
+            states += pattern.dense_search.backward.num_states
+            print(f"{count:>8} {states:>7} {os.path.getsize(path) >> 10:>6}KB "
+                  f"{t_compile * 1000:8.1f}ms {t_load * 1000:8.2f}ms "
+                  f"{t_compile / t_load:7.0f}x")
+        finally:
+            shutil.rmtree(directory)
+
+
+def bench_pattern_set(counts=(10, 100, 1000, 3000), lines=200):
+    # One pass over the union automaton against one search per pattern
+    text_lines = [f"user {keyword(i * 7)} logged in from {keyword(i * 13)}{i % 97} port {i}" for i in range(lines)]
+    print(f"{lines} lines, patterns of the form <keyword>[0-9]+")
+    print(f"{'patterns':>8} {'build':>9} {'PatternSet':>11} {'loop':>11} {'speedup':>8}")
+    for count in counts:
+        regexes = [f"{keyword(i)}[0-9]+" for i in range(count)]
+        t_build, patterns = timed(PatternSet, regexes)
+        singles = [LazyDFA(regex_to_nfa(regex)) for regex in regexes]
+
+        t_set, found = timed(lambda: [patterns.search(line) for line in text_lines])
+        t_loop, looped = timed(lambda: [{i for i, dfa in enumerate(singles) if dfa.search(line)}
+                                        for line in text_lines])
+        assert found == looped
+        print(f"{count:>8} {t_build * 1000:7.1f}ms {t_set * 1000:9.1f}ms {t_loop * 1000:9.1f}ms "
+              f"{t_loop / t_set:7.1f}x")
+
+
+def write_log(path, size):
+    # Synthetic log file where "error<digits>" shows up once per ~100 lines
+    with open(path, "w") as f:
+        written = 0
+        i = 0
+        while written < size:
+            line = f"{i:08d} INFO request {keyword(i)} served in {i % 997}ms\n"
+            if i % 100 == 42:
+                line = f"{i:08d} ERROR error{i % 89} while serving {keyword(i)}\n"
+            f.write(line)
+            written += len(line)
+            i += 1
+
+
+def bench_stream(sizes=(1 << 16, 1 << 18, 1 << 20, 4 << 20), traced_size=1 << 20):
+    # Peak Python memory of the streaming searchers must not grow with input.
+    # tracemalloc slows the search down a lot, so timing and peak memory
+    # come from separate runs and only sizes up to traced_size are traced.
+    nfa = regex_to_nfa("error[0-9]+")
+    directory = tempfile.mkdtemp()
+
+    def run(mode, path):
+        if mode == "file":
+            with open(path, "rb") as f:
+                return sum(1 for _ in search_stream(nfa, f))
+        return sum(1 for _ in search_mmap(nfa, path))
+
+    try:
+        print(f"{'size':>8} {'mode':>6} {'matches':>8} {'time':>9} {'MB/s':>6} {'peak alloc':>11}")
+        for size in sizes:
+            path = os.path.join(directory, f"log{size}")
+            write_log(path, size)
+            for mode in ("file", "mmap"):
+                start = time.perf_counter()
+                count = run(mode, path)
+                seconds = time.perf_counter() - start
+                peak = "-"
+                if size <= traced_size:
+                    tracemalloc.start()
+                    run(mode, path)
+                    peak = f"{tracemalloc.get_traced_memory()[1] / 1024:.0f}KB"
+                    tracemalloc.stop()
+                print(f"{size >> 10:>6}KB {mode:>6} {count:>8} {seconds * 1000:7.0f}ms "
+                      f"{size / seconds / 1e6:6.2f} {peak:>11}")
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_parallel(size=64 << 20, max_workers=None):
+    # Chunked speculative scan of one file over 1..N worker processes,
+    # checked against the sequential scan. Pass size=1 << 30 for 1 GB.
+    max_workers = max_workers or max(os.cpu_count() or 1, 4)
+    dfa = DenseDFA.from_nfa(regex_to_nfa("error[0-9]+"), unanchored=True)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "log")
+        write_log(path, size)
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            t_seq, expected = timed(dfa.match_ends, f.read())
+        print(f"{size >> 20}MB, {os.cpu_count()} CPUs, {len(expected)} match ends")
+        print(f"{'workers':>8} {'time':>10} {'MB/s':>7} {'speedup':>8}")
+        print(f"{'seq':>8} {t_seq * 1000:8.0f}ms {size / t_seq / 1e6:7.2f} {1:8.2f}")
+        for workers in range(2, max_workers + 1):
+            seconds, ends = timed(scan_file_parallel, dfa, path, workers)
+            assert ends == expected
+            print(f"{workers:>8} {seconds * 1000:8.0f}ms {size / seconds / 1e6:7.2f} {t_seq / seconds:8.2f}")
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_match_many(counts=(1000, 100000, 1000000)):
+    # Classifying many short tokens: one vectorized pass against a Python
+    # call per string
+    pattern = "[a-z]+(ing|ed)[0-9]*"
+    nfa = regex_to_nfa(pattern)
+    dense = DenseDFA.from_nfa(nfa)
+    nfa.match_many([])
+    words = ["walking", "talked", "run", "jumped42", "singing7", "x1", "played", "zzz"]
+    print(f"Pattern {pattern}")
+    print(f"{'strings':>8} {'NFA loop':>12} {'dense loop':>12} {'match_many':>12} {'speedup':>8}")
+    for count in counts:
+        strings = [words[i % len(words)] + keyword(i)[:i % 4] for i in range(count)]
+        t_nfa = None
+        if count <= 100000:
+            t_nfa, expected = timed(lambda: [nfa.matches(s) for s in strings])
+        t_loop, expected = timed(lambda: [dense.matches(s) for s in strings])
+        t_many, result = timed(nfa.match_many, strings)
+        assert result.tolist() == expected
+        nfa_col = f"{count / t_nfa:10.0f}/s" if t_nfa else f"{'(skipped)':>12}"
+        print(f"{count:>8} {nfa_col} {count / t_loop:10.0f}/s {count / t_many:10.0f}/s {t_loop / t_many:7.1f}x")
+
+
+def edge_count(nfa):
+    return sum(len(targets) for targets in nfa.transitions.values())
+
+
+EPSILON_CORPUS = (
+    "abcdefghij",
+    "(a|b)*abb",
+    "[a-z]+(ing|ed)[0-9]*",
+    "(cat|dog|cow|pig|hen|eel|ant|bee)+",
+    "((ab)?(cd)?(ef)?)*g",
+    "[a-zA-Z0-9]+at[a-z0-9]+dot[a-z]+",
+)
+
+
+def pattern_strings(pattern, rng, count):
+    # Random strings over the pattern's own characters, so matches happen
+    alphabet = "".join(sorted(set(pattern) - set("()[]|*+?-")))
+    return ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 60))) for _ in range(count)]
+
+
+def bench_epsilon_free(count=2000):
+    # Thompson NFA against the same NFA after remove_epsilons: sizes, and
+    # NFA simulation time over random strings drawn from each pattern's own
+    # characters (tables are built first, so only matching is timed)
+    import random
+    rng = random.Random(12)
+    print(f"{'pattern':<36} {'states':>13} {'edges':>13} {'matches':>19} {'search':>19}")
+    for pattern in EPSILON_CORPUS:
+        nfa = regex_to_nfa(pattern)
+        free = remove_epsilons(nfa)
+        nfa._simulation()
+        free._simulation()
+        strings = pattern_strings(pattern, rng, count)
+        t_match, expected = timed(lambda n: [n.matches(s) for s in strings], nfa)
+        t_match_free, result = timed(lambda n: [n.matches(s) for s in strings], free)
+        assert result == expected
+        t_search, expected = timed(lambda n: [n.search(s) for s in strings], nfa)
+        t_search_free, result = timed(lambda n: [n.search(s) for s in strings], free)
+        assert result == expected
+        print(f"{pattern:<36} {len(nfa.states()):>5} -> {len(free.states()):>4} "
+              f"{edge_count(nfa):>5} -> {edge_count(free):>4} "
+              f"{t_match * 1000:6.0f} -> {t_match_free * 1000:5.0f}ms "
+              f"{t_search * 1000:6.0f} -> {t_search_free * 1000:5.0f}ms")
+
+
+def bench_glushkov(count=2000):
+    # Thompson against Glushkov construction: size, build time (including
+    # the simulation tables) and search time over random strings
+    import random
+    rng = random.Random(13)
+    print(f"{'pattern':<36} {'states':>11} {'edges':>11} {'build':>17} {'search':>17}")
+    for pattern in EPSILON_CORPUS:
+        t_thompson, nfa = timed(regex_to_nfa, pattern)
+        t_thompson += timed(nfa._simulation)[0]
+        t_glushkov, positions = timed(regex_to_nfa, pattern, None, "glushkov")
+        t_glushkov += timed(positions._simulation)[0]
+        strings = pattern_strings(pattern, rng, count)
+        t_search, expected = timed(lambda n: [n.search(s) for s in strings], nfa)
+        t_search_g, result = timed(lambda n: [n.search(s) for s in strings], positions)
+        assert result == expected
+        print(f"{pattern:<36} {len(nfa.states()):>4} -> {len(positions.states()):>3} "
+              f"{edge_count(nfa):>4} -> {edge_count(positions):>3} "
+              f"{t_thompson * 1000:5.2f} -> {t_glushkov * 1000:5.2f}ms "
+              f"{t_search * 1000:5.0f} -> {t_search_g * 1000:4.0f}ms")
+
+
+def bench_bit_parallel(count=3000):
+    # Set-of-states simulation against matcher_for and the lazy DFA: bitmask
+    # steps on patterns that fit in a word, plus one that does not and falls
+    # back
+    import random
+    rng = random.Random(14)
+    print(f"{'pattern':<36} {'pos':>3} {'NFA':>15} {'matcher_for':>15} {'lazy DFA':>15}")
+    print(f"{'':<36} {'':>3} {'match  search':>15} {'match  search':>15} {'match  search':>15}")
+    # Distinct random words leave the optimizer no common prefixes to
+    # merge, so their union needs more positions than a word holds and
+    # matcher_for has to fall back to the lazy DFA
+    words = ["".join(rng.choice("abcdefghij") for _ in range(6)) for _ in range(20)]
+    big = "(" + "|".join(words) + ")+"
+    rows = [(pattern, regex_to_nfa(pattern)) for pattern in EPSILON_CORPUS]
+    rows.append((f"{len(words)}-word union (fallback)", regex_to_nfa(big)))
+    for label, nfa in rows:
+        nfa._simulation()
+        matcher = matcher_for(nfa)
+        if label in EPSILON_CORPUS:
+            assert isinstance(matcher, BitParallelMatcher), label
+            strings = pattern_strings(label, rng, count)
+            positions = matcher.forward.positions
+        else:
+            assert isinstance(matcher, LazyDFA), type(matcher).__name__
+            strings = pattern_strings(big, rng, count)
+            positions = "-"
+        columns = []
+        for engine in (nfa, matcher, LazyDFA(nfa)):
+            t_match, matched = timed(lambda: [engine.matches(s) for s in strings])
+            t_search, found = timed(lambda: [engine.search(s) for s in strings])
+            columns.append(f"{t_match * 1000:6.1f} {t_search * 1000:6.1f}ms")
+        print(f"{label:<36} {positions:>3} " + " ".join(columns))
+
+
+def keyword_list(count):
+    # Keywords sharing prefixes and suffixes, as generated lists tend to
+    stems = [keyword(i) for i in range(max(1, count // 4))]
+    return [stem + suffix for stem in stems for suffix in ("", "ing", "ed", "s")][:count]
+
+
+def bench_optimize(counts=(100, 1000, 5000)):
+    # Keyword alternations compiled with and without optimize_ast; "tables"
+    # is NFA._simulation(), "match" runs every 10th keyword through matches()
+    print(f"{'keywords':>8} {'chars':>7} {'states':>16} {'edges':>16} {'compile':>17} "
+          f"{'tables':>17} {'match':>17}")
+    for count in counts:
+        words = keyword_list(count)
+        regex = "|".join(words)
+        t_plain, plain = timed(regex_to_nfa, regex, None, "thompson", False)
+        t_opt, optimized = timed(regex_to_nfa, regex, None, "thompson", True)
+        t_tables_plain, _ = timed(plain._simulation)
+        t_tables_opt, _ = timed(optimized._simulation)
+        sample = words[::10]
+        t_match_plain, expected = timed(lambda: [plain.matches(w) for w in sample])
+        t_match_opt, found = timed(lambda: [optimized.matches(w) for w in sample])
+        assert found == expected
+        print(f"{count:>8} {len(regex):>7} {len(plain.states()):>7} -> {len(optimized.states()):>5} "
+              f"{edge_count(plain):>7} -> {edge_count(optimized):>5} "
+              f"{t_plain * 1000:6.0f} -> {t_opt * 1000:4.0f}ms "
+              f"{t_tables_plain * 1000:6.0f} -> {t_tables_opt * 1000:4.0f}ms "
+              f"{t_match_plain * 1000:6.0f} -> {t_match_opt * 1000:4.0f}ms")
+
+
+def rare_log(lines, every):
+    # Log text where only one line in `every` holds anything of interest
+    out = []
+    for i in range(lines):
+        if i % every == every // 2:
+            out.append(f"{i:08d} ERROR error{i % 89} request {keyword(i)} timeoutms after 3012msslow\n")
+        else:
+            out.append(f"{i:08d} INFO request {keyword(i)} served in {i % 997}ms\n")
+    return "".join(out)
+
+
+def find_all(engine, text):
+    found = []
+    pos = 0
+    while pos <= len(text):
+        match = engine.search(text, pos)
+        if match is None:
+            break
+        found.append(match)
+        pos = match[1] if match[1] > match[0] else match[1] + 1
+    return found
+
+
+def bench_prefilter(lines=20000, every=5000):
+    # Finding every match in a log where matches are rare, with and without
+    # the literal prefilter in front of the lazy DFA
+    text = rare_log(lines, every)
+    print(f"{len(text) >> 10}KB log, one interesting line in {every}")
+    print(f"{'pattern':<22} {'matches':>7} {'no prefilter':>13} {'prefilter':>10} {'speedup':>8}  prefilter")
+    for pattern in ("error[0-9]+", "timeout(ms|s)", "[0-9]+msslow", "ERROR![0-9]", "x(ab|ac)yz"):
+        nfa = regex_to_nfa(pattern)
+        plain = LazyDFA(nfa, prefilter=False)
+        filtered = LazyDFA(nfa)
+        t_plain, expected = timed(find_all, plain, text)
+        t_filtered, found = timed(find_all, filtered, text)
+        assert found == expected
+        print(f"{pattern:<22} {len(found):>7} {t_plain * 1000:11.1f}ms {t_filtered * 1000:8.1f}ms "
+              f"{t_plain / t_filtered:7.1f}x  {filtered.prefilter}")
+
+
+def bench_utf8(lines=20000, every=5000):
+    # Searching a UTF-8 log: decoding it and running the text automaton,
+    # against the byte automaton run straight on the bytes and on an mmap
+    # of the file. Peak memory is what tracemalloc sees during a search.
+    text = rare_log(lines, every).replace("INFO", "INFO \u00fcber \u0437\u0430\u043f\u0440\u043e\u0441")
+    text = text.replace("ERROR", "ERROR \u0437\u0430\u043f\u0440\u043e\u0441")
+    data = text.encode("utf-8")
+    print(f"{len(data) >> 10}KB UTF-8 log, {len(text) >> 10}K characters")
+    print(f"{'pattern':<22} {'states':>7} {'bytes':>6} {'decode+str':>11} {'bytes':>9} {'mmap':>9} {'peak str':>9} "
+          f"{'peak bytes':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "log.txt")
+        with open(path, "wb") as f:
+            f.write(data)
+        for pattern in ("error[0-9]+", "ERROR![0-9]", "[\u0430-\u044f]+[ ]error", "!['-~]+[ ]error[0-9]"):
+            nfa = regex_to_nfa(pattern)
+            byte_nfa = regex_to_nfa(pattern, utf8=True)
+            text_dfa = LazyDFA(nfa)
+            byte_dfa = LazyDFA(byte_nfa)
+            t_text, found = timed(lambda: find_all(text_dfa, data.decode("utf-8")))
+            t_bytes, byte_found = timed(find_all, byte_dfa, data)
+            # Tracing slows everything down, so memory is measured apart
+            tracemalloc.start()
+            find_all(text_dfa, data.decode("utf-8"))
+            peak_text = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            tracemalloc.start()
+            find_all(byte_dfa, data)
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                t_mmap, mapped_found = timed(find_all, byte_dfa, mapped)
+            assert len(byte_found) == len(found) and mapped_found == byte_found
+            assert [data[start:end].decode("utf-8") for start, end in byte_found] == [text[s:e] for s, e in found]
+            print(f"{pattern:<22} {len(nfa.states()):>7} {len(byte_nfa.states()):>6} {t_text * 1000:9.1f}ms "
+                  f"{t_bytes * 1000:7.1f}ms {t_mmap * 1000:7.1f}ms {peak_text >> 10:>7}KB {peak_bytes >> 10:>8}KB")
+
+
+def bench_repeat(bounds=(10, 1000, 100000), hand_limit=1000):
+    # [0-9]{1,n}x against the same pattern written out by hand as
+    # [0-9][0-9]?[0-9]?...x; "tables" is NFA._simulation() and "match" runs
+    # n/2 digits through matches(). The hand-written form has closures
+    # spanning every optional copy, so it is quadratic and only run up to
+    # hand_limit.
+    print(f"{'n':>7} {'states':>16} {'compile':>18} {'tables':>18} {'match':>18}")
+    for n in bounds:
+        text = "7" * (n // 2) + "x"
+        t_compile, nfa = timed(regex_to_nfa, f"[0-9]{{1,{n}}}x")
+        t_tables, _ = timed(nfa._simulation)
+        t_match, found = timed(nfa.matches, text)
+        assert found
+        hand = ("(skipped)",) * 4
+        if n <= hand_limit:
+            t_hand, written = timed(regex_to_nfa, "[0-9]" + "[0-9]?" * (n - 1) + "x")
+            t_hand_tables, _ = timed(written._simulation)
+            t_hand_match, found = timed(written.matches, text)
+            assert found
+            hand = (len(written.states()), f"{t_hand * 1000:.1f}ms", f"{t_hand_tables * 1000:.1f}ms",
+                    f"{t_hand_match * 1000:.1f}ms")
+        print(f"{n:>7} {hand[0]:>7} -> {len(nfa.states()):>6} "
+              f"{hand[1]:>9} -> {t_compile * 1000:5.1f}ms {hand[2]:>9} -> {t_tables * 1000:5.1f}ms "
+              f"{hand[3]:>9} -> {t_match * 1000:5.1f}ms")
+
+
+def bench_captures(lines=2000, re_limit=22):
+    # Pulling fields out of log lines with the Pike VM against NFA.search
+    # (span only) and Python's re; then (a?){n}a{n} on 'a' * n, where
+    # re backtracks exponentially and the Pike VM stays O(n * states)
+    text = rare_log(lines, 50)
+    pattern = "([0-9]+)[ ]INFO[ ]request[ ]([a-z]+)[ ]served[ ]in[ ]([0-9]+)ms"
+    vm = PikeVM(pattern)
+    nfa = regex_to_nfa(pattern)
+    compiled = re.compile("([0-9]+) INFO request ([a-z]+) served in ([0-9]+)ms")
+    lines_of = text.splitlines()
+    t_vm, found = timed(lambda: [vm.search(line) for line in lines_of])
+    t_nfa, spans = timed(lambda: [nfa.search(line) for line in lines_of])
+    t_re, _ = timed(lambda: [compiled.search(line) for line in lines_of])
+    assert [f and f[0] for f in found] == spans
+    print(f"{len(lines_of)} log lines, {sum(1 for f in found if f)} matches, 3 groups: Pike VM {t_vm * 1000:.1f}ms, "
+          f"NFA.search {t_nfa * 1000:.1f}ms, re {t_re * 1000:.1f}ms")
+
+    print(f"{'n':>6} {'Pike VM':>12} {'re':>12}")
+    for n in (10, 16, 20, re_limit, 100, 1000):
+        text = "a" * n
+        vm = PikeVM(f"(a?){{{n}}}a{{{n}}}")
+        t_vm, found = timed(vm.fullmatch, text)
+        assert found is not None
+        re_col = f"{'(skipped)':>12}"
+        if n <= re_limit:
+            t_re, _ = timed(re.compile(f"(a?){{{n}}}a{{{n}}}").fullmatch, text)
+            re_col = f"{t_re * 1000:10.2f}ms"
+        print(f"{n:>6} {t_vm * 1000:10.2f}ms {re_col}")
+
+
+def per_edge_dot(nfa):
+    # The graph as visualize_nfa used to draw it: one edge per transition
+    dot = Digraph(comment="NFA")
+    dot.attr(rankdir="LR")
+    for (from_state, symbol), to_states in nfa.transitions.items():
+        for to_state in to_states:
+            label = "ε" if symbol is None else str(symbol).replace("\\", "\\\\").replace('"', '\\"')
+            dot.edge(str(from_state), str(to_state), label=label)
+    return dot
+
+
+def bench_visualize():
+    # DOT edges per drawing mode and dot layout time (-Tplain, so no
+    # rasterizing) for one edge per transition against the "auto" level of
+    # detail. Layout is only timed where Graphviz is installed.
+    layout = shutil.which("dot") is not None
+    # Callers that add transitions a character at a time get parallel edges
+    per_char = NFA(0, 2)
+    for code_point in range(0x21, 0x7F):
+        if chr(code_point) != "a":
+            per_char.add_transition(0, chr(code_point), 1)
+            per_char.add_transition(1, chr(code_point), 2)
+    cases = (
+        ("![a]![a], one edge per char", per_char),
+        ("[a-z]+(ing|ed)[0-9]*, glushkov", regex_to_nfa("[a-z]+(ing|ed)[0-9]*", None, "glushkov")),
+        ("(cat|dog|...)+, epsilon-free", remove_epsilons(regex_to_nfa(EPSILON_CORPUS[3]))),
+        ("identifiers, unoptimized", regex_to_nfa(EPSILON_CORPUS[5], None, "thompson", False)),
+        ("200 keywords", regex_to_nfa("|".join(keyword_list(200)))),
+        ("200 keywords, epsilon-free", remove_epsilons(regex_to_nfa("|".join(keyword_list(200))))),
+        ("1000 keywords", regex_to_nfa("|".join(keyword_list(1000)))),
+        ("5000 keywords", regex_to_nfa("|".join(keyword_list(5000)))),
+    )
+    print(f"{'automaton':<30} {'states':>6} {'edges':>6} {'merged':>6} {'collapsed':>9} "
+          f"{'DOT size':>17} {'layout':>20}")
+    for name, nfa in cases:
+        before = per_edge_dot(nfa)
+        after = nfa_to_dot(nfa)
+        merged = nfa_to_dot(nfa, "full").source.count(" -> ") - 1
+        collapsed = nfa_to_dot(nfa, "collapsed").source.count(" -> ") - 1
+        size = f"{len(before.source):6} -> {len(after.source):5}B"
+        timing = "(dot not installed)"
+        if layout:
+            t_before, _ = timed(before.pipe, "plain")
+            t_after, _ = timed(after.pipe, "plain")
+            timing = f"{t_before * 1000:7.0f} -> {t_after * 1000:6.0f}ms"
+        print(f"{name:<30} {len(nfa.states()):>6} {edge_count(nfa):>6} {merged:>6} {collapsed:>9} "
+              f"{size:>17} {timing:>20}")
+
+
+BENCHMARKS = {
+    "pathological": bench_pathological,
+    "lazy_dfa": bench_lazy_dfa,
+    "dense": bench_dense,
+    "construction": bench_construction,
+    "parse": bench_parse,
+    "optimize": bench_optimize,
+    "repeat": bench_repeat,
+    "captures": bench_captures,
+    "prefilter": bench_prefilter,
+    "utf8": bench_utf8,
+    "tracing": bench_tracing,
+    "cache": bench_cache,
+    "binary": bench_binary,
+    "pattern_set": bench_pattern_set,
+    "stream": bench_stream,
+    "parallel": bench_parallel,
+    "match_many": bench_match_many,
+    "epsilon_free": bench_epsilon_free,
+    "glushkov": bench_glushkov,
+    "bit_parallel": bench_bit_parallel,
+    "visualize": bench_visualize,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+        print()
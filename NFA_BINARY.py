@@ -0,0 +1,245 @@
+import mmap
+import struct
+import sys
+from array import array
+
+from NFA_CACHE import Pattern
+from NFA_CODE import NFA, CharClass, ClassMap
+from NFA_DFA import DenseDFA, DenseSearch
+from NFA_PREFILTER import Prefilter
+
+# Compiled pattern files: a header, a table of sections, then each section
+# as a flat little-endian array starting on an 8-byte boundary:
+#
+#   header   magic, format version, section count
+#   section  name (8 bytes), array format, offset, item count
+#
+# Sections:
+#   regex    UTF-8 source of the pattern (format B)
+#   meta     nfa start, nfa accept (-1 for none), utf8 flag, then width
+#            and start of the anchored, forward and backward DFAs (start
+#            -1 if that DFA was not saved) (format q)
+#   accepts  accepting NFA states
+#   edges    NFA edges as (from, to, label) triples; label -1 is epsilon
+#   kinds    per label: 0 for a single character, 1 for a class
+#   starts   per label: index of its first range in ranges, plus an end
+#   ranges   (lo, hi) code point pairs of all labels
+#   table    dense DFA transitions, premultiplied by the width (i or q)
+#   accept   dense DFA accepting flags, indexed like table rows (B)
+#   bounds   class map bounds of the dense DFA
+#   ids      class map ids of the dense DFA
+#   f...     the same four for the forward DFA of DenseSearch
+#   b...     and for its backward DFA (stop column last)
+#   literals prefilter prefix, first characters and required literals,
+#            one after another (UTF-8, format B)
+#   lengths  their lengths in characters; -1 for no first characters
+#
+# load() maps the file and hands out memoryviews of it, so matches() and
+# search() run straight over the page cache; nothing is read until it is
+# touched.
+BINARY_MAGIC = b"NFAB"
+BINARY_FORMAT_VERSION = 3
+HEADER = struct.Struct("<4sHxxI")
+SECTION = struct.Struct("<8sc7xQQ")
+ALIGN = 8
+REQUIRED_SECTIONS = {"regex", "meta", "accepts", "edges", "kinds", "starts", "ranges"}
+
+
+class MappedNFA(NFA):
+    # NFA whose edges stay in the flat arrays of a loaded file. The
+    # transitions dict is only built the first time something asks for it,
+    # so patterns that are only ever run through their DFA never pay for it.
+
+    def __init__(self, start, accept, accepts, edges, kinds, starts, ranges):
+        super().__init__(start, accept, accepts)
+        del self.transitions
+        self._flat = (edges, kinds, starts, ranges)
+
+    def __getattr__(self, name):
+        if name != "transitions":
+            raise AttributeError(name)
+        edges, kinds, starts, ranges = self._flat
+        labels = []
+        for label, kind in enumerate(kinds):
+            lo, hi = starts[label], starts[label + 1]
+            if kind == 0:
+                labels.append(chr(ranges[2 * lo]))
+            else:
+                labels.append(CharClass(zip(ranges[2 * lo:2 * hi:2], ranges[2 * lo + 1:2 * hi:2])))
+        transitions = {}
+        for k in range(0, len(edges), 3):
+            label = edges[k + 2]
+            key = (edges[k], None if label < 0 else labels[label])
+            if key not in transitions:
+                transitions[key] = set()
+            transitions[key].add(edges[k + 1])
+        self.transitions = transitions
+        return transitions
+
+
+def dumps(pattern, dfa=True):
+    # The file contents for pattern; dfa=True builds and includes the dense
+    # DFAs for matches() and search() if the pattern has none yet
+    nfa = pattern.nfa
+    label_ids = {}
+    kinds = array("B")
+    starts = array("I")
+    ranges = array("I")
+    edges = array("i")
+    for (from_state, symbol), to_states in nfa.transitions.items():
+        label = -1
+        if symbol is not None:
+            label = label_ids.get(symbol)
+            if label is None:
+                label = label_ids[symbol] = len(kinds)
+                kinds.append(1 if isinstance(symbol, CharClass) else 0)
+                starts.append(len(ranges) // 2)
+                for lo, hi in (symbol.ranges if isinstance(symbol, CharClass) else ((ord(symbol), ord(symbol)),)):
+                    ranges.extend((lo, hi))
+        for to_state in to_states:
+            edges.extend((from_state, to_state, label))
+    starts.append(len(ranges) // 2)
+
+    dense = pattern.dense_dfa if dfa else pattern._dense_dfa
+    search = pattern.dense_search if dfa else pattern._dense_search
+    meta = array("q", [nfa.start, -1 if nfa.accept is None else nfa.accept, int(pattern.utf8), 0, -1, 0, -1, 0, -1])
+    sections = [
+        (b"regex", array("B", pattern.regex.encode("utf-8"))),
+        (b"meta", meta),
+        (b"accepts", array("I", sorted(nfa.accepts))),
+        (b"edges", edges),
+        (b"kinds", kinds),
+        (b"starts", starts),
+        (b"ranges", ranges),
+    ]
+    if dense is not None:
+        meta[3], meta[4] = dense.width, dense.start
+        sections += dense_sections(b"", dense)
+    if search is not None:
+        meta[5], meta[6] = search.forward.width, search.forward.start
+        meta[7], meta[8] = search.backward.width, search.backward.start
+        sections += dense_sections(b"f", search.forward) + dense_sections(b"b", search.backward)
+        prefilter = search.prefilter
+        if prefilter is not None:
+            first_chars = prefilter.first_chars or ""
+            literals = prefilter.prefix + first_chars + "".join(prefilter.required)
+            lengths = [len(prefilter.prefix), -1 if prefilter.first_chars is None else len(first_chars)]
+            sections += [
+                (b"literals", array("B", literals.encode("utf-8"))),
+                (b"lengths", array("q", lengths + [len(literal) for literal in prefilter.required])),
+            ]
+
+    offset = aligned(HEADER.size + SECTION.size * len(sections))
+    table_of_contents = []
+    for name, values in sections:
+        table_of_contents.append(SECTION.pack(name, values.typecode.encode("ascii"), offset, len(values)))
+        offset = aligned(offset + len(values) * values.itemsize)
+    out = bytearray(HEADER.pack(BINARY_MAGIC, BINARY_FORMAT_VERSION, len(sections)))
+    for entry in table_of_contents:
+        out += entry
+    for name, values in sections:
+        if sys.byteorder != "little":
+            values = array(values.typecode, values)
+            values.byteswap()
+        out += bytes(aligned(len(out)) - len(out))
+        out += values.tobytes()
+    out += bytes(aligned(len(out)) - len(out))
+    return bytes(out)
+
+
+def dense_sections(prefix, dense):
+    wide = len(dense.table) >= 1 << 31
+    return [
+        (prefix + b"table", array("q" if wide else "i", dense.table)),
+        (prefix + b"accept", array("B", dense.accepting)),
+        (prefix + b"bounds", array("I", dense.classes.bounds)),
+        (prefix + b"ids", array("I", dense.classes.ids)),
+    ]
+
+
+def save(pattern, path, dfa=True):
+    with open(path, "wb") as f:
+        f.write(dumps(pattern, dfa))
+
+
+def loads(buffer):
+    # Pattern over any buffer holding a file's contents (bytes, mmap, ...);
+    # the arrays are views of the buffer, not copies
+    view = memoryview(buffer)
+    if len(view) < HEADER.size:
+        raise ValueError("Not a compiled pattern file")
+    magic, version, count = HEADER.unpack_from(view)
+    if magic != BINARY_MAGIC:
+        raise ValueError("Not a compiled pattern file")
+    if version != BINARY_FORMAT_VERSION:
+        raise ValueError(f"Unsupported compiled pattern version {version}")
+    if len(view) < HEADER.size + count * SECTION.size:
+        raise ValueError("Truncated compiled pattern file")
+    sections = {}
+    for k in range(count):
+        name, typecode, offset, length = SECTION.unpack_from(view, HEADER.size + k * SECTION.size)
+        typecode = typecode.decode("ascii")
+        end = offset + length * array(typecode).itemsize
+        if end > len(view):
+            raise ValueError("Truncated compiled pattern file")
+        values = view[offset:end].cast(typecode)
+        if sys.byteorder != "little" and values.itemsize > 1:
+            values = array(typecode, values)
+            values.byteswap()
+        sections[name.rstrip(b"\0").decode("ascii")] = values
+
+    missing = REQUIRED_SECTIONS.difference(sections)
+    if missing:
+        raise ValueError(f"Compiled pattern file lacks {', '.join(sorted(missing))}")
+
+    start, accept, utf8 = sections["meta"][:3]
+    nfa = MappedNFA(start, None if accept < 0 else accept, sections["accepts"], sections["edges"],
+                    sections["kinds"], sections["starts"], sections["ranges"])
+    dense = mapped_dense(sections, "", 3)
+    search = None
+    forward = mapped_dense(sections, "f", 5)
+    if dense is not None and forward is not None:
+        search = DenseSearch(forward, mapped_dense(sections, "b", 7), dense, mapped_prefilter(sections))
+    return Pattern(bytes(sections["regex"]).decode("utf-8"), nfa, dense, bool(utf8), search)
+
+
+def mapped_dense(sections, prefix, at):
+    # The DenseDFA whose width and start are meta[at:at + 2], or None
+    width, start = sections["meta"][at:at + 2]
+    if start < 0:
+        return None
+    names = [prefix + name for name in ("table", "accept", "bounds", "ids")]
+    missing = [name for name in names if name not in sections]
+    if missing:
+        raise ValueError(f"Compiled pattern file lacks {', '.join(missing)}")
+    table, accepting, bounds, ids = (sections[name] for name in names)
+    return DenseDFA(table, width, ClassMap(bounds, ids), start, accepting)
+
+
+def mapped_prefilter(sections):
+    if "lengths" not in sections:
+        return None
+    literals = bytes(sections["literals"]).decode("utf-8")
+    lengths = list(sections["lengths"])
+    prefix = literals[:lengths[0]]
+    at = lengths[0]
+    first_chars = None
+    if lengths[1] >= 0:
+        first_chars = literals[at:at + lengths[1]]
+        at += lengths[1]
+    required = []
+    for length in lengths[2:]:
+        required.append(literals[at:at + length])
+        at += length
+    return Prefilter(prefix, first_chars, required)
+
+
+def load(path):
+    # Maps the file read-only; the mapping lives as long as the pattern
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return loads(mapped)
+
+
+def aligned(offset):
+    return -(-offset // ALIGN) * ALIGN
@@ -0,0 +1,201 @@
+from NFA_CODE import ClassMap, remove_epsilons, tail
+from NFA_DFA import LazyDFA, reverse_nfa
+
+# Positions a bitmask may hold, start position included
+WORD_BITS = 64
+# The follow function is looked up a byte of the mask at a time
+CHUNK_BITS = 8
+
+
+class TooManyPositions(ValueError):
+    pass
+
+
+class BitParallelNFA:
+    # Glushkov-style bit-parallel simulation. The automaton is made
+    # epsilon-free and homogeneous (every position is entered under one
+    # label only), so a set of active positions is one int and a step is
+    #     active = follow(active) & masks[char]
+    # where follow(active) ORs together one precomputed table entry per
+    # byte of the mask. Bit 0 is the start position.
+
+    def __init__(self, follow_tables, class_masks, classes, final, positions):
+        self.follow_tables = follow_tables
+        self.class_masks = class_masks
+        self.classes = classes
+        self.final = final
+        self.positions = positions
+        self.masks = {}
+        self.follows = {}
+
+    @classmethod
+    def from_nfa(cls, nfa, max_positions=WORD_BITS):
+        # Positions are (state, label) pairs of the epsilon-free NFA, so a
+        # state entered under several labels becomes several positions
+        nfa = remove_epsilons(nfa)
+        edges = {}
+        for (from_state, symbol), to_states in nfa.transitions.items():
+            edges.setdefault(from_state, []).extend((symbol, target) for target in to_states)
+
+        index = {(nfa.start, None): 0}
+        order = [(nfa.start, None)]
+        for state, _ in order:
+            for symbol, target in edges.get(state, ()):
+                if (target, symbol) not in index:
+                    index[(target, symbol)] = len(order)
+                    order.append((target, symbol))
+                    if len(order) > max_positions:
+                        raise TooManyPositions(f"Pattern needs more than {max_positions} positions")
+
+        labels = [symbol for _, symbol in order[1:]]
+        classes = ClassMap.for_labels(set(labels))
+        class_masks = [0] * len(classes.ids)
+        for position, symbol in enumerate(labels, 1):
+            for class_id in classes.covering(symbol):
+                class_masks[class_id] |= 1 << position
+
+        follow = []
+        final = 0
+        for position, (state, _) in enumerate(order):
+            mask = 0
+            for symbol, target in edges.get(state, ()):
+                mask |= 1 << index[(target, symbol)]
+            follow.append(mask)
+            if state in nfa.accepts:
+                final |= 1 << position
+
+        follow_tables = []
+        for shift in range(0, len(follow), CHUNK_BITS):
+            # table[byte] = OR of follow[shift + b] over the bits b of byte
+            table = [0] * (1 << CHUNK_BITS)
+            for byte in range(1, 1 << CHUNK_BITS):
+                bit = (byte & -byte).bit_length() - 1
+                table[byte] = table[byte & (byte - 1)]
+                if shift + bit < len(follow):
+                    table[byte] |= follow[shift + bit]
+            follow_tables.append((shift, table))
+        return cls(follow_tables, class_masks, classes, final, len(order))
+
+    def _mask(self, char):
+        mask = self.class_masks[self.classes[char]]
+        self.masks[char] = mask
+        return mask
+
+    def _follow(self, active):
+        # Positions reachable in one step from active (before masking)
+        reached = 0
+        for shift, table in self.follow_tables:
+            reached |= table[(active >> shift) & 0xFF]
+        if len(self.follows) < 4096:
+            self.follows[active] = reached
+        return reached
+
+    def matches(self, text):
+        masks, follows, final = self.masks, self.follows, self.final
+        active = 1
+        for char in text:
+            mask = masks.get(char)
+            if mask is None:
+                mask = self._mask(char)
+            reached = follows.get(active)
+            if reached is None:
+                reached = self._follow(active)
+            active = reached & mask
+            if not active:
+                return False
+        return bool(active & final)
+
+    def longest(self, text, pos=0, active=1):
+        # End of the longest match anchored at pos, or None; with active,
+        # the last end reached from that set of positions
+        masks, follows, final = self.masks, self.follows, self.final
+        last = pos if final & active else None
+        i = pos
+        for char in tail(text, pos):
+            i += 1
+            mask = masks.get(char)
+            if mask is None:
+                mask = self._mask(char)
+            reached = follows.get(active)
+            if reached is None:
+                reached = self._follow(active)
+            active = reached & mask
+            if not active:
+                break
+            if active & final:
+                last = i
+        return last
+
+    def first_end(self, text, pos=0):
+        # (end, active) for the earliest offset at which some match
+        # (starting at or after pos) ends, with the positions active there;
+        # None if there is none. The start position is re-entered at every
+        # step.
+        masks, follows, final = self.masks, self.follows, self.final
+        if final & 1:
+            return pos, 1
+        active = 1
+        i = pos
+        for char in tail(text, pos):
+            i += 1
+            mask = masks.get(char)
+            if mask is None:
+                mask = self._mask(char)
+            reached = follows.get(active)
+            if reached is None:
+                reached = self._follow(active)
+            active = (reached & mask) | 1
+            if active & final:
+                return i, active
+        return None
+
+    def last_start(self, text, stop, pos=0):
+        # Run over text[pos:stop] right to left with the start position
+        # re-entered at every step; the last accepting offset seen is the
+        # smallest one. Used with a reversed automaton to find match starts.
+        masks, follows, final = self.masks, self.follows, self.final
+        active = 1
+        found = stop if final & 1 else None
+        for i in range(stop - 1, pos - 1, -1):
+            char = text[i]
+            mask = masks.get(char)
+            if mask is None:
+                mask = self._mask(char)
+            reached = follows.get(active)
+            if reached is None:
+                reached = self._follow(active)
+            active = (reached & mask) | 1
+            if active & final:
+                found = i
+        return found
+
+
+class BitParallelMatcher:
+    # matches()/search() over a forward and a reversed bit-parallel
+    # automaton, with the same three-scan search as LazyDFA
+
+    def __init__(self, nfa, max_positions=WORD_BITS):
+        self.nfa = nfa
+        self.forward = BitParallelNFA.from_nfa(nfa, max_positions)
+        self.backward = BitParallelNFA.from_nfa(reverse_nfa(nfa), max_positions)
+
+    def matches(self, text):
+        return self.forward.matches(text)
+
+    def search(self, text, pos=0):
+        found = self.forward.first_end(text, pos)
+        if found is None:
+            return None
+        # The leftmost match is under way at the first end; the reverse
+        # scan starts from the last end the active positions reach
+        end = self.forward.longest(text, *found)
+        start = self.backward.last_start(text, end, pos)
+        return (start, self.forward.longest(text, start))
+
+
+def matcher_for(nfa, max_positions=WORD_BITS):
+    # Bit-parallel matcher when the pattern fits in a word, else a lazy DFA
+    try:
+        return BitParallelMatcher(nfa, max_positions)
+    except TooManyPositions:
+        return LazyDFA(nfa)
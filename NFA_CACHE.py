@@ -0,0 +1,203 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from NFA_CODE import regex_to_nfa
+from NFA_DFA import DenseDFA, DenseSearch, LazyDFA
+from NFA_PIKE import PikeVM
+
+
+class Pattern:
+    # A compiled regex: the NFA plus the DFA artifacts, built on first use.
+    # A utf8 pattern runs on UTF-8 encoded bytes-like input and reports
+    # byte offsets (see utf8_nfa).
+
+    def __init__(self, regex, nfa, dense_dfa=None, utf8=False, dense_search=None):
+        self.regex = regex
+        self.nfa = nfa
+        self.utf8 = utf8
+        self._dense_dfa = dense_dfa
+        self._dense_search = dense_search
+        self._lazy_dfa = None
+        self._pike_vm = None
+
+    @property
+    def lazy_dfa(self):
+        if self._lazy_dfa is None:
+            self._lazy_dfa = LazyDFA(self.nfa)
+        return self._lazy_dfa
+
+    @property
+    def dense_dfa(self):
+        if self._dense_dfa is None:
+            self._dense_dfa = DenseDFA.from_nfa(self.nfa)
+        return self._dense_dfa
+
+    @property
+    def dense_search(self):
+        if self._dense_search is None:
+            self._dense_search = DenseSearch.from_nfa(self.nfa, self.dense_dfa)
+        return self._dense_search
+
+    def build_dfa(self, max_states=None):
+        # Builds the dense DFAs of matches() and search() now. ValueError if
+        # one needs more than max_states states; nothing is kept then.
+        dense = self._dense_dfa or DenseDFA.from_nfa(self.nfa, max_states=max_states)
+        self._dense_search = DenseSearch.from_nfa(self.nfa, dense, max_states=max_states)
+        self._dense_dfa = dense
+
+    @property
+    def pike_vm(self):
+        if self.utf8:
+            raise ValueError("Capture groups are only available on text patterns")
+        if self._pike_vm is None:
+            self._pike_vm = PikeVM(self.regex)
+        return self._pike_vm
+
+    def matches(self, text):
+        # A dense DFA, once built (or loaded), beats stepping the lazy one
+        if self._dense_dfa is not None:
+            return self._dense_dfa.matches(text)
+        return self.lazy_dfa.matches(text)
+
+    def search(self, text, pos=0):
+        # Same as matches(): the dense tables once they exist
+        if self._dense_search is not None:
+            return self._dense_search.search(text, pos)
+        return self.lazy_dfa.search(text, pos)
+
+    def captures(self, text, pos=0):
+        # search() plus the span of every group; see PikeVM.search
+        return self.pike_vm.search(text, pos)
+
+    def save(self, path, dfa=True):
+        # Binary file that NFA_BINARY.load maps back in; see NFA_BINARY
+        from NFA_BINARY import save
+        save(self, path, dfa)
+
+    def __repr__(self):
+        if self.utf8:
+            return f"Pattern({self.regex!r}, utf8=True)"
+        return f"Pattern({self.regex!r})"
+
+
+class PatternCache:
+    # Bounded LRU cache of compiled patterns keyed by the regex string (and
+    # whether it was compiled for UTF-8 bytes).
+    # With a directory it also keeps a persistent tier on disk, so a fresh
+    # process can warm-start from patterns compiled by an earlier one. Files
+    # are compiled pattern files (see NFA_BINARY); nothing in them is run
+    # as code.
+
+    def __init__(self, maxsize=256, directory=None):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_hits = 0
+        self.disk_writes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_hits": self.disk_hits,
+            "disk_writes": self.disk_writes,
+        }
+
+    def compile(self, regex, dfa=False, utf8=False):
+        key = (regex, utf8)
+        with self._lock:
+            pattern = self._entries.get(key)
+            if pattern is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        changed = False
+        if pattern is None:
+            pattern = self._load(regex, utf8)
+            if pattern is None:
+                pattern = Pattern(regex, regex_to_nfa(regex, utf8=utf8), utf8=utf8)
+                changed = True
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = pattern
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        if dfa and pattern._dense_dfa is None:
+            pattern._dense_dfa = DenseDFA.from_nfa(pattern.nfa)
+            changed = True
+        if changed:
+            self._store(pattern)
+        return pattern
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._entries.clear()
+        if disk and self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith(".nfab"):
+                    os.remove(os.path.join(self.directory, name))
+
+    def _path(self, regex, utf8):
+        digest = hashlib.sha256(regex.encode("utf-8") + (b"\0utf8" if utf8 else b"")).hexdigest()
+        return os.path.join(self.directory, digest + ".nfab")
+
+    def _load(self, regex, utf8):
+        if self.directory is None:
+            return None
+        from NFA_BINARY import loads
+        # Read in, not mapped: every mapping holds a file descriptor open,
+        # and the cache may keep thousands of patterns
+        try:
+            with open(self._path(regex, utf8), "rb") as f:
+                pattern = loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if pattern.regex != regex or pattern.utf8 != utf8:
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        return pattern
+
+    def _store(self, pattern):
+        if self.directory is None:
+            return
+        from NFA_BINARY import dumps
+        # Write to a temp file and rename, so readers never see half a file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(dumps(pattern, dfa=False))
+            os.replace(temp_path, self._path(pattern.regex, pattern.utf8))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        with self._lock:
+            self.disk_writes += 1
+
+
+default_cache = PatternCache()
+
+
+def compile(regex, dfa=False, utf8=False):
+    # Front door: compile regex once, hand back the cached Pattern after that
+    return default_cache.compile(regex, dfa, utf8)
+
+
+def purge():
+    default_cache.clear()
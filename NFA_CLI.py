@@ -0,0 +1,240 @@
+import argparse
+import mmap
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from NFA_BINARY import load
+from NFA_CACHE import Pattern
+from NFA_CODE import regex_to_nfa
+
+# grep over the package's engines:
+#
+#   python -m NFA_CLI [-c | -l] [-o] [-j N] [--stats] PATTERN [FILE...]
+#
+# The pattern is compiled once, as a UTF-8 byte automaton, and files are
+# searched as bytes: mapped with mmap, or read line by line from stdin
+# ("-" or no files). Only the lines that hold the pattern's required
+# literal are run through the automaton. Exit status is 0 if some line
+# matched, 1 if none did and 2 after an error, as with grep.
+
+# Files are read in slices of this size when counting their lines
+COUNT_CHUNK = 1 << 20
+# Patterns whose DFAs stay under this many states are handed to workers with
+# them built, so a worker searches the mapped tables from its first line
+MAX_DFA_STATES = 20000
+
+# Each worker process maps the compiled pattern once, in the initializer
+_worker_pattern = None
+
+
+def _init_worker(path):
+    global _worker_pattern
+    _worker_pattern = load(path)
+
+
+def _grep_file(path, options):
+    return grep_file(_worker_pattern, path, options)
+
+
+def compile_pattern(regex):
+    return Pattern(regex, regex_to_nfa(regex, utf8=True), utf8=True)
+
+
+def required_literal(pattern):
+    # Longest literal every match contains, as bytes; None if there is none
+    # worth looking for, or if it crosses a line break (matches never do)
+    prefilter = pattern.lazy_dfa.prefilter
+    if prefilter is None:
+        return None
+    required = prefilter.for_input(b"").required
+    if not required or b"\n" in required[0]:
+        return None
+    return required[0]
+
+
+def candidate_lines(data, literal):
+    # (start, end) of the lines of data, without their line break. With a
+    # literal, lines that don't contain it are skipped over by find.
+    size = len(data)
+    pos = 0
+    while pos < size:
+        if literal:
+            at = data.find(literal, pos)
+            if at < 0:
+                return
+            newline = data.rfind(b"\n", pos, at)
+            if newline >= 0:
+                pos = newline + 1
+        end = data.find(b"\n", pos)
+        if end < 0:
+            end = size
+        yield pos, end
+        pos = end + 1
+
+
+def grep_lines(pattern, lines, options, out, prefix=b""):
+    # Appends the output for lines (bytes, without line breaks) to out and
+    # returns how many of them matched
+    search = pattern.search
+    matched = 0
+    for line in lines:
+        found = search(line)
+        if found is None:
+            continue
+        matched += 1
+        if options.files_with_matches:
+            break
+        if options.count:
+            continue
+        if not options.only_matching:
+            out.append(prefix + line + b"\n")
+            continue
+        while found is not None:
+            start, end = found
+            if end > start:
+                out.append(prefix + line[start:end] + b"\n")
+            elif end == len(line):
+                break
+            found = search(line, end if end > start else end + 1)
+    return matched
+
+
+def count_lines(data):
+    lines = 0
+    for start in range(0, len(data), COUNT_CHUNK):
+        lines += data[start:start + COUNT_CHUNK].count(b"\n")
+    if data and data[-1] != ord("\n"):
+        lines += 1
+    return lines
+
+
+def grep_file(pattern, path, options):
+    # (output, matching lines, bytes, lines, error) for one file; lines of
+    # mapped files are only counted for --stats
+    out = []
+    prefix = os.fsencode(path) + b":" if options.with_filename else b""
+    try:
+        if path == "-":
+            read = [0, 0]
+
+            def stdin_lines():
+                for line in sys.stdin.buffer:
+                    read[0] += len(line)
+                    read[1] += 1
+                    yield line.rstrip(b"\n")
+            matched = grep_lines(pattern, stdin_lines(), options, out, prefix)
+            size, lines = read
+        else:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    matched, lines = 0, 0
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        literal = required_literal(pattern)
+                        lines = count_lines(data) if options.stats else 0
+                        matched = grep_lines(pattern, (data[start:end] for start, end in candidate_lines(data, literal)),
+                                             options, out, prefix)
+    except OSError as error:
+        return b"", 0, 0, 0, f"{path}: {error.strerror}"
+    name = b"(standard input)" if path == "-" else os.fsencode(path)
+    if options.files_with_matches:
+        out = [name + b"\n"] if matched else []
+    elif options.count:
+        out = [prefix + str(matched).encode("ascii") + b"\n"]
+    return b"".join(out), matched, size, lines, None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m NFA_CLI",
+                                     description="Print lines matching a regex, searched as UTF-8 bytes.")
+    parser.add_argument("pattern", help="regex in the package's syntax")
+    parser.add_argument("files", nargs="*", default=["-"], help="files to search; - or none for stdin")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("-c", "--count", action="store_true", help="print only a count of matching lines per file")
+    mode.add_argument("-l", "--files-with-matches", action="store_true", help="print only names of files with matches")
+    parser.add_argument("-o", "--only-matching", action="store_true", help="print only the matched parts of lines")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="worker processes for searching files (0: one per CPU)")
+    parser.add_argument("--stats", action="store_true",
+                        help="report compile time, automaton size and throughput on stderr")
+    options = parser.parse_args(argv)
+    if options.jobs < 0:
+        parser.error("--jobs must not be negative")
+    # Standard input is read in this process, so it rules out workers
+    options.jobs = 1 if "-" in options.files else min(options.jobs or os.cpu_count() or 1, len(options.files))
+    options.with_filename = len(options.files) > 1
+    return options
+
+
+def search_files(pattern, options):
+    # Results of grep_file for every file, in order. Several files and
+    # jobs go to a process pool; the workers map a binary copy of the
+    # compiled pattern, dense DFAs included, rather than compiling it again.
+    files = options.files
+    if options.jobs == 1:
+        for path in files:
+            yield grep_file(pattern, path, options)
+        return
+    fd, compiled = tempfile.mkstemp(suffix=".nfab")
+    os.close(fd)
+    try:
+        try:
+            pattern.build_dfa(MAX_DFA_STATES)
+        except ValueError:
+            # Too big to build up front: workers search with the lazy DFA
+            pass
+        pattern.save(compiled, dfa=False)
+        with ProcessPoolExecutor(options.jobs, initializer=_init_worker, initargs=(compiled,)) as pool:
+            yield from pool.map(_grep_file, files, [options] * len(files))
+    finally:
+        os.remove(compiled)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    began = time.perf_counter()
+    try:
+        pattern = compile_pattern(options.pattern)
+    except ValueError as error:
+        print(f"NFA_CLI: {error}", file=sys.stderr)
+        return 2
+    compiled = time.perf_counter()
+
+    output = sys.stdout.buffer
+    status = 1
+    total_matched = total_bytes = total_lines = 0
+    errors = False
+    for text, matched, size, lines, error in search_files(pattern, options):
+        if error is not None:
+            print(f"NFA_CLI: {error}", file=sys.stderr)
+            errors = True
+            continue
+        output.write(text)
+        if matched:
+            status = 0
+        total_matched += matched
+        total_bytes += size
+        total_lines += lines
+    output.flush()
+    finished = time.perf_counter()
+
+    if options.stats:
+        nfa = pattern.nfa
+        edges = sum(len(targets) for targets in nfa.transitions.values())
+        elapsed = max(finished - compiled, 1e-9)
+        print(f"compile    {(compiled - began) * 1000:.2f}ms", file=sys.stderr)
+        print(f"automaton  {len(nfa.states())} states, {edges} edges over bytes", file=sys.stderr)
+        print(f"searched   {total_bytes} bytes, {total_lines} lines in {elapsed * 1000:.1f}ms "
+              f"({options.jobs} job{'s' if options.jobs > 1 else ''})", file=sys.stderr)
+        print(f"throughput {total_bytes / elapsed / (1 << 20):.1f}MB/s, {total_lines / elapsed:.0f} lines/s",
+              file=sys.stderr)
+        print(f"matched    {total_matched} lines", file=sys.stderr)
+    return 2 if errors else status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,377 +17,1232 @@ Original file is located at
     https://colab.research.google.com/drive/1qHRftteSqobKXUQBMn9SJalZo4iIYUvh
 """
 
+import gc
+import hashlib
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import chain
+
 from graphviz import Digraph
 
+MAX_CODE_POINT = 0x10FFFF
+# Rendered graphs kept by render_nfa()
+RENDER_CACHE_SIZE = 64
+# NFAs with more states than this are drawn collapsed unless asked otherwise
+DETAIL_STATES = 150
+# Labels of collapsed chains are cut to this many characters
+MAX_EDGE_LABEL = 24
+DETAILS = ("auto", "full", "collapsed")
+
+logger = logging.getLogger(__name__)
+
+_render_cache = OrderedDict()
+_render_lock = threading.Lock()
+
+
+class CompileTrace:
+    # Opt-in instrumentation for the compile pipeline: pass one as trace= to
+    # regex_to_nfa() (or any single stage) to collect per-phase wall times
+    # and counters. Every step is also sent to this module's logger at DEBUG
+    # level, formatted lazily, and to callback(phase, message, args) if one
+    # is given. Without a trace the stages do no tracing work at all.
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.timings = {}
+        self.counters = {}
+
+    def step(self, phase, message, *args):
+        self.count(phase + "_steps")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[%s] " + message, phase, *args)
+        if self.callback is not None:
+            self.callback(phase, message, args)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def peak(self, name, value):
+        if value > self.counters.get(name, 0):
+            self.counters[name] = value
+
+    def add_time(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+
+def format_code_point(code_point):
+    char = chr(code_point)
+    return char if char.isprintable() and char != ' ' else f"\\u{code_point:04x}"
+
+
+class CharClass:
+    # Set of characters kept as sorted, disjoint (lo, hi) code point ranges,
+    # so building or negating a class costs O(#ranges) instead of O(#chars)
+    __slots__ = ("ranges", "_lows")
+
+    def __init__(self, ranges):
+        merged = []
+        for lo, hi in sorted(ranges):
+            if merged and lo <= merged[-1][1] + 1:
+                if hi > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], hi)
+            else:
+                merged.append((lo, hi))
+        self.ranges = tuple(merged)
+        self._lows = [lo for lo, _ in merged]
+
+    @classmethod
+    def single(cls, char):
+        return cls([(ord(char), ord(char))])
+
+    @classmethod
+    def parse(cls, body, start=0, end=None):
+        # body[start:end] is what sits between the brackets, e.g. "a-zA-Z_"
+        end = len(body) if end is None else end
+        ranges = []
+        j = start
+        while j < end:
+            if j + 2 < end and body[j + 1] == '-':
+                lo, hi = ord(body[j]), ord(body[j + 2])
+                if lo > hi:
+                    lo, hi = hi, lo
+                ranges.append((lo, hi))
+                j += 3
+            else:
+                ranges.append((ord(body[j]), ord(body[j])))
+                j += 1
+        return cls(ranges)
+
+    def negate(self):
+        ranges = []
+        next_lo = 0
+        for lo, hi in self.ranges:
+            if lo > next_lo:
+                ranges.append((next_lo, lo - 1))
+            next_lo = hi + 1
+        if next_lo <= MAX_CODE_POINT:
+            ranges.append((next_lo, MAX_CODE_POINT))
+        return CharClass(ranges)
+
+    def size(self):
+        return sum(hi - lo + 1 for lo, hi in self.ranges)
+
+    def __contains__(self, char):
+        code_point = ord(char)
+        i = bisect_right(self._lows, code_point) - 1
+        return i >= 0 and code_point <= self.ranges[i][1]
+
+    def __eq__(self, other):
+        return isinstance(other, CharClass) and self.ranges == other.ranges
+
+    def __hash__(self):
+        return hash(self.ranges)
+
+    def __repr__(self):
+        return f"CharClass({list(self.ranges)!r})"
+
+    def __str__(self):
+        # Mostly-everything classes read better as a negation
+        if self.size() > (MAX_CODE_POINT + 1) // 2:
+            return "!" + self.negate()._bracketed()
+        return self._bracketed()
+
+    def _bracketed(self):
+        parts = []
+        for lo, hi in self.ranges:
+            if lo == hi:
+                parts.append(format_code_point(lo))
+            else:
+                parts.append(format_code_point(lo) + "-" + format_code_point(hi))
+        return "[" + "".join(parts) + "]"
+
+
+def label_ranges(symbol):
+    # Edge labels are either a single character or a CharClass
+    if isinstance(symbol, CharClass):
+        return symbol.ranges
+    return ((ord(symbol), ord(symbol)),)
+
+
+class ClassMap(dict):
+    # char -> class id for a partition of the code point space. Class i
+    # covers [bounds[i - 1], bounds[i]); ids[i] is its id. Characters are
+    # looked up lazily and memoized, so lookups are a plain dict hit.
+
+    def __init__(self, bounds, ids):
+        super().__init__()
+        self.bounds = bounds
+        self.ids = ids
+
+    @classmethod
+    def for_labels(cls, labels):
+        # Coarsest partition on which every label is a union of classes
+        bounds = set()
+        for symbol in labels:
+            for lo, hi in label_ranges(symbol):
+                bounds.add(lo)
+                bounds.add(hi + 1)
+        bounds.discard(0)
+        bounds.discard(MAX_CODE_POINT + 1)
+        bounds = sorted(bounds)
+        return cls(bounds, list(range(len(bounds) + 1)))
+
+    def __missing__(self, char):
+        # Iterating bytes, bytearray or memoryview input yields ints: they
+        # are looked up as the code points of the same value
+        class_id = self.ids[bisect_right(self.bounds, char if type(char) is int else ord(char))]
+        self[char] = class_id
+        return class_id
+
+    def covering(self, symbol):
+        # Class ids making up a label
+        for lo, hi in label_ranges(symbol):
+            yield from range(bisect_right(self.bounds, lo), bisect_right(self.bounds, hi) + 1)
+
+
 class NFA:
-    def __init__(self, start, accept):
+    def __init__(self, start, accept, accepts=None):
+        # accept is the single accept state of a Thompson NFA; automata with
+        # several accepting states list them all in accepts (accept may then
+        # be None)
         self.start = start
         self.accept = accept
+        self.accepts = {accept} if accepts is None else set(accepts)
         self.transitions = {}
+        self._sim = None
+        self._dense = None
 
     def add_transition(self, from_state, symbol, to_state):
         if (from_state, symbol) not in self.transitions:
             self.transitions[(from_state, symbol)] = set()
         self.transitions[(from_state, symbol)].add(to_state)
+        # Any cached simulation tables are stale now
+        self._sim = None
+        self._dense = None
+
+    def states(self):
+        states = {self.start} | self.accepts
+        for (from_state, _), to_states in self.transitions.items():
+            states.add(from_state)
+            states.update(to_states)
+        return states
+
+    def epsilon_closure(self, states):
+        closure = set(states)
+        stack = list(states)
+        while stack:
+            state = stack.pop()
+            for target in self.transitions.get((state, None), ()):
+                if target not in closure:
+                    closure.add(target)
+                    stack.append(target)
+        return closure
+
+    def _simulation(self):
+        # Precompute everything the matchers need so the per-character loop
+        # only does dict lookups and set unions:
+        #   closures[s] -> epsilon-closure of s, reduced to the states that
+        #                  matter while matching (states with a character
+        #                  transition, plus the accepting states)
+        #   moves[s]    -> {class id: union of the closures of the targets}
+        #   classes     -> ClassMap from characters to class ids; every edge
+        #                  label is a union of these classes
+        if self._sim is not None:
+            return self._sim
+
+        labelled = {}
+        for (from_state, symbol), to_states in self.transitions.items():
+            if symbol is not None:
+                labelled.setdefault(from_state, {}).setdefault(symbol, set()).update(to_states)
+        classes = ClassMap.for_labels({symbol for by_symbol in labelled.values() for symbol in by_symbol})
+
+        closures = {}
+        for state in self.states():
+            closures[state] = frozenset(
+                s for s in self.epsilon_closure([state])
+                if s in labelled or s in self.accepts
+            )
+
+        moves = {}
+        for state, by_symbol in labelled.items():
+            moves[state] = {}
+            for symbol, targets in by_symbol.items():
+                reached = set()
+                for target in targets:
+                    reached |= closures[target]
+                for class_id in classes.covering(symbol):
+                    moves[state][class_id] = moves[state].get(class_id, frozenset()) | reached
+
+        self._sim = (closures, moves, classes)
+        return self._sim
+
+    def matches(self, text):
+        # Thompson simulation: the whole input must be accepted
+        closures, moves, classes = self._simulation()
+        current = closures[self.start]
+        for char in text:
+            if not current:
+                return False
+            class_id = classes[char]
+            reached = set()
+            for state in current:
+                targets = moves.get(state, {}).get(class_id)
+                if targets:
+                    reached |= targets
+            current = reached
+        return not self.accepts.isdisjoint(current)
+
+    def match_many(self, strings, longest=False):
+        # Batch matching through a dense DFA built on first use; see
+        # DenseDFA.match_many. Needs NumPy.
+        if self._dense is None:
+            from NFA_DFA import DenseDFA
+            self._dense = DenseDFA.from_nfa(self)
+        return self._dense.match_many(strings, longest)
+
+    def search(self, text, pos=0):
+        # Leftmost-longest match at or after pos, as (start, end), or None.
+        # Each live state remembers the earliest offset it was entered from,
+        # so a single left-to-right pass is enough.
+        closures, moves, classes = self._simulation()
+        initial = closures[self.start]
+        threads = {}
+        best = None
+        i = pos
+        while True:
+            if best is None:
+                for state in initial:
+                    if state not in threads:
+                        threads[state] = i
+
+            for final in self.accepts.intersection(threads):
+                started = threads[final]
+                if best is None or started < best[0] or (started == best[0] and i > best[1]):
+                    best = (started, i)
+            if best is not None:
+                # Threads that started after the best match can never beat it
+                threads = {s: st for s, st in threads.items() if st <= best[0]}
+                if not threads:
+                    break
+            if i >= len(text):
+                break
+
+            class_id = classes[text[i]]
+            reached = {}
+            for state, started in threads.items():
+                targets = moves.get(state, {}).get(class_id)
+                if targets:
+                    for target in targets:
+                        if target not in reached or started < reached[target]:
+                            reached[target] = started
+            threads = reached
+            i += 1
 
-def insert_concat(regex):
-    output = []
-    i = 0
+        return best
 
-    while i < len(regex):
-        current = regex[i]
-        output.append(current)
+class Node:
+    # Regex syntax tree. Nodes are immutable once built; children come
+    # first in postorder(), which is the order every construction uses.
+    __slots__ = ()
 
-        if current == '[':
-            i += 1
-            while i < len(regex) and regex[i] != ']':
-                output.append(regex[i])
-                i += 1
-            if i < len(regex):
-                output.append(regex[i])
-            else:
-                raise ValueError("Unclosed bracket in regex")
-        elif current == '!' and i + 1 < len(regex) and regex[i + 1] == '[':
-            output.append('[')  # Append only the opening bracket
-            i += 1  # Skip the ! since we'll handle negation differently
-            while i < len(regex) and regex[i] != ']':
-                output.append(regex[i])
-                i += 1
-            if i < len(regex):
-                output.append(regex[i])
-            else:
-                raise ValueError("Unclosed bracket in negated character class")
+    def children(self):
+        return ()
 
-        if i < len(regex) - 1:
-            next_char = regex[i + 1]
-            # Don't add concat after '!', include '+' in unary operators
-            if current != '!' and ((current.isalnum() or current in '*?+]') or current == ')') and \
-               (next_char.isalnum() or next_char in '([!' or next_char == '!'):
-                output.append('.')
 
-        i += 1
+class Symbol(Node):
+    # One character: label is a str or a CharClass, as on NFA edges
+    __slots__ = ("label",)
 
-    result = ''.join(output)
-    print(f"After inserting concatenation: {result}")
-    return result
+    def __init__(self, label):
+        self.label = label
 
-def infix_to_postfix(regex):
-    regex = insert_concat(regex)
-    precedence = {'*': 3, '?': 3, '+': 3, '.': 2, '|': 1}
-    output = []
-    stack = []
+    def __repr__(self):
+        return f"Symbol({self.label!r})"
 
-    print(f"Processing expanded regex: {regex}")
-    i = 0
-    while i < len(regex):
-        char = regex[i]
-        print(f"  Processing char '{char}' at position {i}, remaining: '{regex[i:]}'")
 
-        if char.isalnum():
-            output.append(char)
-            print(f"    Added operand: {''.join(output)}")
-        elif char == '[':
-            # Check if it's an empty character class
-            if i + 1 < len(regex) and regex[i + 1] == ']':
-                print(f"    Empty character class detected at position {i}")
-                # Skip this empty class - don't add anything to output
-                i += 1  # This will be incremented again at the end of the loop
-            else:
-                range_start = i
-                i += 1
-                while i < len(regex) and regex[i] != ']':
-                    i += 1
-                if i >= len(regex):
-                    print(f"    ERROR: Unclosed bracket at {range_start}, regex: {regex}")
-                    raise ValueError("Unclosed bracket in regex")
-                range_token = regex[range_start:i + 1]
-                output.append(range_token)
-                print(f"    Added character range: {range_token}")
-        elif char == '!' and i + 1 < len(regex) and regex[i + 1] == '[':
-            range_start = i
-            i += 2
-            while i < len(regex) and regex[i] != ']':
-                i += 1
-            if i >= len(regex):
-                print(f"    ERROR: Unclosed bracket at {range_start}, regex: {regex}")
-                raise ValueError("Unclosed bracket in negated regex")
-            range_token = regex[range_start:i + 1]
-            output.append(range_token)
-            print(f"    Added negated character range: {range_token}")
-        elif char == '(':
-            stack.append(char)
-            print(f"    Pushed '(' to stack: {stack}")
-        elif char == ')':
-            while stack and stack[-1] != '(':
-                output.append(stack.pop())
-                print(f"    Popped operator to output: {''.join(output)}")
-            if stack and stack[-1] == '(':
-                stack.pop()
-                print(f"    Popped '(' from stack: {stack}")
-            else:
-                print("    ERROR: Mismatched parentheses")
-        elif char in '*?+.|':
-            while (stack and stack[-1] != '(' and
-                   precedence.get(stack[-1], 0) >= precedence.get(char, 0)):
-                output.append(stack.pop())
-                print(f"    Popped higher precedence operator: {''.join(output)}")
-            stack.append(char)
-            print(f"    Pushed operator to stack: {stack}")
-        elif char == '!' and (i + 1 < len(regex) and regex[i + 1].isalnum()):
-            output.append('!' + regex[i + 1])
-            i += 1
-            print(f"    Added negated character: !{regex[i]}")
+class Concat(Node):
+    __slots__ = ("items",)
 
-        i += 1
+    def __init__(self, items):
+        self.items = items
+
+    def children(self):
+        return self.items
+
+    def __repr__(self):
+        return f"Concat({self.items!r})"
+
+
+class Union(Node):
+    __slots__ = ("items",)
+
+    def __init__(self, items):
+        self.items = items
+
+    def children(self):
+        return self.items
+
+    def __repr__(self):
+        return f"Union({self.items!r})"
+
+
+class Star(Node):
+    __slots__ = ("item",)
+
+    def __init__(self, item):
+        self.item = item
+
+    def children(self):
+        return (self.item,)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.item!r})"
+
+
+class Plus(Star):
+    __slots__ = ()
+
+
+class Optional(Star):
+    __slots__ = ()
+
+
+class Repeat(Node):
+    # item{min,max}; max is None for {min,}
+    __slots__ = ("item", "min", "max")
+
+    def __init__(self, item, min, max):
+        self.item = item
+        self.min = min
+        self.max = max
+
+    def children(self):
+        return (self.item,)
+
+    def __repr__(self):
+        return f"Repeat({self.item!r}, {self.min!r}, {self.max!r})"
+
+
+class Group(Node):
+    # Capturing group number index (from 1, in order of the '('); only in
+    # trees parsed with captures=True
+    __slots__ = ("item", "index")
+
+    def __init__(self, item, index):
+        self.item = item
+        self.index = index
+
+    def children(self):
+        return (self.item,)
+
+    def __repr__(self):
+        return f"Group({self.item!r}, {self.index!r})"
+
+
+REPEAT_NODES = {'*': Star, '+': Plus, '?': Optional}
+# Largest pattern accepted, in character positions once counted repeats
+# are unrolled; each is about two Thompson states. This is also what
+# bounds {m,n}: a single repeat counts its bound times its operand.
+MAX_POSITIONS = 250000
 
+
+def repeat_node(item, low, high):
+    # Node for item{low,high}, using the plain repeats where they fit
+    if high is None:
+        return Star(item) if low == 0 else Plus(item) if low == 1 else Repeat(item, low, None)
+    if low == 0 and high == 1:
+        return Optional(item)
+    if low == high == 1:
+        return item
+    return Repeat(item, low, high)
+
+
+def postorder(root):
+    # Nodes children-first, without recursion, so deeply nested patterns
+    # don't hit the interpreter's recursion limit
+    stack = [(root, False)]
     while stack:
-        if stack[-1] == '(':
-            stack.pop()
-            print("    ERROR: Mismatched parentheses")
+        node, expanded = stack.pop()
+        children = node.children()
+        if expanded or not children:
+            yield node
         else:
-            output.append(stack.pop())
-            print(f"    Popped remaining operator: {''.join(output)}")
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(children))
 
-    result = ''.join(output)
-    print(f"Final postfix: {result}")
-    return result
 
-def postfix_to_nfa(postfix):
-    state_counter = 0
-    stack = []
-    # Define appropriate character sets
-    alphabet = set()
-    for i in range(32, 127):  # ASCII printable characters
-        alphabet.add(chr(i))
-
-    print(f"\nProcessing postfix: '{postfix}' (length: {len(postfix)})")
+@contextmanager
+def gc_paused():
+    # Parsing and construction allocate lots of small objects without any
+    # reference cycles; collector passes over them are pure overhead
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def parse_regex(regex, trace=None, captures=False):
+    # Single left-to-right pass from pattern text to syntax tree.
+    #   a b 1        literal alphanumeric characters
+    #   [a-z_]       class; ![...] is its complement, !a any character but a
+    #   * + ?        repeat the preceding atom or group
+    #   {m} {m,} {m,n}   ... exactly m times, at least m, or m to n times
+    #   |            alternation, binding loosest
+    #   ( )          grouping
+    # Juxtaposition is concatenation ('.' is accepted and ignored); other
+    # characters are skipped. An unmatched ')' is ignored and an unclosed
+    # '(' is closed at the end, both with a warning. With captures=True
+    # every group is kept as a Group node, numbered in order of its '('.
+    # Patterns that would unroll to more than MAX_POSITIONS characters are
+    # refused with ValueError before anything is built.
+    with gc_paused():
+        tree = parse_tree(regex, trace, captures)
+    positions = unrolled_size(tree)
+    if positions > MAX_POSITIONS:
+        raise ValueError(f"Pattern unrolls to {positions} characters, more than {MAX_POSITIONS}")
+    return tree
+
+
+def unrolled_size(root):
+    # Characters in the pattern once every counted repeat is written out
+    sizes = []
+    for node in postorder(root):
+        count = len(node.children())
+        size = sum(sizes[-count:]) if count else 1
+        del sizes[len(sizes) - count:]
+        if isinstance(node, Repeat):
+            size *= node.min + 1 if node.max is None else node.max
+        sizes.append(size)
+    return sizes[0]
+
+
+def parse_tree(regex, trace, captures=False):
+    if trace is not None:
+        began = time.perf_counter()
+    groups = []
+    group_count = 0
+    alternatives, sequence = [], []
+    length = len(regex)
     i = 0
-    while i < len(postfix):
-        char = postfix[i]
-        print(f"Step {i}: char = '{char}', Stack size = {len(stack)}")
-
+    while i < length:
+        char = regex[i]
+        if trace is not None:
+            trace.step("parse_regex", "Token %r at position %d, group depth %d", char, i, len(groups))
         if char.isalnum():
-            start = state_counter
-            state_counter += 1
-            accept = state_counter
-            state_counter += 1
-            nfa = NFA(start, accept)
-            nfa.add_transition(start, char, accept)
-            stack.append(nfa)
-            print(f"  Added char {char}: S{start} --{char}--> S{accept}")
-            print(f"  Stack size now: {len(stack)}")
-
-        elif char == '[':
-            # Check for empty character class
-            if i + 1 < len(postfix) and postfix[i + 1] == ']':
-                i += 1  # Skip the empty class
-                print(f"  Skipping empty character class")
-                continue
-                
-            range_start = i
+            sequence.append(Symbol(char))
+        elif char == '[' or (char == '!' and i + 1 < length and regex[i + 1] == '['):
+            body = i + 1 if char == '[' else i + 2
+            end = regex.find(']', body)
+            if end < 0:
+                raise ValueError("Unclosed bracket in regex")
+            if end == body:
+                raise ValueError(f"Empty character class at position {i}")
+            char_class = CharClass.parse(regex, body, end)
+            sequence.append(Symbol(char_class.negate() if char == '!' else char_class))
+            i = end
+        elif char == '!' and i + 1 < length and regex[i + 1].isalnum():
             i += 1
-            while i < len(postfix) and postfix[i] != ']':
-                i += 1
-            if i >= len(postfix):
-                raise ValueError("Unclosed bracket in postfix")
-            range_expr = postfix[range_start:i + 1]
-
-            start = state_counter
-            state_counter += 1
-            accept = state_counter
-            state_counter += 1
-            nfa = NFA(start, accept)
-
-            j = 1
-            allowed_chars = set()
-            while j < len(range_expr) - 1:
-                if j + 2 < len(range_expr) - 1 and range_expr[j + 1] == '-':
-                    # Handle character range properly
-                    start_char, end_char = range_expr[j], range_expr[j + 2]
-                    
-                    # Ensure proper range processing
-                    if start_char > end_char:
-                        start_char, end_char = end_char, start_char
-                        
-                    # Generate only the appropriate characters in the range
-                    for c in range(ord(start_char), ord(end_char) + 1):
-                        allowed_chars.add(chr(c))
-                    j += 3
+            sequence.append(Symbol(CharClass.single(regex[i]).negate()))
+        elif char in REPEAT_NODES:
+            if not sequence:
+                raise ValueError(f"No operand for '{char}'")
+            sequence[-1] = REPEAT_NODES[char](sequence[-1])
+        elif char == '{':
+            if not sequence:
+                raise ValueError("No operand for '{'")
+            close = regex.find('}', i)
+            if close < 0:
+                raise ValueError("Unclosed '{' in regex")
+            low, high = parse_bounds(regex[i + 1:close])
+            sequence[-1] = repeat_node(sequence[-1], low, high)
+            i = close
+        elif char == '|':
+            alternatives.append(sequence_node(sequence, "|"))
+            sequence = []
+        elif char == '(':
+            group_count += 1
+            groups.append((alternatives, sequence, group_count))
+            alternatives, sequence = [], []
+            if trace is not None:
+                trace.peak("max_group_depth", len(groups))
+        elif char == ')':
+            if groups:
+                node = alternatives_node(alternatives, sequence)
+                alternatives, sequence, index = groups.pop()
+                sequence.append(Group(node, index) if captures else node)
+            else:
+                logger.warning("Mismatched parentheses at position %d in %r", i, regex)
+        i += 1
+
+    while groups:
+        logger.warning("Unclosed '(' in %r", regex)
+        node = alternatives_node(alternatives, sequence)
+        alternatives, sequence, index = groups.pop()
+        sequence.append(Group(node, index) if captures else node)
+    root = alternatives_node(alternatives, sequence)
+    if trace is not None:
+        trace.step("parse_regex", "Parsed %d characters into a %s", length, type(root).__name__)
+        trace.add_time("parse_regex", time.perf_counter() - began)
+    return root
+
+
+def parse_bounds(body):
+    # "m", "m," or "m,n" (spaces allowed) -> (m, n), n None if unbounded
+    low, comma, high = body.replace(" ", "").partition(',')
+    if not low.isdigit() or (high and not high.isdigit()):
+        raise ValueError(f"Invalid repetition {{{body}}}")
+    low = int(low)
+    high = int(high) if high else (None if comma else low)
+    if high is not None and high < low:
+        raise ValueError(f"Invalid repetition {{{body}}}: {high} is less than {low}")
+    if high == 0:
+        raise ValueError(f"Invalid repetition {{{body}}}: nothing left to match")
+    return low, high
+
+
+def sequence_node(sequence, operator):
+    if not sequence:
+        raise ValueError(f"Not enough operands for '{operator}'")
+    return sequence[0] if len(sequence) == 1 else Concat(sequence)
+
+
+def alternatives_node(alternatives, sequence):
+    if not alternatives:
+        if not sequence:
+            raise ValueError("Invalid regex: incomplete expression")
+        return sequence_node(sequence, ".")
+    alternatives.append(sequence_node(sequence, "|"))
+    return Union(alternatives)
+
+
+# Nested repeats with the same meaning as one: FOLDED[outer, inner]
+FOLDED = {
+    (Star, Star): Star, (Star, Plus): Star, (Star, Optional): Star,
+    (Plus, Star): Star, (Plus, Plus): Plus, (Plus, Optional): Star,
+    (Optional, Star): Star, (Optional, Plus): Star, (Optional, Optional): Optional,
+}
+
+
+class TreeOptimizer:
+    # Rewrites a syntax tree bottom-up into an equivalent, smaller one:
+    #   - nested concatenations and alternations are flattened
+    #   - alternatives are put in a trie, so common prefixes are matched
+    #     once (foo|foobar|food -> foo(bar|d)?); at each branch point the
+    #     remaining tails share their common suffixes the same way
+    #   - single-character alternatives become one class (a|b|[cd] -> [a-d])
+    #   - repeats of repeats fold: (x*)* and x** -> x*, x?* and x+? -> x*
+    # Matching is leftmost-longest, so the order of alternatives never
+    # matters and any equivalent tree is as good as another.
+
+    def __init__(self):
+        # Structurally equal subtrees get the same small int, so tails and
+        # trie edges are compared by int instead of by walking subtrees
+        self.interned = {}
+        self.keys = {}
+
+    def key(self, node):
+        entry = self.keys.get(id(node))
+        if entry is None:
+            if isinstance(node, Symbol):
+                shape = (Symbol, node.label)
+            elif isinstance(node, Repeat):
+                shape = (Repeat, node.min, node.max, self.key(node.item))
+            elif isinstance(node, Group):
+                shape = (Group, node.index, self.key(node.item))
+            else:
+                shape = (type(node),) + tuple(self.key(child) for child in node.children())
+            entry = self.keys[id(node)] = (node, self.interned.setdefault(shape, len(self.interned)))
+        return entry[1]
+
+    def optimize(self, root):
+        done = {}
+        for node in postorder(root):
+            children = [done.pop(id(child)) for child in node.children()]
+            if isinstance(node, Symbol):
+                result = node
+            elif isinstance(node, Concat):
+                result = self.concat(children)
+            elif isinstance(node, Union):
+                items = []
+                for child in children:
+                    items.extend(child.items if isinstance(child, Union) else (child,))
+                result = self.alternatives(items, reverse=False)
+            elif isinstance(node, Repeat):
+                result = self.bounded(children[0], node.min, node.max)
+            elif isinstance(node, Group):
+                result = Group(children[0], node.index)
+            else:
+                result = self.repeat(type(node), children[0])
+            done[id(node)] = result
+        return done[id(root)]
+
+    def concat(self, items):
+        flat = []
+        for item in items:
+            flat.extend(item.items if isinstance(item, Concat) else (item,))
+        return flat[0] if len(flat) == 1 else Concat(flat)
+
+    def repeat(self, kind, item):
+        if isinstance(item, Star):
+            return FOLDED[kind, type(item)](item.item)
+        return kind(item)
+
+    def bounded(self, item, low, high):
+        # (x*){m,n} is x*, (x+){m,n} is x{m,} and (x?){m,n} is x{0,n}
+        if isinstance(item, Plus):
+            return repeat_node(item.item, low, None)
+        if isinstance(item, Optional):
+            return repeat_node(item.item, 0, high)
+        if isinstance(item, Star):
+            return item
+        return repeat_node(item, low, high)
+
+    def alternatives(self, items, reverse):
+        # Prefix trie over the alternatives (reverse=False), or suffix trie
+        # over the tails left at one branch point (reverse=True)
+        if len(items) == 1:
+            return items[0]
+        root = ({}, [False])
+        for item in items:
+            node = root
+            sequence = item.items if isinstance(item, Concat) else (item,)
+            for element in (reversed(sequence) if reverse else sequence):
+                edges = node[0]
+                key = self.key(element)
+                if key not in edges:
+                    edges[key] = (element, ({}, [False]))
+                node = edges[key][1]
+            node[1][0] = True
+
+        built = {}
+        stack = [(root, False)]
+        while stack:
+            node, expanded = stack.pop()
+            edges, (ends,) = node
+            if edges and not expanded:
+                stack.append((node, True))
+                stack.extend((child, False) for _, child in edges.values())
+                continue
+            branches = []
+            for element, child in edges.values():
+                tail = built.pop(id(child))
+                if tail is None:
+                    branches.append(element)
                 else:
-                    allowed_chars.add(range_expr[j])
-                    j += 1
-
-            for c in allowed_chars:
-                nfa.add_transition(start, c, accept)
-            print(f"  Added range {range_expr}: S{start} --{allowed_chars}--> S{accept}")
-            stack.append(nfa)
-            print(f"  Stack size now: {len(stack)}")
-
-        elif char == '!' and i + 1 < len(postfix) and postfix[i + 1] == '[':
-            range_start = i
-            i += 2
-            while i < len(postfix) and postfix[i] != ']':
-                i += 1
-            if i >= len(postfix):
-                raise ValueError("Unclosed bracket in negated postfix")
-            range_expr = postfix[range_start:i + 1]
-
-            start = state_counter
-            state_counter += 1
-            accept = state_counter
-            state_counter += 1
-            nfa = NFA(start, accept)
-
-            j = 2
-            excluded_chars = set()
-            while j < len(range_expr) - 1:
-                if j + 2 < len(range_expr) - 1 and range_expr[j + 1] == '-':
-                    start_char, end_char = range_expr[j], range_expr[j + 2]
-                    if ord(start_char) > ord(end_char):
-                        start_char, end_char = end_char, start_char
-                    for c in range(ord(start_char), ord(end_char) + 1):
-                        excluded_chars.add(chr(c))
-                    j += 3
+                    branches.append(self.concat([tail, element] if reverse else [element, tail]))
+            result = None
+            if branches:
+                if reverse:
+                    result = self.merge_symbols(branches)
                 else:
-                    excluded_chars.add(range_expr[j])
-                    j += 1
-
-            # Only include alphabet characters (not special chars) for negated class
-            valid_chars = set(c for c in alphabet if c.isalnum() or c.isspace())
-            for c in valid_chars - excluded_chars:
-                nfa.add_transition(start, c, accept)
-            print(f"  Added negated range {range_expr}: S{start} --(not {excluded_chars})--> S{accept}")
-            stack.append(nfa)
-            print(f"  Stack size now: {len(stack)}")
-
-        elif char == '!' and i + 1 < len(postfix) and postfix[i + 1].isalnum():
-            i += 1
-            negated_char = postfix[i]
-            start = state_counter
-            state_counter += 1
-            accept = state_counter
-            state_counter += 1
-            nfa = NFA(start, accept)
-            # Only include alphabet characters for negated single char
-            valid_chars = set(c for c in alphabet if c.isalnum() or c.isspace())
-            for c in valid_chars - {negated_char}:
-                nfa.add_transition(start, c, accept)
-            stack.append(nfa)
-            print(f"  Added negated char !{negated_char}: S{start} --(not {negated_char})--> S{accept}")
-            print(f"  Stack size now: {len(stack)}")
+                    result = self.alternatives(branches, reverse=True)
+                if ends:
+                    result = self.repeat(Optional, result)
+            built[id(node)] = result
+        return built[id(root)]
+
+    def merge_symbols(self, branches):
+        symbols = [branch for branch in branches if isinstance(branch, Symbol)]
+        if len(symbols) > 1:
+            char_class = CharClass([r for symbol in symbols for r in label_ranges(symbol.label)])
+            if char_class.size() == 1:
+                merged = Symbol(chr(char_class.ranges[0][0]))
+            else:
+                merged = Symbol(char_class)
+            branches = [branch for branch in branches if not isinstance(branch, Symbol)] + [merged]
+        return branches[0] if len(branches) == 1 else Union(branches)
+
+
+def optimize_ast(root, trace=None):
+    if trace is not None:
+        began = time.perf_counter()
+    with gc_paused():
+        result = TreeOptimizer().optimize(root)
+    if trace is not None:
+        trace.step("optimize_ast", "%d nodes -> %d nodes",
+                   sum(1 for _ in postorder(root)), sum(1 for _ in postorder(result)))
+        trace.add_time("optimize_ast", time.perf_counter() - began)
+    return result
 
-        elif char == '|':
-            if len(stack) < 2:
-                print(f"  ERROR: Not enough operands for '|' (stack size: {len(stack)})")
-                raise ValueError("Not enough operands for '|'")
-            nfa2 = stack.pop()
-            nfa1 = stack.pop()
-            start = state_counter
-            state_counter += 1
-            accept = state_counter
-            state_counter += 1
-            nfa = NFA(start, accept)
-            nfa.add_transition(start, None, nfa1.start)
-            nfa.add_transition(start, None, nfa2.start)
-            nfa.add_transition(nfa1.accept, None, accept)
-            nfa.add_transition(nfa2.accept, None, accept)
-            nfa.transitions.update(nfa1.transitions)
-            nfa.transitions.update(nfa2.transitions)
-            stack.append(nfa)
-            print(f"  Union: S{start} --ε--> S{nfa1.start}, S{nfa2.start}; S{nfa1.accept}, S{nfa2.accept} --ε--> S{accept}")
-            print(f"  Stack size now: {len(stack)}")
-
-        elif char == '*':
-            if not stack:
-                print(f"  ERROR: No operand for '*' (stack size: {len(stack)})")
-                raise ValueError("No operand for '*'")
-            nfa1 = stack.pop()
-            start = state_counter
-            state_counter += 1
-            accept = state_counter
-            state_counter += 1
-            nfa = NFA(start, accept)
-            nfa.add_transition(start, None, nfa1.start)
-            nfa.add_transition(nfa1.accept, None, accept)
-            nfa.add_transition(start, None, accept)
-            nfa.add_transition(nfa1.accept, None, nfa1.start)
-            nfa.transitions.update(nfa1.transitions)
-            stack.append(nfa)
-            print(f"  Star: S{start} --ε--> S{nfa1.start}, S{accept}; S{nfa1.accept} --ε--> S{nfa1.start}, S{accept}")
-            print(f"  Stack size now: {len(stack)}")
-
-        elif char == '+':  # + operator
-            if not stack:
-                print(f"  ERROR: No operand for '+' (stack size: {len(stack)})")
-                raise ValueError("No operand for '+'")
-            nfa1 = stack.pop()
-            start = state_counter
-            state_counter += 1
-            accept = state_counter
-            state_counter += 1
-            nfa = NFA(start, accept)
-            nfa.add_transition(start, None, nfa1.start)
-            nfa.add_transition(nfa1.accept, None, accept)
-            nfa.add_transition(nfa1.accept, None, nfa1.start)  # Loop back for more
-            nfa.transitions.update(nfa1.transitions)
-            stack.append(nfa)
-            print(f"  Plus: S{start} --ε--> S{nfa1.start}; S{nfa1.accept} --ε--> S{nfa1.start}, S{accept}")
-            print(f"  Stack size now: {len(stack)}")
-
-        elif char == '?':
-            if not stack:
-                print(f"  ERROR: No operand for '?' (stack size: {len(stack)})")
-                raise ValueError("No operand for '?'")
-            nfa1 = stack.pop()
-            start = state_counter
-            state_counter += 1
-            accept = state_counter
-            state_counter += 1
-            nfa = NFA(start, accept)
-            nfa.add_transition(start, None, nfa1.start)
-            nfa.add_transition(nfa1.accept, None, accept)
-            nfa.add_transition(start, None, accept)
-            nfa.transitions.update(nfa1.transitions)
-            stack.append(nfa)
-            print(f"  Optional: S{start} --ε--> S{nfa1.start}, S{accept}; S{nfa1.accept} --ε--> S{accept}")
-            print(f"  Stack size now: {len(stack)}")
-
-        elif char == '.':
-            if len(stack) < 2:
-                print(f"  ERROR: Not enough operands for '.' (stack size: {len(stack)})")
-                raise ValueError("Not enough operands for '.'")
-            nfa2 = stack.pop()
-            nfa1 = stack.pop()
-            nfa = NFA(nfa1.start, nfa2.accept)
-            nfa.add_transition(nfa1.accept, None, nfa2.start)
-            nfa.transitions.update(nfa1.transitions)
-            nfa.transitions.update(nfa2.transitions)
-            stack.append(nfa)
-            print(f"  Concat: S{nfa1.accept} --ε--> S{nfa2.start}")
-            print(f"  Stack size now: {len(stack)}")
 
-        i += 1
+class ThompsonArena:
+    # Shared store for Thompson construction. Every state gets at most one
+    # labelled edge and at most two epsilon edges, so the automaton lives in
+    # flat per-state arrays and a fragment is nothing but (start, accept).
+    # Combining fragments never copies edges, which keeps construction
+    # linear in the pattern length. eps1 is the preferred edge (the left
+    # alternative, another round of a repeat), and a state with a slot
+    # records the position it is passed at into that capture slot.
+
+    def __init__(self):
+        self.labels = []
+        self.targets = array('l')
+        self.eps1 = array('l')
+        self.eps2 = array('l')
+        self.slots = array('l')
+
+    def __len__(self):
+        return len(self.labels)
+
+    def new_state(self):
+        self.labels.append(None)
+        self.targets.append(-1)
+        self.eps1.append(-1)
+        self.eps2.append(-1)
+        self.slots.append(-1)
+        return len(self.labels) - 1
+
+    def fragment(self, label):
+        start = self.new_state()
+        accept = self.new_state()
+        self.add_edge(start, label, accept)
+        return start, accept
+
+    def add_edge(self, from_state, label, to_state):
+        if label is not None:
+            self.labels[from_state] = label
+            self.targets[from_state] = to_state
+        elif self.eps1[from_state] < 0:
+            self.eps1[from_state] = to_state
+        elif self.eps2[from_state] < 0:
+            self.eps2[from_state] = to_state
+        else:
+            raise ValueError(f"State S{from_state} already has two epsilon edges")
+
+    def copy(self, lo, hi):
+        # Append a copy of states lo..hi-1, edges renumbered to match, and
+        # return the offset from old to new state numbers. The states must
+        # form a finished fragment, whose edges all stay inside it.
+        shift = len(self.labels) - lo
+        self.labels.extend(self.labels[lo:hi])
+        for column in (self.targets, self.eps1, self.eps2):
+            column.extend([target + shift if target >= 0 else -1 for target in column[lo:hi]])
+        self.slots.extend(self.slots[lo:hi])
+        return shift
+
+    def to_nfa(self, start, accept):
+        nfa = NFA(start, accept)
+        transitions = nfa.transitions
+        for state, label in enumerate(self.labels):
+            if label is not None:
+                transitions[(state, label)] = {self.targets[state]}
+            if self.eps1[state] >= 0:
+                transitions[(state, None)] = {self.eps1[state]}
+                if self.eps2[state] >= 0:
+                    transitions[(state, None)].add(self.eps2[state])
+        return nfa
+
+
+def ast_to_nfa(root, trace=None):
+    if trace is not None:
+        began = time.perf_counter()
+    arena, start, accept = ast_to_arena(root, trace)
+    nfa = arena.to_nfa(start, accept)
+    if trace is not None:
+        trace.count("states", len(arena))
+        trace.count("edges", sum(len(targets) for targets in nfa.transitions.values()))
+        trace.add_time("ast_to_nfa", time.perf_counter() - began)
+    return nfa
+
+
+def ast_to_arena(root, trace=None):
+    # Thompson construction, walking the tree children-first like a postfix
+    # expression: every finished subtree leaves a (start, accept, lowest)
+    # fragment on the stack. A subtree's states are numbered from lowest up
+    # to the end of the arena, so a repeat can copy them as a block.
+    # Returns (arena, start, accept).
+    arena = ThompsonArena()
+    stack = []
+    for node in postorder(root):
+        if trace is not None:
+            trace.peak("max_fragment_stack", len(stack))
+
+        if isinstance(node, Symbol):
+            start, accept = arena.fragment(node.label)
+            stack.append((start, accept, start))
+            if trace is not None:
+                trace.step("ast_to_nfa", "Added %s: S%d --%s--> S%d", node.label, start, node.label, accept)
+
+        elif isinstance(node, Concat):
+            fragments = stack[-len(node.items):]
+            del stack[-len(node.items):]
+            for (_, accept1, _), (start2, _, _) in zip(fragments, fragments[1:]):
+                arena.add_edge(accept1, None, start2)
+            stack.append((fragments[0][0], fragments[-1][1], fragments[0][2]))
+            if trace is not None:
+                trace.step("ast_to_nfa", "Concat of %d: S%d ... S%d", len(fragments), *stack[-1][:2])
+
+        elif isinstance(node, Union):
+            # Folded pairwise, as each state has room for two epsilon edges
+            fragments = stack[-len(node.items):]
+            del stack[-len(node.items):]
+            start1, accept1, lowest = fragments[0]
+            for start2, accept2, _ in fragments[1:]:
+                start = arena.new_state()
+                accept = arena.new_state()
+                arena.add_edge(start, None, start1)
+                arena.add_edge(start, None, start2)
+                arena.add_edge(accept1, None, accept)
+                arena.add_edge(accept2, None, accept)
+                if trace is not None:
+                    trace.step("ast_to_nfa", "Union: S%d --ε--> S%d, S%d; S%d, S%d --ε--> S%d", start, start1, start2, accept1, accept2, accept)
+                start1, accept1 = start, accept
+            stack.append((start1, accept1, lowest))
+
+        elif isinstance(node, Repeat):
+            # Unrolled into copies of the item chained one after another.
+            # Once min copies are done, the state between two copies also
+            # leads straight to the exit, so the optional copies nest like
+            # x{2,4} = xx(x(x)?)? without any epsilon chains between them;
+            # for {min,} the last copy loops instead.
+            start1, accept1, lowest = stack.pop()
+            count = node.min if node.max is None else node.max
+            end = len(arena)
+            copies = [(start1, accept1)]
+            for _ in range(max(count, 1) - 1):
+                shift = arena.copy(lowest, end)
+                copies.append((start1 + shift, accept1 + shift))
+            accept = arena.new_state()
+            start = copies[0][0]
+            if node.min == 0:
+                start = arena.new_state()
+                arena.add_edge(start, None, copies[0][0])
+                arena.add_edge(start, None, accept)  # Zero times
+            for done, (_, copy_accept) in enumerate(copies, 1):
+                if done < len(copies):
+                    arena.add_edge(copy_accept, None, copies[done][0])
+                elif node.max is None:
+                    arena.add_edge(copy_accept, None, copies[-1][0])  # Loop back for more
+                if done >= node.min:
+                    arena.add_edge(copy_accept, None, accept)
+            stack.append((start, accept, lowest))
+            if trace is not None:
+                trace.step("ast_to_nfa", "Repeat {%s,%s}: %d copies, S%d ... S%d",
+                           node.min, node.max, len(copies), start, accept)
+
+        elif isinstance(node, Group):
+            # Passing through records where the group opens and closes
+            start1, accept1, lowest = stack.pop()
+            start = arena.new_state()
+            accept = arena.new_state()
+            arena.slots[start] = 2 * node.index
+            arena.slots[accept] = 2 * node.index + 1
+            arena.add_edge(start, None, start1)
+            arena.add_edge(accept1, None, accept)
+            stack.append((start, accept, lowest))
 
-    print(f"Final stack size: {len(stack)}")
-    while len(stack) > 1:
-        nfa2 = stack.pop()
-        nfa1 = stack.pop()
-        nfa = NFA(nfa1.start, nfa2.accept)
-        nfa.add_transition(nfa1.accept, None, nfa2.start)
-        nfa.transitions.update(nfa1.transitions)
-        nfa.transitions.update(nfa2.transitions)
-        stack.append(nfa)
-        print(f"  Implicit concatenation: S{nfa1.accept} --ε--> S{nfa2.start}")
-        print(f"  Stack size now: {len(stack)}")
-
-    if len(stack) != 1:
-        print(f"Stack still has wrong number of NFAs: {len(stack)}")
-        raise ValueError("Invalid regex: incomplete expression")
-    return stack[0]
-
-def regex_to_nfa(regex):
-    postfix = infix_to_postfix(regex)
-    return postfix_to_nfa(postfix)
+        else:
+            start1, accept1, lowest = stack.pop()
+            start = arena.new_state()
+            accept = arena.new_state()
+            arena.add_edge(start, None, start1)
+            if not isinstance(node, Plus):
+                arena.add_edge(start, None, accept)  # Zero times
+            if not isinstance(node, Optional):
+                arena.add_edge(accept1, None, start1)  # Loop back for more
+            arena.add_edge(accept1, None, accept)
+            stack.append((start, accept, lowest))
+            if trace is not None:
+                trace.step("ast_to_nfa", "%s: S%d --ε--> S%d; S%d --ε--> S%d", type(node).__name__, start, start1, accept1, accept)
+
+    start, accept, _ = stack.pop()
+    return arena, start, accept
+
+
+def ast_to_glushkov(root, trace=None):
+    # Glushkov (position) automaton: state 0 is the start and every symbol of
+    # the pattern is a state of its own, entered only by that symbol's label.
+    # Each subtree is summarised as (nullable, first, last) position sets,
+    # and follow[p] collects the positions that may come after p. No epsilon
+    # edges, exactly one state per symbol plus one.
+    if trace is not None:
+        began = time.perf_counter()
+    labels = [None]
+    follow = [set()]
+    stack = []
+    for node in postorder(root):
+        if isinstance(node, Symbol):
+            labels.append(node.label)
+            follow.append(set())
+            position = len(labels) - 1
+            stack.append((False, {position}, {position}))
+            if trace is not None:
+                trace.step("ast_to_glushkov", "Position %d: %s", position, node.label)
+
+        elif isinstance(node, Concat):
+            parts = stack[-len(node.items):]
+            del stack[-len(node.items):]
+            nullable, first, last = parts[0]
+            for nullable2, first2, last2 in parts[1:]:
+                for position in last:
+                    follow[position] |= first2
+                if nullable:
+                    first = first | first2
+                last = last | last2 if nullable2 else last2
+                nullable = nullable and nullable2
+            stack.append((nullable, first, last))
+
+        elif isinstance(node, Union):
+            parts = stack[-len(node.items):]
+            del stack[-len(node.items):]
+            stack.append((any(part[0] for part in parts),
+                          set().union(*(part[1] for part in parts)),
+                          set().union(*(part[2] for part in parts))))
+
+        elif isinstance(node, Group):
+            pass  # Positions carry no capture information
+
+        elif isinstance(node, Repeat):
+            # Copies of the item's positions, nested from the right as
+            # x(x(x)?)? once min copies are done, so every copy only leads
+            # into the next one. A subtree's positions are numbered from its
+            # leftmost symbol, which is always in its first set.
+            nullable, first, last = stack.pop()
+            lowest = min(first)
+            end = len(labels)
+            count = max(node.min if node.max is None else node.max, 1)
+            copies = [(first, last)]
+            for shift in range(end - lowest, (end - lowest) * count, end - lowest):
+                labels.extend(labels[lowest:end])
+                follow.extend({target + shift for target in follow[position]} for position in range(lowest, end))
+                copies.append(({position + shift for position in first}, {position + shift for position in last}))
+            tail_nullable, tail_first, tail_last = nullable, copies[-1][0], copies[-1][1]
+            if node.max is None:
+                for position in tail_last:
+                    follow[position] |= tail_first
+            for done in range(len(copies) - 1, 0, -1):
+                copy_first, copy_last = copies[done - 1]
+                tail_nullable = tail_nullable or done >= node.min
+                for position in copy_last:
+                    follow[position] |= tail_first
+                # Sets grow in place: rebuilding them for every copy would be
+                # quadratic in the count
+                if nullable:
+                    copy_first |= tail_first
+                tail_first = copy_first
+                if tail_nullable:
+                    tail_last |= copy_last
+                tail_nullable = nullable and tail_nullable
+            stack.append((tail_nullable or node.min == 0, tail_first, tail_last))
+
+        else:
+            nullable, first, last = stack.pop()
+            if not isinstance(node, Optional):
+                for position in last:
+                    follow[position] |= first
+            stack.append((nullable or not isinstance(node, Plus), first, last))
+
+    nullable, first, last = stack.pop()
+    accepts = set(last) | ({0} if nullable else set())
+    nfa = NFA(0, next(iter(accepts)) if len(accepts) == 1 else None, accepts)
+    for position in range(len(labels)):
+        for target in (first if position == 0 else follow[position]):
+            nfa.add_transition(position, labels[target], target)
+    if trace is not None:
+        trace.count("states", len(labels))
+        trace.count("edges", sum(len(targets) for targets in nfa.transitions.values()))
+        trace.add_time("ast_to_glushkov", time.perf_counter() - began)
+    return nfa
+
+
+CONSTRUCTIONS = {
+    "thompson": ast_to_nfa,
+    "glushkov": ast_to_glushkov,
+}
+
+
+def regex_to_nfa(regex, trace=None, construction="thompson", optimize=True, utf8=False):
+    # construction="glushkov" builds the epsilon-free position automaton;
+    # optimize=False skips optimize_ast and builds the tree as written;
+    # utf8=True gives a byte automaton for UTF-8 input (see utf8_nfa)
+    if construction not in CONSTRUCTIONS:
+        raise ValueError(f"Unknown construction {construction!r}")
+    with gc_paused():
+        tree = parse_regex(regex, trace)
+        if optimize:
+            tree = optimize_ast(tree, trace)
+        nfa = CONSTRUCTIONS[construction](tree, trace)
+        return utf8_nfa(nfa, trace) if utf8 else nfa
+
+
+# Characters of a str copied at a time by tail()
+TAIL_CHUNK = 4096
+
+# Largest code point encoded in 1, 2 and 3 UTF-8 bytes
+UTF8_BOUNDARIES = (0x7F, 0x7FF, 0xFFFF)
+
+
+def utf8_sequences(lo, hi):
+    # Code points lo..hi as UTF-8: a list of byte range sequences such as
+    # [(0xE1, 0xEC), (0x80, 0xBF), (0x80, 0xBF)], each matching one run of
+    # the code points. Surrogates have no encoding and are left out.
+    sequences = []
+    stack = [(lo, hi)]
+    while stack:
+        lo, hi = stack.pop()
+        if lo <= 0xDFFF and hi >= 0xD800:
+            if hi > 0xDFFF:
+                stack.append((0xE000, hi))
+            if lo < 0xD800:
+                stack.append((lo, 0xD7FF))
+            continue
+        split = next((b for b in UTF8_BOUNDARIES if lo <= b < hi), None)
+        if split is not None:
+            stack.append((split + 1, hi))
+            stack.append((lo, split))
+            continue
+        if hi <= 0x7F:
+            sequences.append([(lo, hi)])
+            continue
+        # Split until every continuation byte spans its whole 80..BF range
+        # wherever the bytes before it vary
+        for bits in (6, 12, 18):
+            mask = (1 << bits) - 1
+            if lo & ~mask != hi & ~mask:
+                if lo & mask:
+                    stack.append(((lo | mask) + 1, hi))
+                    stack.append((lo, lo | mask))
+                    break
+                if hi & mask != mask:
+                    stack.append((hi & ~mask, hi))
+                    stack.append((lo, (hi & ~mask) - 1))
+                    break
+        else:
+            sequences.append(list(zip(chr(lo).encode("utf-8"), chr(hi).encode("utf-8"))))
+    return sequences
+
+
+def tail(text, pos):
+    # text[pos:] to iterate over. Scans usually stop long before the end,
+    # so a str is sliced a chunk at a time as the scan gets there instead
+    # of copied whole. Bytes-like input (bytes, bytearray, memoryview, mmap)
+    # goes through a memoryview, so nothing is copied and every item is an
+    # int, even for an mmap whose iteration yields bytes.
+    if type(text) is str:
+        if len(text) - pos <= TAIL_CHUNK:
+            return text[pos:]
+        return chain.from_iterable(text[k:k + TAIL_CHUNK] for k in range(pos, len(text), TAIL_CHUNK))
+    return memoryview(text)[pos:]
+
+
+def byte_label(ranges):
+    # Edge label for byte ranges, bytes being code points 0..255 as when
+    # bytes-like input is iterated
+    char_class = CharClass(ranges)
+    lo, hi = char_class.ranges[0]
+    return chr(lo) if len(char_class.ranges) == 1 and lo == hi else char_class
+
+
+def utf8_nfa(nfa, trace=None):
+    # Equivalent NFA over UTF-8 encoded bytes, to run on bytes, bytearray,
+    # memoryview or mmap input directly: every labelled edge becomes the
+    # byte sequences of its code points. States partway through a
+    # character are shared by all edges into the same target that end in
+    # the same bytes, so multi-byte classes cost few extra states. Offsets
+    # reported are byte offsets.
+    if trace is not None:
+        began = time.perf_counter()
+    result = NFA(nfa.start, nfa.accept, nfa.accepts)
+    next_state = max(nfa.states()) + 1
+    suffixes = {}
+    first_bytes = {}
+    for (from_state, symbol), to_states in nfa.transitions.items():
+        if symbol is None:
+            for to_state in to_states:
+                result.add_transition(from_state, None, to_state)
+            continue
+        sequences = [sequence for lo, hi in label_ranges(symbol) for sequence in utf8_sequences(lo, hi)]
+        for to_state in to_states:
+            for sequence in sequences:
+                target = to_state
+                for k in range(len(sequence) - 1, 0, -1):
+                    key = (to_state, tuple(sequence[k:]))
+                    state = suffixes.get(key)
+                    if state is None:
+                        state = suffixes[key] = next_state
+                        next_state += 1
+                        result.add_transition(state, byte_label([sequence[k]]), target)
+                    target = state
+                first_bytes.setdefault((from_state, target), []).append(sequence[0])
+    for (from_state, target), ranges in first_bytes.items():
+        result.add_transition(from_state, byte_label(ranges), target)
+    if trace is not None:
+        trace.step("utf8_nfa", "%d states -> %d states over bytes", len(nfa.states()), len(result.states()))
+        trace.add_time("utf8_nfa", time.perf_counter() - began)
+    return result
+
+
+def remove_epsilons(nfa, trace=None):
+    # Equivalent NFA without epsilon edges: state s gets every labelled edge
+    # leaving its epsilon-closure, and accepts if the closure does. Only
+    # states reachable from the start and able to reach an accept are kept,
+    # renumbered from 0 in the order they are found.
+    if trace is not None:
+        began = time.perf_counter()
+    labelled = {}
+    for (from_state, symbol), to_states in nfa.transitions.items():
+        if symbol is not None:
+            labelled.setdefault(from_state, []).append((symbol, to_states))
+
+    edges = {}
+    accepting = set()
+    order = [nfa.start]
+    seen = {nfa.start}
+    for state in order:
+        closure = nfa.epsilon_closure([state])
+        if not nfa.accepts.isdisjoint(closure):
+            accepting.add(state)
+        out = edges[state] = {}
+        for source in closure:
+            for symbol, to_states in labelled.get(source, ()):
+                out.setdefault(symbol, set()).update(to_states)
+                for target in to_states:
+                    if target not in seen:
+                        seen.add(target)
+                        order.append(target)
+
+    # Drop dead states: those no accepting state can be reached from
+    live = set(accepting)
+    sources = {}
+    for state, out in edges.items():
+        for to_states in out.values():
+            for target in to_states:
+                sources.setdefault(target, set()).add(state)
+    stack = list(live)
+    while stack:
+        for source in sources.get(stack.pop(), ()):
+            if source not in live:
+                live.add(source)
+                stack.append(source)
+
+    number = {}
+    for state in order:
+        if state in live or state == nfa.start:
+            number[state] = len(number)
+    accepts = {number[state] for state in accepting}
+    result = NFA(0, next(iter(accepts)) if len(accepts) == 1 else None, accepts)
+    for state, out in edges.items():
+        if state not in live:
+            continue
+        for symbol, to_states in out.items():
+            targets = {number[target] for target in to_states if target in live}
+            if targets:
+                result.transitions[(number[state], symbol)] = targets
+    if trace is not None:
+        trace.step("remove_epsilons", "%d states, %d edges -> %d states, %d edges",
+                   len(nfa.states()), sum(len(t) for t in nfa.transitions.values()),
+                   len(number), sum(len(t) for t in result.transitions.values()))
+        trace.count("epsilon_free_states", len(number))
+        trace.add_time("remove_epsilons", time.perf_counter() - began)
+    return result
 
 """
 def visualize_nfa(nfa, filename="nfa"):
@@ -417,34 +1272,125 @@ def visualize_nfa(nfa, filename="nfa"):
 
 """
 
-def visualize_nfa(nfa, filename="nfa"):
+def edge_label(symbols):
+    # One label for every symbol on the parallel edges between two states:
+    # the characters merged into a single class, with ε listed first
+    ranges = [r for symbol in symbols if symbol is not None for r in label_ranges(symbol)]
+    parts = ["ε"] if None in symbols else []
+    if ranges:
+        merged = CharClass(ranges)
+        parts.append(format_code_point(merged.ranges[0][0]) if merged.size() == 1 else str(merged))
+    return "|".join(parts)
+
+
+def aggregate_edges(nfa):
+    # (from_state, to_state) -> label, so a pair of states gets one edge
+    # however many symbols lead from one to the other
+    symbols = {}
+    for (from_state, symbol), to_states in nfa.transitions.items():
+        for to_state in to_states:
+            symbols.setdefault((from_state, to_state), set()).add(symbol)
+    return {pair: edge_label(pair_symbols) for pair, pair_symbols in symbols.items()}
+
+
+def collapse_chains(nfa, edges):
+    # Level of detail for big automata: states with a single edge in and a
+    # single edge out (start and accepts excepted) are dropped, and each
+    # chain through them becomes one edge labelled with the chain's labels.
+    # Returns (from_state, to_state, label, hidden states) tuples.
+    succ = {}
+    in_degree = {}
+    for (from_state, to_state), label in edges.items():
+        succ.setdefault(from_state, []).append((to_state, label))
+        in_degree[to_state] = in_degree.get(to_state, 0) + 1
+
+    def inner(state):
+        return (state != nfa.start and state not in nfa.accepts
+                and in_degree.get(state) == 1 and len(succ.get(state, ())) == 1)
+
+    collapsed = {}
+    for from_state, targets in succ.items():
+        if inner(from_state):
+            continue
+        for to_state, label in targets:
+            labels = [label]
+            # An inner state's only way in is the chain itself, so the walk
+            # always ends at a kept state
+            while inner(to_state):
+                (to_state, label), = succ[to_state]
+                labels.append(label)
+            text = "".join(label for label in labels if label != "ε") or "ε"
+            # Chains that start and end at the same states share one edge
+            pair = (from_state, to_state)
+            if pair in collapsed:
+                previous, hidden = collapsed[pair]
+                text, hidden_here = previous + "|" + text, hidden + len(labels) - 1
+            else:
+                hidden_here = len(labels) - 1
+            collapsed[pair] = (text, hidden_here)
+    return [(from_state, to_state, text if len(text) <= MAX_EDGE_LABEL else text[:MAX_EDGE_LABEL - 1] + "…", hidden)
+            for (from_state, to_state), (text, hidden) in collapsed.items()]
+
+
+def nfa_to_dot(nfa, detail="auto"):
+    # detail="full" draws every state, "collapsed" folds chains of
+    # pass-through states into single edges, and "auto" collapses NFAs with
+    # more than DETAIL_STATES states. Parallel edges are always merged.
+    if detail not in DETAILS:
+        raise ValueError(f"Unknown detail {detail!r}")
+    edges = aggregate_edges(nfa)
+    if detail == "collapsed" or (detail == "auto" and len(nfa.states()) > DETAIL_STATES):
+        edges = collapse_chains(nfa, edges)
+    else:
+        edges = [(from_state, to_state, label, 0) for (from_state, to_state), label in edges.items()]
+
     dot = Digraph(comment="NFA")
     dot.attr(rankdir="LR")
     dot.node("start", "", shape="point")
     dot.node(str(nfa.start), "S" + str(nfa.start), shape="circle")
-    dot.node(str(nfa.accept), "S" + str(nfa.accept), shape="doublecircle")
+    for accept in sorted(nfa.accepts):
+        dot.node(str(accept), "S" + str(accept), shape="doublecircle")
 
     dot.edge("start", str(nfa.start))
 
-    for (from_state, symbol), to_states in nfa.transitions.items():
-        for to_state in to_states:
-            # Escape special characters for DOT syntax
-            if symbol is None:
-                label = "ε"
-            else:
-                # Escape special characters for GraphViz
-                label = str(symbol)
-                # Replace problematic characters with their escaped versions
-                label = label.replace('\\', '\\\\').replace('"', '\\"')
-                label = label.replace('*', '\\*').replace('[', '\\[').replace(']', '\\]')
-
+    for from_state, to_state, label, hidden in edges:
+        # Escape special characters for GraphViz
+        label = label.replace('\\', '\\\\').replace('"', '\\"')
+        label = label.replace('*', '\\*').replace('[', '\\[').replace(']', '\\]')
+        if hidden:
+            # Drawn bold so folded chains stand out from plain transitions
+            dot.edge(str(from_state), str(to_state), label=label, style="bold")
+        else:
             dot.edge(str(from_state), str(to_state), label=label)
 
+    return dot
+
+
+def visualize_nfa(nfa, filename="nfa", detail="auto"):
     # Render the graph to a PNG file and return the path
-    output_path = dot.render(filename, view=False, format="png", cleanup=False)
+    output_path = nfa_to_dot(nfa, detail).render(filename, view=False, format="png", cleanup=False)
     return output_path
 
 
+def render_nfa(nfa, format="png", detail="auto"):
+    # The rendered graph as bytes, piped through dot with nothing written to
+    # disk. The DOT source spells out the whole structure, so its digest is
+    # the cache key: recompiling a pattern reuses the earlier render.
+    dot = nfa_to_dot(nfa, detail)
+    key = (format, hashlib.sha256(dot.source.encode("utf-8")).digest())
+    with _render_lock:
+        image = _render_cache.get(key)
+        if image is not None:
+            _render_cache.move_to_end(key)
+            return image
+    image = dot.pipe(format=format)
+    with _render_lock:
+        _render_cache[key] = image
+        while len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+    return image
+
+
 
 
 
@@ -471,11 +1417,8 @@ if __name__ == "__main__":
 
         print(f"Converting regex: {regex}")
 
-        expanded_regex = insert_concat(regex)
-        print(f"Expanded regex with concatenation operators: {expanded_regex}")
-
-        postfix = infix_to_postfix(regex)
-        print(f"Postfix notation: {postfix}")
+        tree = parse_regex(regex)
+        print(f"Syntax tree: {tree!r}")
 
         nfa = regex_to_nfa(regex)
 
@@ -0,0 +1,692 @@
+from array import array
+
+from NFA_CODE import NFA, ClassMap, tail
+from NFA_PREFILTER import Prefilter
+
+
+def reverse_nfa(nfa):
+    # Same language read right to left: flip every edge, swap start/accept.
+    # Several accepting states get a fresh start state fanning out to them.
+    if len(nfa.accepts) == 1:
+        start = next(iter(nfa.accepts))
+        reversed_nfa = NFA(start, nfa.start)
+    else:
+        start = max(nfa.states()) + 1
+        reversed_nfa = NFA(start, nfa.start)
+        for accept in nfa.accepts:
+            reversed_nfa.add_transition(start, None, accept)
+    for (from_state, symbol), to_states in nfa.transitions.items():
+        for to_state in to_states:
+            reversed_nfa.add_transition(to_state, symbol, from_state)
+    return reversed_nfa
+
+
+class CacheThrashing(Exception):
+    pass
+
+
+class DFAState:
+    __slots__ = ("states", "accepting", "next")
+
+    def __init__(self, states, accepting):
+        self.states = states
+        self.accepting = accepting
+        self.next = {}
+
+
+class LazyDFACache:
+    # Subset construction done on demand, one (state, char) pair at a time.
+    # DFA states are kept in a bounded cache; when it fills up the whole
+    # cache is flushed (like RE2), and if flushes come too close together
+    # the scan gives up with CacheThrashing so the caller can fall back to
+    # NFA simulation.
+    #
+    # In unanchored mode the start closure is part of every DFA state, so it
+    # is left implicit: DFA states only hold the NFA states reached on top
+    # of it. That keeps keys small when the start closure is large (e.g. the
+    # union automaton of a PatternSet).
+
+    def __init__(self, nfa, unanchored=False, max_states=10000):
+        if max_states < 2:
+            raise ValueError("max_states must be at least 2")
+        self.nfa = nfa
+        self.unanchored = unanchored
+        self.max_states = max_states
+        self.closures, self.moves, self.classes = nfa._simulation()
+        self.initial_states = self.closures[nfa.start]
+        self.initial_info = self.match_info(self.initial_states)
+        self._initial_moves = {}
+        self.cache = {}
+        self.flushes = 0
+        self.misses = 0
+        self._last_flush = None
+
+    def start_scan(self, pos, states=None):
+        # Thrashing is judged per scan, from where the scan started. states
+        # resumes a scan from that set of NFA states instead of the start.
+        self._last_flush = None
+        self._scan_start = pos
+        if states is None:
+            states = frozenset() if self.unanchored else self.initial_states
+        return self._state(states, pos)
+
+    def _state(self, states, pos):
+        state = self.cache.get(states)
+        if state is None:
+            if len(self.cache) >= self.max_states:
+                self._flush(pos)
+            info = self.match_info(states)
+            if self.unanchored:
+                info = info | self.initial_info
+            state = DFAState(states, info)
+            self.cache[states] = state
+        return state
+
+    def match_info(self, states):
+        # What an accepting DFA state reports; subclasses can return richer
+        # (but still truthy/falsy) values, e.g. the ids of matched patterns
+        return not self.nfa.accepts.isdisjoint(states)
+
+    def _flush(self, pos):
+        since = pos - (self._scan_start if self._last_flush is None else self._last_flush)
+        if self._last_flush is not None and abs(since) < 10 * self.max_states:
+            raise CacheThrashing()
+        for state in self.cache.values():
+            state.next.clear()
+        self.cache.clear()
+        self.flushes += 1
+        self._last_flush = pos
+
+    def step(self, state, char, pos):
+        # Slow path, only taken when state.next has no entry for char
+        self.misses += 1
+        class_id = self.classes[char]
+        reached = set()
+        for nfa_state in state.states:
+            targets = self.moves.get(nfa_state, {}).get(class_id)
+            if targets:
+                reached |= targets
+        if self.unanchored:
+            reached |= self._initial_step(class_id)
+            reached = frozenset(s for s in reached if s not in self.initial_states)
+        target = self._state(frozenset(reached), pos)
+        # A flush may have dropped the source state; re-register it so the
+        # new edge is not lost with it
+        if state.states not in self.cache:
+            self.cache[state.states] = state
+        state.next[char] = target
+        return target
+
+    def _initial_step(self, class_id):
+        # Where the implicit start closure goes on class_id, computed once
+        targets = self._initial_moves.get(class_id)
+        if targets is None:
+            reached = set()
+            for nfa_state in self.initial_states:
+                reached |= self.moves.get(nfa_state, {}).get(class_id, frozenset())
+            targets = self._initial_moves[class_id] = frozenset(reached)
+        return targets
+
+
+class LazyDFA:
+    def __init__(self, nfa, max_states=10000, prefilter=True):
+        self.nfa = nfa
+        self.max_states = max_states
+        self.anchored = LazyDFACache(nfa, max_states=max_states)
+        self.forward = LazyDFACache(nfa, unanchored=True, max_states=max_states)
+        backward = reverse_nfa(nfa)
+        self.backward = LazyDFACache(backward, unanchored=True, max_states=max_states)
+        self.backward_anchored = LazyDFACache(backward, max_states=max_states)
+        self.fallbacks = 0
+        self.prefilter = None
+        if prefilter:
+            self.prefilter = Prefilter.from_nfa(nfa)
+            if not self.prefilter.useful:
+                self.prefilter = None
+
+    @property
+    def stats(self):
+        caches = (self.anchored, self.forward, self.backward, self.backward_anchored)
+        return {
+            "states": sum(len(cache.cache) for cache in caches),
+            "misses": sum(cache.misses for cache in caches),
+            "flushes": sum(cache.flushes for cache in caches),
+            "fallbacks": self.fallbacks,
+        }
+
+    def matches(self, text):
+        prefilter = self.prefilter and self.prefilter.for_input(text)
+        if prefilter is not None and prefilter.rejects_whole(text):
+            return False
+        try:
+            return self._longest(text, 0, full=True) == len(text)
+        except CacheThrashing:
+            self.fallbacks += 1
+            return self.nfa.matches(text)
+
+    def search(self, text, pos=0):
+        try:
+            return self._search(text, pos)
+        except CacheThrashing:
+            self.fallbacks += 1
+            return self.nfa.search(text, pos)
+
+    def _longest(self, text, pos, full=False, states=None):
+        # End of the longest match anchored at pos, or None; with states,
+        # the last end reached by the threads in that set of NFA states
+        cache = self.anchored
+        state = cache.start_scan(pos, states)
+        last = pos if state.accepting else None
+        i = pos
+        for char in tail(text, pos):
+            i += 1
+            target = state.next.get(char)
+            if target is None:
+                target = cache.step(state, char, i)
+            state = target
+            if not state.states:
+                return None if full else last
+            if state.accepting:
+                last = i
+        return last
+
+    def _search(self, text, pos):
+        prefilter = self.prefilter and self.prefilter.for_input(text)
+        find = None
+        if prefilter is not None:
+            if prefilter.rejects(text, pos):
+                return None
+            find = prefilter.scanner(text)
+
+        # 1. forward unanchored scan: is there any match at all?
+        cache = self.forward
+        state = cache.start_scan(pos)
+        found = state.accepting
+        i = pos
+        if not found and find is None:
+            for char in tail(text, pos):
+                i += 1
+                target = state.next.get(char)
+                if target is None:
+                    target = cache.step(state, char, i)
+                state = target
+                if state.accepting:
+                    found = True
+                    break
+        elif not found:
+            length = len(text)
+            while i < length:
+                if not state.states:
+                    # Nothing under way: jump to where a match could begin
+                    i = find(i)
+                    if i < 0:
+                        return None
+                char = text[i]
+                i += 1
+                target = state.next.get(char)
+                if target is None:
+                    target = cache.step(state, char, i)
+                state = target
+                if state.accepting:
+                    found = True
+                    break
+        if not found:
+            return None
+
+        # 2. the threads under way go on, with no new ones started, until
+        # they die. The leftmost match began by the first end at i, so it
+        # ends by the last end they reach.
+        first = i
+        end = self._longest(text, i, states=state.states | cache.initial_states)
+
+        # 3. backward scan of the reversed pattern from there. The leftmost
+        # match ends between the first and the last end, so threads start
+        # only at those offsets; below them, the threads run until they
+        # die. The last accepting position seen is the leftmost start.
+        cache = self.backward
+        i = end
+        state = cache.start_scan(i)
+        start = i if state.accepting else None
+        while i > first:
+            i -= 1
+            char = text[i]
+            target = state.next.get(char)
+            if target is None:
+                target = cache.step(state, char, i)
+            state = target
+            if state.accepting:
+                start = i
+        cache = self.backward_anchored
+        state = cache.start_scan(i, state.states | self.backward.initial_states)
+        while state.states and i > pos:
+            i -= 1
+            char = text[i]
+            target = state.next.get(char)
+            if target is None:
+                target = cache.step(state, char, i)
+            state = target
+            if state.accepting:
+                start = i
+
+        # 4. forward anchored scan from there for the longest end
+        return (start, self._longest(text, start))
+
+
+class DFA:
+    # Fully built DFA. Columns are the class ids of the NFA's ClassMap,
+    # which together cover every character. State 0 is the dead state.
+
+    def __init__(self, classes, rows, accepting, start):
+        self.classes = classes
+        self.rows = rows
+        self.accepting = accepting
+        self.start = start
+
+    @classmethod
+    def from_nfa(cls, nfa, unanchored=False, until_match=False, max_states=None, stop=False):
+        # Classic subset construction over NFA._simulation()'s closures.
+        # until_match makes an unanchored DFA stop starting new threads once
+        # a state accepts: the threads under way then run until they die,
+        # which is what DenseSearch needs to bound the leftmost match.
+        # stop adds a last column, past the character classes, that does
+        # the same on demand: it keeps a state's threads (start closure
+        # included) but starts no new ones after it.
+        # Raises ValueError past max_states (before minimizing).
+        #
+        # States are (NFA states, seeding) pairs. As in LazyDFACache, the
+        # start closure of a seeding state is left implicit, and where it
+        # goes on each class is worked out once.
+        closures, moves, classes = nfa._simulation()
+        symbols = range(len(classes.ids))
+        accepts = nfa.accepts
+
+        initial = closures[nfa.start]
+        initial_accepts = not accepts.isdisjoint(initial)
+        initial_moves = []
+        for symbol in symbols:
+            reached = set()
+            for nfa_state in initial:
+                reached |= moves.get(nfa_state, {}).get(symbol, frozenset())
+            initial_moves.append(frozenset(s for s in reached if s not in initial))
+
+        index = {(frozenset(), False): 0}
+        keys = [(frozenset(), False)]
+        rows = [[0] * (len(symbols) + stop)]
+        todo = []
+
+        def state_for(key):
+            if key not in index:
+                if max_states is not None and len(keys) >= max_states:
+                    raise ValueError(f"DFA needs more than {max_states} states")
+                index[key] = len(keys)
+                keys.append(key)
+                rows.append(None)
+                todo.append(key)
+            return index[key]
+
+        if not unanchored or (until_match and initial_accepts):
+            start = state_for((initial, False))
+        else:
+            start = state_for((frozenset(), True))
+        while todo:
+            states, seeds = todo.pop()
+            reached = [set() for _ in symbols]
+            for nfa_state in states:
+                for symbol, targets in moves.get(nfa_state, {}).items():
+                    reached[symbol] |= targets
+            row = []
+            for symbol in symbols:
+                targets = reached[symbol]
+                if not seeds:
+                    target = (frozenset(targets), False)
+                elif until_match and not (accepts.isdisjoint(targets) and accepts.isdisjoint(initial_moves[symbol])):
+                    target = (initial.union(initial_moves[symbol], targets), False)
+                else:
+                    target = (initial_moves[symbol].union(s for s in targets if s not in initial), True)
+                row.append(state_for(target))
+            if stop:
+                row.append(state_for((initial.union(states), False)) if seeds else index[states, seeds])
+            rows[index[states, seeds]] = row
+
+        accepting = {i for i, (states, seeds) in enumerate(keys)
+                     if not accepts.isdisjoint(states) or (seeds and initial_accepts)}
+        return cls(classes, rows, accepting, start)
+
+    def minimize(self):
+        # Hopcroft's partition refinement
+        n = len(self.rows)
+        columns = range(len(self.rows[0]))
+        inverse = [[[] for _ in range(n)] for _ in columns]
+        for state, row in enumerate(self.rows):
+            for column in columns:
+                inverse[column][row[column]].append(state)
+
+        blocks = [block for block in (set(self.accepting), set(range(n)) - self.accepting) if block]
+        block_of = [0] * n
+        for b, block in enumerate(blocks):
+            for state in block:
+                block_of[state] = b
+
+        pending = {(b, column) for b in range(len(blocks)) for column in columns}
+        worklist = list(pending)
+        while worklist:
+            splitter = worklist.pop()
+            pending.discard(splitter)
+            b, column = splitter
+
+            touched = {}
+            for target in blocks[b]:
+                for source in inverse[column][target]:
+                    touched.setdefault(block_of[source], set()).add(source)
+
+            for y, inside in touched.items():
+                if len(inside) == len(blocks[y]):
+                    continue
+                outside = blocks[y] - inside
+                # Keep the bigger half under the old id and move the smaller
+                # one; queueing only the smaller half is what keeps Hopcroft
+                # at O(n log n), and is right whether or not (y, c) is pending
+                small, big = (inside, outside) if len(inside) <= len(outside) else (outside, inside)
+                blocks[y] = big
+                new = len(blocks)
+                blocks.append(small)
+                for state in small:
+                    block_of[state] = new
+                for c in columns:
+                    pending.add((new, c))
+                    worklist.append((new, c))
+
+        # Renumber: dead block first, then in discovery order from start
+        numbering = {block_of[0]: 0}
+        order = [block_of[0]]
+        queue = [block_of[self.start]]
+        while queue:
+            b = queue.pop()
+            if b in numbering:
+                continue
+            numbering[b] = len(order)
+            order.append(b)
+            row = self.rows[next(iter(blocks[b]))]
+            queue.extend(block_of[target] for target in reversed(row))
+
+        rows = []
+        for b in order:
+            row = self.rows[next(iter(blocks[b]))]
+            rows.append([numbering[block_of[target]] for target in row])
+        accepting = {numbering[block_of[s]] for s in self.accepting if block_of[s] in numbering}
+        return DFA(self.classes, rows, accepting, numbering[block_of[self.start]])
+
+    def to_dense(self):
+        # Byte-class compression: columns that are identical in every row
+        # share one class, and neighbouring code point ranges that end up
+        # in the same class are merged. Columns past the character classes
+        # (see from_nfa's stop) are kept, in order, after the classes.
+        signatures = {}
+        column_class = []
+        for column in range(len(self.classes.ids)):
+            signature = tuple(row[column] for row in self.rows)
+            column_class.append(signatures.setdefault(signature, len(signatures)))
+        bounds = []
+        ids = [column_class[self.classes.ids[0]]]
+        for bound, class_id in zip(self.classes.bounds, self.classes.ids[1:]):
+            if column_class[class_id] != ids[-1]:
+                bounds.append(bound)
+                ids.append(column_class[class_id])
+        classes = ClassMap(bounds, ids)
+
+        width = len(signatures) + len(self.rows[0]) - len(self.classes.ids)
+        representative = {}
+        for column, cls in enumerate(column_class):
+            representative.setdefault(cls, column)
+        for column in range(len(self.classes.ids), len(self.rows[0])):
+            representative[column - len(self.classes.ids) + len(signatures)] = column
+        table = array("l", [0]) * (len(self.rows) * width)
+        accepting = bytearray(len(table))
+        for state, row in enumerate(self.rows):
+            base = state * width
+            for cls, column in representative.items():
+                # Targets are stored premultiplied by the row width
+                table[base + cls] = row[column] * width
+            if state in self.accepting:
+                accepting[base] = 1
+        return DenseDFA(table, width, classes, self.start * width, accepting)
+
+
+class DenseDFA:
+    # Array-backed transition table: table[state + cls] is the next state,
+    # with state ids already multiplied by the number of classes. Row 0 is
+    # the dead state.
+
+    def __init__(self, table, width, classes, start, accepting):
+        self.table = table
+        self.width = width
+        self.classes = classes
+        self.start = start
+        self.accepting = accepting
+        self._byte_classes = None
+
+    @classmethod
+    def from_nfa(cls, nfa, unanchored=False, until_match=False, max_states=None, stop=False):
+        return DFA.from_nfa(nfa, unanchored, until_match, max_states, stop).minimize().to_dense()
+
+    @property
+    def num_states(self):
+        return len(self.table) // self.width
+
+    @property
+    def table_bytes(self):
+        return len(self.table) * self.table.itemsize
+
+    def as_numpy(self):
+        # (num_states, width) table of plain state numbers
+        import numpy as np
+        return np.asarray(self.table).reshape(-1, self.width) // self.width
+
+    @property
+    def byte_classes(self):
+        # Class offset of every byte value, for scanning bytes / mmaps where
+        # iteration yields ints (bytes are read as latin-1)
+        if self._byte_classes is None:
+            self._byte_classes = [self.classes[chr(b)] for b in range(256)]
+        return self._byte_classes
+
+    def scan(self, data, state=None, offset=0):
+        # Run over str or bytes-like data from state (default: start).
+        # Returns the offsets just after every character that leaves the DFA
+        # in an accepting state, counted from offset, and the final state.
+        # Over an unanchored DFA those are the ends of all matches.
+        table, accepting = self.table, self.accepting
+        state = self.start if state is None else state
+        ends = []
+        i = offset
+        if isinstance(data, str):
+            classes = self.classes
+            for char in data:
+                i += 1
+                state = table[state + classes[char]]
+                if accepting[state]:
+                    ends.append(i)
+        else:
+            byte_classes = self.byte_classes
+            for byte in data:
+                i += 1
+                state = table[state + byte_classes[byte]]
+                if accepting[state]:
+                    ends.append(i)
+        return ends, state
+
+    def match_ends(self, data):
+        ends, _ = self.scan(data)
+        return [0] + ends if self.accepting[self.start] else ends
+
+    def match_many(self, strings, longest=False):
+        # Match a batch of str (or bytes) strings at once. NumPy advances a
+        # vector holding one state per string, one character position at a
+        # time; strings are sorted longest first, so the ones still running
+        # at position j are always a prefix of the vector. Returns a bool
+        # array (does the whole string match), or with longest=True the end
+        # of the longest match at offset 0 of each string (-1 for none).
+        import numpy as np
+        strings = list(strings)
+        count = len(strings)
+        lengths = np.fromiter(map(len, strings), dtype=np.int64, count=count)
+        # 32-bit states and classes halve the memory traffic per step
+        index = np.int32 if len(self.table) < 1 << 31 else np.int64
+        byte_classes = np.asarray(self.byte_classes, dtype=index)
+        if strings and isinstance(strings[0], (bytes, bytearray)):
+            cls = byte_classes[np.frombuffer(b"".join(strings), dtype=np.uint8)]
+        else:
+            codes = np.frombuffer("".join(strings).encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+            if not len(codes) or codes.max() < 256:
+                # Latin-1 text: a table lookup instead of a binary search
+                cls = byte_classes[codes]
+            else:
+                bounds = np.asarray(self.classes.bounds, dtype=np.int64)
+                cls = np.asarray(self.classes.ids, dtype=index)[np.searchsorted(bounds, codes, side="right")]
+
+        table = np.asarray(self.table).astype(index)
+        accepting = np.frombuffer(self.accepting, dtype=np.bool_)
+        # Stable sort on the narrowest dtype that fits lets NumPy use radix sort
+        keys = lengths.max(initial=0) - lengths
+        if len(keys) and keys.max() < 1 << 16:
+            keys = keys.astype(np.uint16)
+        order = np.argsort(keys, kind="stable")
+        starts = (np.cumsum(lengths) - lengths)[order]
+        running = count - np.cumsum(np.bincount(lengths, minlength=1))
+
+        state = np.full(count, self.start, dtype=index)
+        last = np.full(count, 0 if accepting[self.start] else -1, dtype=np.int64)
+        positions = np.empty(count, dtype=np.int64)
+        for j in range(len(running) - 1):
+            n = running[j]
+            np.add(starts[:n], j, out=positions[:n])
+            step = cls.take(positions[:n])
+            step += state[:n]
+            table.take(step, out=state[:n])
+            if longest:
+                last[:n] = np.where(accepting[state[:n]], j + 1, last[:n])
+                if not state[:n].any():
+                    break
+
+        out = np.empty(count, dtype=np.int64 if longest else np.bool_)
+        out[order] = last if longest else accepting[state]
+        return out
+
+    def matches(self, text):
+        table, classes = self.table, self.classes
+        state = self.start
+        for char in text:
+            state = table[state + classes[char]]
+            if not state:
+                return False
+        return bool(self.accepting[state])
+
+    def longest(self, text, pos=0):
+        # End of the longest match anchored at pos, or None
+        table, classes, accepting = self.table, self.classes, self.accepting
+        state = self.start
+        last = pos if accepting[state] else None
+        i = pos
+        for char in tail(text, pos):
+            i += 1
+            state = table[state + classes[char]]
+            if not state:
+                break
+            if accepting[state]:
+                last = i
+        return last
+
+
+class DenseSearch:
+    # LazyDFA's search done over three dense DFAs, for patterns whose tables
+    # are built ahead of time (or mapped from a file, see NFA_BINARY):
+    #   forward   unanchored, until_match: new threads start at each offset
+    #             until one accepts, then the ones under way run out
+    #   backward  unanchored DFA of the reversed pattern, with a stop
+    #             column (its last) that ends the restarts
+    #   anchored  the pattern itself, for the longest end
+
+    def __init__(self, forward, backward, anchored, prefilter=None):
+        self.forward = forward
+        self.backward = backward
+        self.anchored = anchored
+        self.prefilter = prefilter
+
+    @classmethod
+    def from_nfa(cls, nfa, anchored=None, prefilter=True, max_states=None):
+        forward = DenseDFA.from_nfa(nfa, unanchored=True, until_match=True, max_states=max_states)
+        backward = DenseDFA.from_nfa(reverse_nfa(nfa), unanchored=True, max_states=max_states, stop=True)
+        if anchored is None:
+            anchored = DenseDFA.from_nfa(nfa, max_states=max_states)
+        if prefilter:
+            prefilter = Prefilter.from_nfa(nfa)
+        return cls(forward, backward, anchored, prefilter if prefilter and prefilter.useful else None)
+
+    def search(self, text, pos=0):
+        prefilter = self.prefilter and self.prefilter.for_input(text)
+        find = None
+        if prefilter is not None:
+            if prefilter.rejects(text, pos):
+                return None
+            find = prefilter.scanner(text)
+
+        # 1. forward until the DFA dies: the first accepting offset is the
+        # first match end, the last one the last end reached by threads
+        # started by then
+        dfa = self.forward
+        table, classes, accepting = dfa.table, dfa.classes, dfa.accepting
+        state = start = dfa.start
+        first = end = pos if accepting[state] else None
+        i = pos
+        if find is None:
+            for char in tail(text, pos):
+                i += 1
+                state = table[state + classes[char]]
+                if not state:
+                    break
+                if accepting[state]:
+                    end = i
+                    if first is None:
+                        first = i
+        else:
+            length = len(text)
+            while i < length:
+                if state == start:
+                    # Nothing under way: jump to where a match could begin
+                    i = find(i)
+                    if i < 0:
+                        break
+                state = table[state + classes[text[i]]]
+                i += 1
+                if not state:
+                    break
+                if accepting[state]:
+                    end = i
+                    if first is None:
+                        first = i
+        if end is None:
+            return None
+
+        # 2. backward scan of the reversed pattern from there. The leftmost
+        # match ends between the first and the last end, so threads start
+        # only at those offsets; below them, the threads run until they
+        # die. The last accepting offset seen is the leftmost start.
+        dfa = self.backward
+        table, classes, accepting = dfa.table, dfa.classes, dfa.accepting
+        state = dfa.start
+        found = end if accepting[state] else None
+        i = end
+        while i > first:
+            i -= 1
+            state = table[state + classes[text[i]]]
+            if accepting[state]:
+                found = i
+        state = table[state + dfa.width - 1]
+        while state and i > pos:
+            i -= 1
+            state = table[state + classes[text[i]]]
+            if accepting[state]:
+                found = i
+
+        # 3. forward anchored scan from there for the longest end
+        return (found, self.anchored.longest(text, found))
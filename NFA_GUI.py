@@ -6,11 +6,64 @@ from PySide6.QtWidgets import (
     QHBoxLayout, QLabel, QLineEdit, QPushButton, 
     QScrollArea, QFileDialog
 )
-from PySide6.QtGui import QPixmap, QFont, QMovie
-from PySide6.QtCore import Qt, QTimer
+from PySide6.QtGui import QPixmap, QImage, QFont, QMovie, QPainter, QKeySequence, QShortcut
+from PySide6.QtCore import Qt, QTimer, QObject, QRunnable, QThreadPool, Signal, QEvent, QByteArray
+from PySide6.QtSvg import QSvgRenderer
 from graphviz import Digraph
 
-from NFA_CODE import regex_to_nfa, visualize_nfa
+from NFA_CODE import render_nfa
+from NFA_CACHE import compile as compile_regex
+
+# Quiet time after a keystroke before the pattern is converted
+TYPING_DELAY_MS = 150
+# Jobs that finish sooner than this never show the loading GIF
+SPINNER_DELAY_MS = 200
+# Zoom range and step for the rendered graph
+MIN_ZOOM = 0.1
+MAX_ZOOM = 8.0
+ZOOM_STEP = 1.25
+# Largest raster drawn for display or saving: 64MB at 4 bytes per pixel
+MAX_IMAGE_PIXELS = 1 << 24
+
+
+class RenderSignals(QObject):
+    # generation, SVG bytes (None on failure), error message
+    finished = Signal(int, object, str)
+
+
+class RenderJob(QRunnable):
+    # Compiles a regex and lays its NFA out as SVG off the GUI thread. The
+    # GUI rasterizes the SVG itself, so zooming never runs dot again.
+    # cancel() is checked between stages, so a superseded job skips
+    # whatever work it has not started yet.
+    def __init__(self, regex, generation):
+        super().__init__()
+        self.regex = regex
+        self.generation = generation
+        self.signals = RenderSignals()
+        self.cancelled = False
+        # The GUI keeps the job alive until it reports back
+        self.setAutoDelete(False)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        svg = None
+        error = ""
+        try:
+            nfa = compile_regex(self.regex).nfa
+        except Exception as e:
+            print(f"Error during NFA conversion: {str(e)}")
+            error = "Failed to convert regex to NFA. Check your regex syntax."
+        if not error and not self.cancelled:
+            try:
+                svg = render_nfa(nfa, "svg")
+            except Exception as e:
+                print(f"Error during NFA rendering: {str(e)}")
+                error = "Visualization failed. Check if Graphviz is installed."
+        self.signals.finished.emit(self.generation, svg, error)
+
 
 class NFAConverterGUI(QMainWindow):
     def __init__(self):
@@ -39,6 +92,8 @@ class NFAConverterGUI(QMainWindow):
         button_layout = QVBoxLayout()
         convert_button = QPushButton("Convert to NFA")
         convert_button.clicked.connect(self.convert_regex)
+        self.regex_input.textChanged.connect(self.schedule_convert)
+        self.regex_input.returnPressed.connect(self.convert_regex)
         convert_button.setFixedWidth(150)
         clear_button = QPushButton("Clear")
         clear_button.clicked.connect(self.clear_all)
@@ -64,6 +119,8 @@ class NFAConverterGUI(QMainWindow):
         self.image_label = QLabel()
         self.image_label.setAlignment(Qt.AlignCenter)
         self.image_scroll.setWidget(self.image_label)
+        # Ctrl + mouse wheel zooms instead of scrolling
+        self.image_scroll.viewport().installEventFilter(self)
         output_layout.addWidget(self.image_scroll)
         
         # Add a label for the "NFA" text
@@ -87,10 +144,22 @@ class NFAConverterGUI(QMainWindow):
         self.timer.timeout.connect(self.move_waiting_text)
         self.timer.start(16) #60 Frames  
         
-        # Timer for the 5-second loading delay
-        self.loading_timer = QTimer(self)
-        self.loading_timer.setSingleShot(True)  # Run only once
-        self.loading_timer.timeout.connect(self.show_nfa_result)
+        # Timer that converts once typing pauses
+        self.typing_timer = QTimer(self)
+        self.typing_timer.setSingleShot(True)
+        self.typing_timer.timeout.connect(self.convert_typed)
+
+        # Timer that shows the loading GIF if a job is still running
+        self.spinner_timer = QTimer(self)
+        self.spinner_timer.setSingleShot(True)
+        self.spinner_timer.timeout.connect(lambda: self.show_gif("loading.gif"))
+
+        # Compile and render run here; one thread, so a superseded job waiting
+        # in the queue is dropped instead of competing for the CPU
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.jobs = {}
+        self.generation = 0
         
         # Variables for text movement
         self.text_x = 0
@@ -105,9 +174,14 @@ class NFAConverterGUI(QMainWindow):
         self.setCentralWidget(main_widget)
     
         # Initialize variables
-        self.current_nfa_image_path = None
+        self.current_nfa_svg = None
+        self.svg_renderer = None
+        self.zoom = 1.0
         self.movie = None 
-        self.nfa_result = None 
+
+        QShortcut(QKeySequence.ZoomIn, self, self.zoom_in)
+        QShortcut(QKeySequence.ZoomOut, self, self.zoom_out)
+        QShortcut(QKeySequence("Ctrl+0"), self, self.zoom_reset)
     
     def move_waiting_text(self):
         # Show the waiting label if no image, GIF, or error message is displayed
@@ -183,7 +257,11 @@ class NFAConverterGUI(QMainWindow):
             self.show_error_message(f"Failed to load GIF: {gif_path}")
             return False
     
-    def show_nfa_result(self):
+    def show_nfa_result(self, generation, svg, error):
+        self.jobs.pop(generation, None)
+        if generation != self.generation:
+            return  # superseded by a newer keystroke
+        self.spinner_timer.stop()
         # Stop the loading GIF
         if self.movie:
             self.movie.stop()
@@ -191,23 +269,98 @@ class NFAConverterGUI(QMainWindow):
         self.image_label.clear()
         # Ensure the error label is hidden before showing the NFA result
         self.error_label.hide()
-        
-        # Display the NFA result (or error) that was computed during the loading period
-        if self.nfa_result is None:
-            self.show_error_message("Failed to convert regex to NFA. Check your regex syntax.")
-        elif self.current_nfa_image_path is None:
-            self.show_error_message("Visualization failed: No image path returned. Check if Graphviz is installed and if the output directory is writable.")
-        elif os.path.exists(self.current_nfa_image_path):
-            pixmap = QPixmap(self.current_nfa_image_path)
-            if pixmap.isNull():
-                self.show_error_message("Failed to load the generated image. The file might be corrupted.")
+
+        self.current_nfa_svg = None
+        self.svg_renderer = None
+        if svg is None:
+            self.show_error_message(error)
+            return
+        renderer = QSvgRenderer(QByteArray(svg))
+        if not renderer.isValid():
+            self.show_error_message("Failed to load the generated image. The file might be corrupted.")
+            return
+        self.current_nfa_svg = svg
+        self.svg_renderer = renderer
+        self.show_svg()
+
+    def max_zoom(self):
+        # Zoom at which the graph's raster reaches MAX_IMAGE_PIXELS
+        size = self.svg_renderer.defaultSize()
+        return (MAX_IMAGE_PIXELS / max(size.width() * size.height(), 1)) ** 0.5
+
+    def render_image(self):
+        # Rasterize the whole SVG at the current zoom, scaled down if the
+        # image would exceed MAX_IMAGE_PIXELS
+        zoom = min(self.zoom, self.max_zoom())
+        image = QImage(self.svg_renderer.defaultSize() * zoom, QImage.Format_ARGB32)
+        image.fill(Qt.white)
+        painter = QPainter(image)
+        self.svg_renderer.render(painter)
+        painter.end()
+        return image
+
+    def show_svg(self):
+        self.image_label.setPixmap(QPixmap.fromImage(self.render_image()))
+        self.image_label.adjustSize()
+
+    def set_zoom(self, zoom):
+        self.zoom = max(MIN_ZOOM, min(MAX_ZOOM, zoom))
+        if self.svg_renderer is not None:
+            # Zooming in past the raster cap would change nothing on screen
+            self.zoom = min(self.zoom, max(MIN_ZOOM, self.max_zoom()))
+        if self.svg_renderer is not None and self.movie is None:
+            self.show_svg()
+
+    def zoom_in(self):
+        self.set_zoom(self.zoom * ZOOM_STEP)
+
+    def zoom_out(self):
+        self.set_zoom(self.zoom / ZOOM_STEP)
+
+    def zoom_reset(self):
+        self.set_zoom(1.0)
+
+    def eventFilter(self, watched, event):
+        if event.type() == QEvent.Wheel and event.modifiers() & Qt.ControlModifier:
+            if event.angleDelta().y() > 0:
+                self.zoom_in()
             else:
-                self.image_label.setPixmap(pixmap)
-                self.image_label.adjustSize()
-        else:
-            self.show_error_message(f"Image file not found at: {self.current_nfa_image_path}")
-    
+                self.zoom_out()
+            return True
+        return super().eventFilter(watched, event)
+
+    def cancel_job(self):
+        # Invalidate whatever is queued or running; its result is ignored
+        self.generation += 1
+        for generation, job in list(self.jobs.items()):
+            job.cancel()
+            if self.pool.tryTake(job):
+                del self.jobs[generation]  # never started
+        self.spinner_timer.stop()
+
+    def start_job(self, regex):
+        self.cancel_job()
+        job = self.jobs[self.generation] = RenderJob(regex, self.generation)
+        job.signals.finished.connect(self.show_nfa_result)
+        self.pool.start(job)
+        if self.movie is None:
+            self.spinner_timer.start(SPINNER_DELAY_MS)
+
+    def schedule_convert(self):
+        self.typing_timer.start(TYPING_DELAY_MS)
+
+    def convert_typed(self):
+        # Typing converts quietly: an emptied field just cancels
+        if self.regex_input.text().strip():
+            self.convert_regex()
+            return
+        self.cancel_job()
+        if self.movie:
+            self.movie.stop()
+            self.movie = None
+
     def convert_regex(self):
+        self.typing_timer.stop()
         regex = self.regex_input.text().strip()
         if not regex:
             self.waiting_label.setText("String is empty")
@@ -216,33 +369,10 @@ class NFAConverterGUI(QMainWindow):
             QTimer.singleShot(2000, self.reset_waiting_label)  # Reset after 2 seconds
             return 
 
-        # Clear any GIF or error message if present
-        if self.movie:
-            self.movie.stop()
-            self.movie = None
+        # Clear any error message; the last image stays up until the new one
+        # is ready, or the loading GIF replaces it if the job runs long
         self.error_label.hide()
-        self.image_label.clear()
-        
-        # Show the loading GIF and start the timer
-        if self.show_gif("loading.gif"):
-            self.loading_timer.start(1500)  # 1500ms = 1.5 seconds
-        else:
-            self.loading_timer.start(1500)  
-        
-        # Compute the NFA result in the background
-        try:
-            # Convert regex to NFA
-            self.nfa_result = regex_to_nfa(regex)
-            if self.nfa_result is None:
-                return  
-            
-            # Visualize NFA
-            self.current_nfa_image_path = visualize_nfa(self.nfa_result, "nfa_output")
-            
-        except Exception as e:
-            self.nfa_result = None  # Indicate an error
-            self.current_nfa_image_path = None
-            print(f"Error during NFA conversion: {str(e)}") 
+        self.start_job(regex)
     
     def reset_waiting_label(self):
         self.waiting_label.setText("NFA")
@@ -251,13 +381,19 @@ class NFAConverterGUI(QMainWindow):
         self.waiting_label.setFont(font)
 
     def save_image(self):
-        if self.current_nfa_image_path:
+        if self.current_nfa_svg is not None:
             file_path, _ = QFileDialog.getSaveFileName(
-                self, "Save NFA Image", "", "PNG Files (*.png);;All Files (*)"
+                self, "Save NFA Image", "", "PNG Files (*.png);;SVG Files (*.svg);;All Files (*)"
             )
             if file_path:
-                pixmap = QPixmap(self.current_nfa_image_path)
-                pixmap.save(file_path)
+                if file_path.lower().endswith(".svg"):
+                    with open(file_path, "wb") as f:
+                        f.write(self.current_nfa_svg)
+                # PNGs are drawn from the SVG, not taken from the label, which
+                # may be showing the loading GIF or an earlier save's message
+                elif not self.render_image().save(file_path):
+                    self.show_error_message(f"Could not save the image to {file_path}")
+                    return
                 # Show success message in the image area
                 self.image_label.clear()
                 self.show_error_message(f"Image saved to {file_path}")
@@ -266,22 +402,27 @@ class NFAConverterGUI(QMainWindow):
        
     def clear_all(self):
         self.regex_input.clear()
+        self.typing_timer.stop()
+        self.cancel_job()
         self.image_label.clear()
-        self.current_nfa_image_path = None
-        self.nfa_result = None
+        self.current_nfa_svg = None
+        self.svg_renderer = None
         self.error_label.hide()
         # Stop any GIF if present
         if self.movie:
             self.movie.stop()
             self.movie = None
-        # Stop the loading timer if it's running
-        if self.loading_timer.isActive():
-            self.loading_timer.stop()
         # Reset waiting label
         self.waiting_label.setText("NFA")
         self.waiting_label.setStyleSheet("color: white; background: transparent;") 	
         font = QFont('Arial', 16)
         self.waiting_label.setFont(font)
+
+    def closeEvent(self, event):
+        # Let a running render finish before its signals object goes away
+        self.cancel_job()
+        self.pool.waitForDone()
+        super().closeEvent(event)
     
 def main():
     app = QApplication(sys.argv)
@@ -0,0 +1,114 @@
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Each worker process gets the DFA once, through the pool initializer
+_worker_dfa = None
+
+
+def _init_worker(dfa):
+    global _worker_dfa
+    _worker_dfa = dfa
+
+
+def speculate(dfa, data, offset=0):
+    # Scan one chunk without knowing the state it starts in: every DFA state
+    # is tried as the origin, in lockstep, and runs that land on the same
+    # state are merged. DFAs for unanchored searches nearly always collapse
+    # into a single run within a few characters. From then on the rest of
+    # the chunk is scanned once, as a normal single-state scan. The dead
+    # state is left out: it never leaves itself and never matches.
+    #
+    # Returns (mapping, prefix, ends):
+    #   mapping  origin state -> state at the end of the chunk
+    #   prefix   (end, origins) for matches found before the runs merged
+    #   ends     match ends after the merge, shared by every origin
+    table, accepting = dfa.table, dfa.accepting
+    lookup = dfa.classes if isinstance(data, str) else dfa.byte_classes
+    runs = {state: [state] for state in range(dfa.width, len(table), dfa.width)}
+    prefix = []
+    i = offset
+    for item in data:
+        if len(runs) <= 1:
+            break
+        i += 1
+        cls = lookup[item]
+        reached = {}
+        for state, origins in runs.items():
+            target = table[state + cls]
+            if target in reached:
+                reached[target] += origins
+            else:
+                reached[target] = origins
+        runs = reached
+        for state, origins in runs.items():
+            if accepting[state]:
+                prefix.append((i, tuple(origins)))
+
+    if len(runs) != 1:
+        mapping = {origin: state for state, origins in runs.items() for origin in origins}
+        return mapping, prefix, []
+    (state, origins), = runs.items()
+    ends, state = dfa.scan(data[i - offset:], state, i)
+    return dict.fromkeys(origins, state), prefix, ends
+
+
+def stitch(dfa, results):
+    # Combine per-chunk speculate() results, in input order, into exactly
+    # the match ends a sequential dfa.match_ends() would report
+    state = dfa.start
+    ends = [0] if dfa.accepting[state] else []
+    for mapping, prefix, shared in results:
+        if not state:
+            continue
+        ends.extend(end for end, origins in prefix if state in origins)
+        ends.extend(shared)
+        state = mapping[state]
+    return ends
+
+
+def _speculate_slice(data, offset):
+    return speculate(_worker_dfa, data, offset)
+
+
+def _speculate_file(path, start, stop):
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                return speculate(_worker_dfa, view[start:stop], start)
+            finally:
+                view.release()
+
+
+def _bounds(size, workers, chunk_size):
+    if chunk_size is None:
+        # A few chunks per worker keeps them busy when chunks run unevenly
+        chunk_size = max(1 << 16, -(-size // (workers * 4)))
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+def scan_parallel(dfa, data, workers=None, chunk_size=None):
+    # Match ends of dfa over str or bytes data, scanning chunks in a process
+    # pool. Equal to dfa.match_ends(data); build dfa with unanchored=True to
+    # find matches anywhere rather than only at offset 0.
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        return dfa.match_ends(data)
+    bounds = _bounds(len(data), workers, chunk_size)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(dfa,)) as pool:
+        futures = [pool.submit(_speculate_slice, data[start:stop], start) for start, stop in bounds]
+        return stitch(dfa, (future.result() for future in futures))
+
+
+def scan_file_parallel(dfa, path, workers=None, chunk_size=None):
+    # Same over a file's bytes. Workers map the file themselves, so chunks
+    # are never copied between processes.
+    workers = workers or os.cpu_count() or 1
+    size = os.path.getsize(path)
+    if size == 0:
+        return dfa.match_ends(b"")
+    bounds = _bounds(size, workers, chunk_size)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(dfa,)) as pool:
+        futures = [pool.submit(_speculate_file, path, start, stop) for start, stop in bounds]
+        return stitch(dfa, (future.result() for future in futures))
@@ -0,0 +1,172 @@
+import threading
+
+from NFA_CODE import ClassMap, Group, ast_to_arena, gc_paused, parse_regex, postorder
+
+
+class ThreadList:
+    # Sparse set of threads keyed by NFA state, allocated once per VM and
+    # searching thread and reused for every step: dense holds the states
+    # in priority order, marks[state] == generation says a state is in the
+    # list (so resetting is one increment), and caps[state] is the
+    # thread's capture slots, overwritten in place.
+
+    def __init__(self, size, slot_count):
+        self.dense = [0] * size
+        self.marks = [0] * size
+        self.caps = [[-1] * slot_count for _ in range(size)]
+        self.size = 0
+        self.generation = 1
+
+    def reset(self):
+        self.size = 0
+        self.generation += 1
+
+
+class Workspace:
+    # Everything a search writes to: two thread lists (current and next
+    # step), the capture slots being built, the best match so far and the
+    # epsilon-walk stack. Each thread searching with a VM gets its own.
+
+    def __init__(self, size, slot_count):
+        self.lists = (ThreadList(size, slot_count), ThreadList(size, slot_count))
+        self.scratch = [-1] * slot_count
+        self.best = [-1] * slot_count
+        self.stack = []
+
+
+class PikeVM:
+    # Capture groups without backtracking: the Thompson NFA of the pattern,
+    # with a save state at each end of every group, simulated one thread
+    # per NFA state as in Pike's VM. A thread carries the capture slots of
+    # the path that reached its state; where two paths meet, the one from
+    # the preferred branch (left alternative, another round of a repeat)
+    # keeps the state. O(len(text) * states) time, no recursion.
+    #
+    # The overall match is leftmost-longest like the rest of the package,
+    # so search() spans agree with NFA.search(); the groups are those of the
+    # most preferred path among the ones producing that span.
+    #
+    # A VM can be shared between threads: the compiled program is read-only
+    # and the buffers a search writes to are per thread.
+
+    def __init__(self, regex):
+        self.regex = regex
+        with gc_paused():
+            tree = parse_regex(regex, captures=True)
+            self.groups = max((node.index for node in postorder(tree) if isinstance(node, Group)), default=0)
+            arena, self.start, self.accept = ast_to_arena(tree)
+        self.eps1 = arena.eps1.tolist()
+        self.eps2 = arena.eps2.tolist()
+        self.slots = arena.slots.tolist()
+        # Slots 0 and 1 hold the span of the whole match
+        self.slot_count = 2 * (self.groups + 1)
+        labels = arena.labels
+        self.classes = ClassMap.for_labels({label for label in labels if label is not None})
+        self.moves = [None] * len(labels)
+        for state, label in enumerate(labels):
+            if label is not None:
+                target = arena.targets[state]
+                self.moves[state] = {class_id: target for class_id in self.classes.covering(label)}
+        self._blank = [-1] * self.slot_count
+        self._local = threading.local()
+
+    def __repr__(self):
+        return f"PikeVM({self.regex!r})"
+
+    def _workspace(self):
+        workspace = getattr(self._local, "workspace", None)
+        if workspace is None:
+            workspace = self._local.workspace = Workspace(len(self.moves), self.slot_count)
+        return workspace
+
+    def _add(self, threads, state, pos, scratch, stack):
+        # Follow epsilon edges from state in priority order, applying save
+        # states to scratch on the way, and add a thread at every labelled
+        # or accepting state reached. Undoing a save is pushed as -1 - slot
+        # on top of the old value, so the stack holds nothing but ints.
+        eps1, eps2, slots, marks = self.eps1, self.eps2, self.slots, threads.marks
+        generation = threads.generation
+        stack.append(state)
+        while stack:
+            state = stack.pop()
+            if state < 0:
+                scratch[-1 - state] = stack.pop()
+                continue
+            if marks[state] == generation:
+                continue
+            marks[state] = generation
+            slot = slots[state]
+            if slot >= 0:
+                stack.append(scratch[slot])
+                stack.append(-1 - slot)
+                scratch[slot] = pos
+            if eps1[state] >= 0:
+                if eps2[state] >= 0:
+                    stack.append(eps2[state])
+                stack.append(eps1[state])
+            else:
+                threads.dense[threads.size] = state
+                threads.size += 1
+                threads.caps[state][:] = scratch
+
+    def _run(self, text, pos, anchored):
+        # Slots of the leftmost-longest match at or after pos (starting
+        # exactly at pos if anchored), or None
+        workspace = self._workspace()
+        current, following = workspace.lists
+        scratch, best, stack, blank = workspace.scratch, workspace.best, workspace.stack, self._blank
+        moves, classes, accept = self.moves, self.classes, self.accept
+        best[0] = -1
+        current.reset()
+        length = len(text)
+        for i in range(pos, length + 1):
+            if best[0] < 0 and (i == pos or not anchored):
+                # A new thread starting here, behind every older one
+                scratch[:] = blank
+                scratch[0] = i
+                self._add(current, self.start, i, scratch, stack)
+            if current.size == 0:
+                if best[0] >= 0 or anchored:
+                    break
+                continue
+            class_id = classes[text[i]] if i < length else None
+            following.reset()
+            dense, caps = current.dense, current.caps
+            for k in range(current.size):
+                state = dense[k]
+                thread = caps[state]
+                if best[0] >= 0 and thread[0] > best[0]:
+                    continue  # Starts right of a match already found
+                if state == accept:
+                    if best[0] < 0 or thread[0] < best[0] or i > best[1]:
+                        best[:] = thread
+                        best[1] = i
+                    continue
+                if class_id is not None:
+                    target = moves[state].get(class_id)
+                    if target is not None:
+                        scratch[:] = thread
+                        self._add(following, target, i + 1, scratch, stack)
+            current, following = following, current
+        workspace.lists = (current, following)
+        return best if best[0] >= 0 else None
+
+    def _spans(self, best):
+        return tuple((best[2 * g], best[2 * g + 1]) if best[2 * g] >= 0 and best[2 * g + 1] >= 0 else None
+                     for g in range(self.groups + 1))
+
+    def search(self, text, pos=0):
+        # Leftmost-longest match at or after pos as a tuple of spans: the
+        # whole match first, then each group's (start, end), or None for a
+        # group that took no part in the match
+        best = self._run(text, pos, anchored=False)
+        if best is None:
+            return None
+        return self._spans(best)
+
+    def fullmatch(self, text):
+        # Spans as for search() if the whole of text matches, else None
+        best = self._run(text, 0, anchored=True)
+        if best is None or best[1] != len(text):
+            return None
+        return self._spans(best)
@@ -0,0 +1,184 @@
+from NFA_CODE import CharClass, label_ranges, remove_epsilons
+
+# Bigger automata are not analysed: finding dominators is quadratic
+MAX_ANALYSED_STATES = 2000
+# First-character sets up to this size are scanned for with str.find
+MAX_FIRST_CHARS = 3
+
+
+class Prefilter:
+    # Facts every match of a pattern obeys, found by looking at its NFA once
+    # at compile time, so searches can skip text with str.find (memchr)
+    # instead of stepping an automaton through it:
+    #   prefix       literal every match starts with ("" if none)
+    #   first_chars  the few characters a match can start with, or None
+    #   required     literals every match contains somewhere
+    #   never        no match can occur at all
+
+    def __init__(self, prefix="", first_chars=None, required=(), never=False):
+        self.prefix = prefix
+        self.first_chars = first_chars
+        self.required = tuple(required)
+        self.never = never
+        self._encoded = None
+
+    def __repr__(self):
+        return f"Prefilter(prefix={self.prefix!r}, first_chars={self.first_chars!r}, required={self.required!r})"
+
+    @property
+    def useful(self):
+        return bool(self.prefix or self.first_chars or self.required or self.never)
+
+    @classmethod
+    def from_nfa(cls, nfa):
+        # Works on the epsilon-free form. A state d dominates the accepts if
+        # every path from the start to an accept passes through d; the
+        # dominators are ordered along every such path. Where all edges into
+        # a dominator carry one character, and all edges out of the previous
+        # dominator lead straight to it, the characters chain into a literal.
+        nfa = remove_epsilons(nfa)
+        states = nfa.states()
+        if nfa.start in nfa.accepts or len(states) > MAX_ANALYSED_STATES:
+            return cls()
+        succ = {}
+        pred = {}
+        for (from_state, symbol), to_states in nfa.transitions.items():
+            for to_state in to_states:
+                succ.setdefault(from_state, []).append((symbol, to_state))
+                pred.setdefault(to_state, []).append((symbol, from_state))
+
+        first = CharClass([r for symbol, _ in succ.get(nfa.start, ()) for r in label_ranges(symbol)])
+        first_chars = None
+        if 0 < first.size() <= MAX_FIRST_CHARS:
+            first_chars = "".join(chr(c) for lo, hi in first.ranges for c in range(lo, hi + 1))
+
+        distance = reachable(nfa.start, succ)
+        dominators = [nfa.start] + sorted(
+            (d for d in distance if d != nfa.start and not reaches_accept(nfa, succ, avoiding=d)),
+            key=distance.get)
+
+        literals = []
+        run = ""
+        anchored = False
+        prefix = ""
+        for previous, dominator in zip(dominators, dominators[1:]):
+            char = single_char(pred[dominator])
+            adjacent = all(target == dominator for _, target in succ[previous])
+            if char is not None and adjacent and (run or previous == nfa.start):
+                if not run:
+                    anchored = previous == nfa.start
+                run += char
+                continue
+            if run:
+                literals.append(run)
+                if anchored:
+                    prefix = run
+            run, anchored = (char, False) if char is not None else ("", False)
+        if run:
+            literals.append(run)
+            if anchored:
+                prefix = run
+        literals.sort(key=len, reverse=True)
+        return cls(prefix, first_chars, literals)
+
+    def for_input(self, text):
+        # The prefilter to run over text: self for str, the same facts as
+        # bytes for bytes-like input, or None if text can't be searched
+        # (a memoryview has no find)
+        if type(text) is str:
+            return self
+        if not hasattr(text, "find"):
+            return None
+        if self._encoded is None:
+            self._encoded = self.encoded()
+        return self._encoded
+
+    def encoded(self):
+        # Bytes-like input is read one byte per character (as latin-1,
+        # which covers byte automata from utf8_nfa too). A literal with a
+        # character above 255 can't occur in it, so nothing can match.
+        try:
+            required = [literal.encode("latin-1") for literal in self.required]
+            prefix = self.prefix.encode("latin-1")
+        except UnicodeEncodeError:
+            return Prefilter(never=True)
+        first_chars = None
+        if self.first_chars is not None:
+            first_chars = tuple(char.encode("latin-1") for char in self.first_chars if ord(char) < 256)
+            if not first_chars:
+                return Prefilter(never=True)
+        return Prefilter(prefix, first_chars, required, self.never)
+
+    def rejects_whole(self, text):
+        # True when text as a whole can't match: it doesn't start with the
+        # prefix, or lacks a required literal
+        return text[:len(self.prefix)] != self.prefix or self.rejects(text)
+
+    def rejects(self, text, pos=0):
+        # True when text[pos:] can't hold a match, because a required
+        # literal never occurs in it
+        if self.never:
+            return True
+        for literal in self.required:
+            if text.find(literal, pos) < 0:
+                return True
+        return False
+
+    def scanner(self, text):
+        # find(pos) -> first offset >= pos where a match could start, or -1.
+        # Offsets of the first characters are remembered between calls, so
+        # a rare one is not searched for again every time a common one hits.
+        if self.prefix:
+            prefix = self.prefix
+            return lambda pos: text.find(prefix, pos)
+        if self.first_chars is None:
+            return None
+        found = dict.fromkeys(self.first_chars, -2)
+
+        def find(pos):
+            best = -1
+            for char, at in found.items():
+                if -1 < at < pos or at == -2:
+                    at = found[char] = text.find(char, pos)
+                if at >= 0 and (best < 0 or at < best):
+                    best = at
+            return best
+        return find
+
+
+def single_char(edges):
+    # The one character every edge is labelled with, or None
+    chars = set()
+    for symbol, _ in edges:
+        if isinstance(symbol, CharClass):
+            if symbol.size() != 1:
+                return None
+            symbol = chr(symbol.ranges[0][0])
+        chars.add(symbol)
+    return chars.pop() if len(chars) == 1 else None
+
+
+def reachable(start, succ):
+    # Breadth-first distance of every state reachable from start
+    distance = {start: 0}
+    queue = [start]
+    for state in queue:
+        for _, target in succ.get(state, ()):
+            if target not in distance:
+                distance[target] = distance[state] + 1
+                queue.append(target)
+    return distance
+
+
+def reaches_accept(nfa, succ, avoiding):
+    seen = {nfa.start, avoiding}
+    stack = [nfa.start]
+    while stack:
+        state = stack.pop()
+        if state in nfa.accepts:
+            return True
+        for _, target in succ.get(state, ()):
+            if target not in seen:
+                seen.add(target)
+                stack.append(target)
+    return False
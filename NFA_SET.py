@@ -0,0 +1,118 @@
+from NFA_CODE import NFA, regex_to_nfa
+from NFA_DFA import CacheThrashing, LazyDFACache
+
+
+class TaggedDFACache(LazyDFACache):
+    # Lazy DFA whose states report which patterns they accept
+
+    def __init__(self, nfa, tags, unanchored=False, max_states=10000):
+        self.tags = tags
+        super().__init__(nfa, unanchored, max_states)
+
+    def match_info(self, states):
+        return frozenset(self.tags[s] for s in self.nfa.accepts.intersection(states))
+
+
+class PatternSet:
+    # Many regexes compiled into one automaton: a shared start state with an
+    # epsilon edge into each pattern's NFA, and every pattern's accept state
+    # tagged with the pattern's id (its index in self.regexes). One pass
+    # over the input reports every pattern that matches.
+
+    def __init__(self, regexes=(), max_states=10000):
+        self.regexes = []
+        self.tags = {}
+        self.max_states = max_states
+        self.nfa = NFA(0, None, accepts=())
+        self._next_state = 1
+        self._anchored = None
+        self._unanchored = None
+        self.fallbacks = 0
+        for regex in regexes:
+            self.add(regex)
+
+    def __len__(self):
+        return len(self.regexes)
+
+    def add(self, regex):
+        pattern_id = len(self.regexes)
+        nfa = regex_to_nfa(regex)
+        # Shift the pattern's states past everything already in the union
+        offset = self._next_state
+        for (from_state, symbol), to_states in nfa.transitions.items():
+            for to_state in to_states:
+                self.nfa.add_transition(from_state + offset, symbol, to_state + offset)
+        self.nfa.add_transition(self.nfa.start, None, nfa.start + offset)
+        for accept in nfa.accepts:
+            self.nfa.accepts.add(accept + offset)
+            self.tags[accept + offset] = pattern_id
+        self._next_state = offset + max(nfa.states()) + 1
+
+        self.regexes.append(regex)
+        self._anchored = None
+        self._unanchored = None
+        return pattern_id
+
+    def matches(self, text):
+        # Ids of the patterns matching the whole of text
+        if self._anchored is None:
+            self._anchored = TaggedDFACache(self.nfa, self.tags, max_states=self.max_states)
+        cache = self._anchored
+        try:
+            state = cache.start_scan(0)
+            i = 0
+            for char in text:
+                i += 1
+                target = state.next.get(char)
+                if target is None:
+                    target = cache.step(state, char, i)
+                state = target
+                if not state.states:
+                    return set()
+            return set(state.accepting)
+        except CacheThrashing:
+            self.fallbacks += 1
+            return self._simulate(text, unanchored=False)
+
+    def search(self, text):
+        # Ids of the patterns matching somewhere in text
+        if self._unanchored is None:
+            self._unanchored = TaggedDFACache(self.nfa, self.tags, unanchored=True, max_states=self.max_states)
+        cache = self._unanchored
+        try:
+            state = cache.start_scan(0)
+            found = set(state.accepting)
+            i = 0
+            for char in text:
+                i += 1
+                target = state.next.get(char)
+                if target is None:
+                    target = cache.step(state, char, i)
+                state = target
+                if state.accepting:
+                    found |= state.accepting
+                    if len(found) == len(self.regexes):
+                        break
+            return found
+        except CacheThrashing:
+            self.fallbacks += 1
+            return self._simulate(text, unanchored=True)
+
+    def _simulate(self, text, unanchored):
+        # Plain NFA simulation over the union, used when the DFA cache thrashes
+        closures, moves, classes = self.nfa._simulation()
+        initial = closures[self.nfa.start]
+        current = set(initial)
+        found = set()
+        for char in text:
+            if unanchored:
+                found.update(self.tags[s] for s in self.nfa.accepts.intersection(current))
+            class_id = classes[char]
+            reached = set(initial) if unanchored else set()
+            for state in current:
+                targets = moves.get(state, {}).get(class_id)
+                if targets:
+                    reached |= targets
+            current = reached
+        found.update(self.tags[s] for s in self.nfa.accepts.intersection(current))
+        return found
@@ -0,0 +1,201 @@
+import mmap
+import tempfile
+
+# Binary input is read as latin-1: one byte is one character, so offsets
+# reported for bytes, files opened in binary mode and mmaps are byte offsets
+LATIN1 = [chr(b) for b in range(256)]
+# Characters read back at a time when replaying the text after a match
+REPLAY_CHUNK = 1 << 16
+# Characters a Spool keeps in memory before it writes them to its file
+SPOOL_WINDOW = 1 << 16
+
+
+class Spool:
+    # Characters read past the end of a pending match, from offset start
+    # on. Only the last SPOOL_WINDOW stay in memory; the older ones go to a
+    # temporary file as UTF-32, four bytes each, to be read back by offset.
+
+    def __init__(self):
+        self.start = 0
+        self.window = []
+        self.spilled = 0
+        self.file = None
+
+    def clear(self, start):
+        self.start = start
+        self.window = []
+        self.spilled = 0
+
+    def append(self, char):
+        self.window.append(char)
+        if len(self.window) >= SPOOL_WINDOW:
+            if self.file is None:
+                self.file = tempfile.TemporaryFile()
+            self.file.seek(self.spilled * 4)
+            self.file.write("".join(self.window).encode("utf-32-le", "surrogatepass"))
+            self.spilled += len(self.window)
+            self.window = []
+
+    def read(self, start, end):
+        # The characters at offsets start to end, as a str
+        i, j = start - self.start, end - self.start
+        parts = []
+        if i < self.spilled:
+            self.file.seek(i * 4)
+            parts.append(self.file.read((min(j, self.spilled) - i) * 4).decode("utf-32-le", "surrogatepass"))
+        if j > self.spilled:
+            parts.append("".join(self.window[max(i - self.spilled, 0):j - self.spilled]))
+        return "".join(parts)
+
+
+class StreamSearcher:
+    # Leftmost-longest, non-overlapping matches over input that arrives in
+    # chunks. Automaton state (live threads and the pending match) carries
+    # over from one chunk to the next, so matches may straddle chunk
+    # boundaries. After a non-empty match ending at e the search resumes at
+    # e; after an empty match it resumes one character later.
+    #
+    # The characters read past the end of a pending match are read again
+    # once the match is final, as the next search starts from its end.
+    # reread(start, end) gets them back from the input by offset (an mmap
+    # slice, say); without it they go to a Spool. Either way they are
+    # replayed REPLAY_CHUNK at a time, so memory stays bounded however long
+    # the pending threads live.
+
+    def __init__(self, nfa, reread=None):
+        self.closures, self.moves, self.classes = nfa._simulation()
+        self.initial = self.closures[nfa.start]
+        self.finals = nfa.accepts
+        self.pos = 0
+        self.top = 0
+        self.threads = {}
+        self.best = None
+        self.seed_from = 0
+        self.reread = reread
+        self.spool = None if reread is not None else Spool()
+
+    def feed(self, chunk):
+        # Consume a str / bytes / bytearray / memoryview chunk and return
+        # the matches that became final
+        out = []
+        self._scan(chunk, out, at_end=False)
+        return out
+
+    def finish(self):
+        out = []
+        self._scan("", out, at_end=True)
+        return out
+
+    def _scan(self, chunk, out, at_end):
+        moves, classes, initial, finals = self.moves, self.classes, self.initial, self.finals
+        threads, best, spool = self.threads, self.best, self.spool
+        reread = self.reread or spool.read
+        # pos is the offset of the next character; those before top were
+        # read already and come back through reread
+        pos, top, seed_from = self.pos, self.top, self.seed_from
+        replay, replay_at = "", pos
+        idx = 0
+
+        while True:
+            more = pos < top or idx < len(chunk)
+
+            if best is None and pos >= seed_from:
+                for state in initial:
+                    if state not in threads:
+                        threads[state] = pos
+            for final in finals.intersection(threads):
+                started = threads[final]
+                if best is None or started < best[0] or (started == best[0] and pos > best[1]):
+                    best = (started, pos)
+                    if spool is not None and pos == top:
+                        spool.clear(pos)
+            if best is not None:
+                threads = {s: st for s, st in threads.items() if st <= best[0]}
+                if not threads or (at_end and not more):
+                    out.append(best)
+                    resume = best[1] if best[0] != best[1] else best[1] + 1
+                    seed_from = resume
+                    threads, best = {}, None
+                    if resume < pos:
+                        # Read the characters after the match again
+                        pos = resume
+                    continue
+
+            if not more:
+                break
+
+            if pos < top:
+                k = pos - replay_at
+                if not 0 <= k < len(replay):
+                    replay, replay_at, k = reread(pos, min(top, pos + REPLAY_CHUNK)), pos, 0
+                char = replay[k]
+                if type(char) is int:
+                    char = LATIN1[char]
+            else:
+                char = chunk[idx]
+                idx += 1
+                top += 1
+                if type(char) is int:
+                    char = LATIN1[char]
+                if spool is not None and best is not None:
+                    spool.append(char)
+            if threads:
+                class_id = classes[char]
+                reached = {}
+                for state, started in threads.items():
+                    targets = moves.get(state, {}).get(class_id)
+                    if targets:
+                        for target in targets:
+                            if target not in reached or started < reached[target]:
+                                reached[target] = started
+                threads = reached
+            pos += 1
+
+        self.threads, self.best = threads, best
+        self.pos, self.top, self.seed_from = pos, top, seed_from
+
+
+def finditer(nfa, text):
+    searcher = StreamSearcher(nfa)
+    yield from searcher.feed(text)
+    yield from searcher.finish()
+
+
+def search_stream(nfa, stream, chunk_size=1 << 16):
+    # Matches from a file object, read chunk by chunk. Binary streams are
+    # read into one reused buffer, so no per-chunk bytes objects are made.
+    searcher = StreamSearcher(nfa)
+    if hasattr(stream, "readinto"):
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        while True:
+            count = stream.readinto(buffer)
+            if not count:
+                break
+            yield from searcher.feed(view[:count])
+    else:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            yield from searcher.feed(chunk)
+    yield from searcher.finish()
+
+
+def search_mmap(nfa, path, chunk_size=1 << 20):
+    # Matches from a memory-mapped file; chunks are memoryview windows over
+    # the mapping, so the file is never copied into Python objects
+    with open(path, "rb") as f:
+        if f.seek(0, 2) == 0:
+            yield from finditer(nfa, "")
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                # Text after a pending match is read again from the mapping
+                searcher = StreamSearcher(nfa, reread=lambda start, end: view[start:end])
+                for start in range(0, len(mapped), chunk_size):
+                    yield from searcher.feed(view[start:start + chunk_size])
+                yield from searcher.finish()
+            finally:
+                view.release()
@@ -0,0 +1,497 @@
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+from NFA_BINARY import dumps, load, loads
+from NFA_BITPAR import BitParallelMatcher, matcher_for
+from NFA_CACHE import Pattern, PatternCache
+from NFA_CODE import (MAX_EDGE_LABEL, MAX_POSITIONS, NFA, CharClass, CompileTrace, aggregate_edges, collapse_chains,
+                      nfa_to_dot, regex_to_nfa)
+from NFA_DFA import DenseDFA, DenseSearch, LazyDFA
+from NFA_PARALLEL import scan_file_parallel, scan_parallel, speculate, stitch
+from NFA_PIKE import PikeVM
+from NFA_SET import PatternSet
+from NFA_STREAM import StreamSearcher, search_mmap
+
+# Differential tests: random patterns are written both in this package's
+# syntax and in Python's, and every engine has to agree with re on random
+# strings. re picks the leftmost-first match where this package picks the
+# leftmost-longest one, so expected search spans take re's start and the
+# longest end re will fullmatch from there.
+
+PATTERNS = 1000
+TEXTS = 12
+ALPHABET = "abcé"
+TEXT_ALPHABET = ALPHABET + "x"
+
+
+def random_class(rng):
+    chars = sorted(rng.sample(ALPHABET, rng.randint(1, 3)))
+    if len(chars) > 1 and rng.random() < 0.3:
+        body = f"{chars[0]}-{chars[-1]}"
+    else:
+        body = "".join(chars)
+    if rng.random() < 0.3:
+        return f"![{body}]", f"[^{body}]"
+    return f"[{body}]", f"[{body}]"
+
+
+def random_pattern(rng, depth=0):
+    # (ours, re's) source of a random pattern
+    roll = rng.random()
+    if depth >= 3 or roll < 0.3:
+        if rng.random() < 0.6:
+            char = rng.choice(ALPHABET)
+            return char, char
+        return random_class(rng)
+    if roll < 0.55:
+        parts = [random_pattern(rng, depth + 1) for _ in range(rng.randint(2, 3))]
+        return "".join(p for p, _ in parts), "".join(p for _, p in parts)
+    if roll < 0.75:
+        parts = [random_pattern(rng, depth + 1) for _ in range(rng.randint(2, 3))]
+        return "(" + "|".join(p for p, _ in parts) + ")", "(?:" + "|".join(p for _, p in parts) + ")"
+    ours, theirs = random_pattern(rng, depth + 1)
+    quantifier = rng.choice(["*", "+", "?", "{2}", "{0,2}", "{1,}", "{1,3}"])
+    return f"({ours}){quantifier}", f"(?:{theirs}){quantifier}"
+
+
+def random_texts(rng):
+    return [""] + ["".join(rng.choice(TEXT_ALPHABET) for _ in range(rng.randint(1, 7))) for _ in range(TEXTS - 1)]
+
+
+def expected_search(compiled, text, pos=0):
+    found = compiled.search(text, pos)
+    if found is None:
+        return None
+    start = found.start()
+    end = max(e for e in range(start, len(text) + 1) if compiled.fullmatch(text, start, e))
+    return (start, end)
+
+
+def cases(seed=2024, count=PATTERNS):
+    rng = random.Random(seed)
+    for _ in range(count):
+        ours, theirs = random_pattern(rng)
+        yield ours, re.compile(theirs), random_texts(rng)
+
+
+def byte_span(text, span):
+    if span is None:
+        return None
+    return len(text[:span[0]].encode()), len(text[:span[1]].encode())
+
+
+def test_matches_against_re():
+    for ours, compiled, texts in cases():
+        engines = [
+            regex_to_nfa(ours),
+            regex_to_nfa(ours, optimize=False),
+            regex_to_nfa(ours, construction="glushkov"),
+        ]
+        nfa = engines[0]
+        engines += [LazyDFA(nfa), DenseDFA.from_nfa(nfa), matcher_for(nfa)]
+        utf8 = LazyDFA(regex_to_nfa(ours, utf8=True))
+        vm = PikeVM(ours)
+        for text in texts:
+            expected = compiled.fullmatch(text) is not None
+            for engine in engines:
+                assert engine.matches(text) == expected, (ours, text, engine)
+            assert utf8.matches(text.encode()) == expected, (ours, text, "utf8")
+            assert (vm.fullmatch(text) is not None) == expected, (ours, text, "pike")
+
+
+def test_search_against_re():
+    for ours, compiled, texts in cases(seed=7):
+        nfa = regex_to_nfa(ours)
+        engines = [nfa, LazyDFA(nfa), LazyDFA(nfa, prefilter=False), matcher_for(nfa), DenseSearch.from_nfa(nfa)]
+        utf8_nfa = regex_to_nfa(ours, utf8=True)
+        utf8_engines = [LazyDFA(utf8_nfa), DenseSearch.from_nfa(utf8_nfa)]
+        vm = PikeVM(ours)
+        for text in texts:
+            for pos in range(0, len(text) + 1, 3):
+                expected = expected_search(compiled, text, pos)
+                for engine in engines:
+                    assert engine.search(text, pos) == expected, (ours, text, pos, engine)
+                found = vm.search(text, pos)
+                assert (found and found[0]) == expected, (ours, text, pos, "pike")
+                encoded_pos = len(text[:pos].encode())
+                for engine in utf8_engines:
+                    assert engine.search(text.encode(), encoded_pos) == byte_span(text, expected), (ours, text, pos, engine)
+
+
+def test_concatenation_after_class():
+    # Before the single-pass parser no concatenation was inserted after a
+    # bracket class, so "[ab]c|d" read as "[ab](c|d)"; the class now binds
+    # to what follows it like any other operand
+    cases = [
+        ("[ab]c|d", "d", True),
+        ("[ab]c|d", "ad", False),
+        ("x[ab]c|d", "d", True),
+        ("[a]b|c", "ac", False),
+        ("[ab]c[a-c]|(c|[ab])", "bb", False),
+        ("[ab]c[a-c]|(c|[ab])", "b", True),
+        ("(([a-c]|b.[a-c][ab]))*", "", True),
+        ("(([a-c]|b.[a-c][ab]))*", "bca", True),
+    ]
+    for regex, text, expected in cases:
+        for construction in ("thompson", "glushkov"):
+            assert regex_to_nfa(regex, construction=construction).matches(text) == expected, (regex, text)
+
+
+def test_trace_counts_parse_tokens():
+    steps = []
+    trace = CompileTrace(lambda phase, message, args: steps.append((phase, args)))
+    regex_to_nfa("a(b|[cd])*", trace)
+    tokens = [args for phase, args in steps if phase == "parse_regex"][:-1]
+    assert [token[0] for token in tokens] == ["a", "(", "b", "|", "[", ")", "*"]
+    assert trace.counters["parse_regex_steps"] == len(tokens) + 1
+    assert trace.counters["max_group_depth"] == 1
+
+
+def test_empty_class_is_an_error():
+    # The old tokenizer dropped "[]" ("a[]b" read as "ab") unless it came
+    # last; now it is rejected wherever it is, negated or not
+    for regex in ("[]", "a[]b", "[]a", "a[]", "a![]b", "(a|[])"):
+        with pytest.raises(ValueError, match="Empty character class"):
+            regex_to_nfa(regex)
+
+
+def test_prefix_search_is_linear():
+    # Trying every occurrence of the prefix "a" up to the first match end
+    # made this quadratic: ~6s at n=8000 where a linear scan takes ms
+    n = 20000
+    for prefilter in (True, False):
+        dfa = LazyDFA(regex_to_nfa("a(a*y|z)"), prefilter=prefilter)
+        began = time.perf_counter()
+        assert dfa.search("a" * n + "z") == (n - 1, n + 1)
+        assert time.perf_counter() - began < 1.0
+
+
+def test_search_stops_after_match():
+    # The reverse scan used to start at the end of the text wherever the
+    # match was, so iterating matches with search(text, end) was quadratic
+    text = ("b1" + "x" * 50) * 4000 + "b" + "x" * 10 ** 6
+    nfa = regex_to_nfa("b[0-9]?")
+    for engine in (LazyDFA(nfa, prefilter=False), BitParallelMatcher(nfa)):
+        began = time.perf_counter()
+        pos, found = 0, []
+        while True:
+            match = engine.search(text, pos)
+            if match is None:
+                break
+            found.append(match)
+            pos = match[1]
+        assert len(found) == 4001 and found[0] == (0, 2) and found[-1] == (4000 * 52, 4000 * 52 + 1)
+        assert time.perf_counter() - began < 1.0, engine
+
+
+def test_search_skips_text_before_match():
+    # The backward scan used to restart threads at every offset down to
+    # pos, undoing the prefilter's skip over the text before the match
+    nfa = regex_to_nfa("error[0-9]+")
+    for engine in (LazyDFA(nfa), DenseSearch.from_nfa(nfa)):
+        times = []
+        for n in (1000, 10 ** 6):
+            text = "x" * n + "error12 x"
+            engine.search(text)
+            began = time.perf_counter()
+            assert engine.search(text) == (n, n + 7)
+            times.append(time.perf_counter() - began)
+        assert times[1] < 0.02 + 10 * times[0], (engine, times)
+
+
+def all_matches(engine, text):
+    # Non-overlapping leftmost-longest matches, one search() at a time
+    found, pos = [], 0
+    while pos <= len(text):
+        span = engine.search(text, pos)
+        if span is None:
+            break
+        found.append(span)
+        pos = span[1] if span[1] > span[0] else span[1] + 1
+    return found
+
+
+def stream_matches(nfa, text, size, **options):
+    searcher = StreamSearcher(nfa, **options)
+    found = []
+    for start in range(0, len(text), size):
+        found += searcher.feed(text[start:start + size])
+    return found + searcher.finish()
+
+
+def test_stream_against_search(monkeypatch):
+    # Tiny windows make the spool spill to its file and replays span
+    # several reads
+    monkeypatch.setattr("NFA_STREAM.SPOOL_WINDOW", 3)
+    monkeypatch.setattr("NFA_STREAM.REPLAY_CHUNK", 2)
+    for ours, _, texts in cases(seed=11, count=200):
+        nfa = regex_to_nfa(ours)
+        for text in texts:
+            expected = all_matches(nfa, text)
+            for size in (1, 2, 3):
+                assert stream_matches(nfa, text, size) == expected, (ours, text, size)
+                data = text.encode("latin-1", "replace")
+                assert stream_matches(nfa, data, size) == all_matches(nfa, data.decode("latin-1")), (ours, text, size)
+
+
+def test_stream_memory_stays_bounded(monkeypatch, tmp_path):
+    # A match that may go on is pending over the whole input, and when it
+    # ends short everything after it is read again. Only a window of that
+    # text may stay in memory: the rest is spooled, or reread from the map.
+    monkeypatch.setattr("NFA_STREAM.SPOOL_WINDOW", 64)
+    monkeypatch.setattr("NFA_STREAM.REPLAY_CHUNK", 64)
+    nfa = regex_to_nfa("a(x*b)?")
+    n = 20000
+    text = "a" + "x" * n + "ya"
+    searcher = StreamSearcher(nfa)
+    found = []
+    for start in range(0, len(text), 1000):
+        found += searcher.feed(text[start:start + 1000])
+        assert len(searcher.spool.window) < 64
+        if start + 1000 < n:
+            assert searcher.spool.spilled >= start + 1000 - 64
+    assert found + searcher.finish() == [(0, 1), (n + 2, n + 3)]
+    assert stream_matches(nfa, text[:-1] + "b", 1000) == [(0, 1)]
+
+    path = tmp_path / "long.txt"
+    path.write_bytes(text.encode())
+    assert list(search_mmap(nfa, path, chunk_size=1000)) == [(0, 1), (n + 2, n + 3)]
+
+
+def test_cache_disk_tier(tmp_path):
+    cache = PatternCache(directory=tmp_path)
+    cache.compile("ab+c", dfa=True)
+    cache.compile("é+", utf8=True)
+    names = sorted(os.listdir(tmp_path))
+    assert len(names) == 2 and all(name.endswith(".nfab") for name in names)
+
+    restarted = PatternCache(directory=tmp_path)
+    pattern = restarted.compile("ab+c")
+    assert restarted.stats["disk_hits"] == 1 and pattern._dense_dfa is not None
+    assert pattern.search("xabbc") == (1, 5)
+    assert restarted.compile("é+", utf8=True).search("xéé".encode()) == (1, 5)
+
+    # Anything but a compiled pattern file (a pickle, say) is a miss
+    for name in names:
+        (tmp_path / name).write_bytes(b"\x80\x05N.")
+    fresh = PatternCache(directory=tmp_path)
+    assert fresh.compile("ab+c").matches("abc")
+    assert fresh.stats["disk_hits"] == 0 and fresh.stats["disk_writes"] == 1
+    fresh.clear(disk=True)
+    assert os.listdir(tmp_path) == []
+
+
+def test_pattern_set_against_single_patterns():
+    # Every pattern run on its own; max_states=2 makes the DFA cache thrash
+    # so the NFA fallback answers too
+    rng = random.Random(8)
+    groups = list(cases(seed=13, count=300))
+    fallbacks = 0
+    for k in range(0, len(groups), 5):
+        regexes = [ours for ours, _, _ in groups[k:k + 5]]
+        texts = [text for _, _, texts in groups[k:k + 5] for text in texts]
+        texts += ["".join(rng.sample(texts, 8)) for _ in range(4)]
+        nfas = [regex_to_nfa(regex) for regex in regexes]
+        for max_states in (10000, 2):
+            patterns = PatternSet(regexes, max_states=max_states)
+            for text in texts:
+                assert patterns.matches(text) == {i for i, nfa in enumerate(nfas) if nfa.matches(text)}, (regexes, text)
+                assert patterns.search(text) == {i for i, nfa in enumerate(nfas) if nfa.search(text) is not None}, \
+                    (regexes, text)
+            fallbacks += patterns.fallbacks if max_states == 2 else 0
+    assert fallbacks > 0
+
+
+def chunked_ends(dfa, data, size):
+    results = [speculate(dfa, data[start:start + size], start) for start in range(0, len(data), size)]
+    return stitch(dfa, results)
+
+
+def test_parallel_chunks_against_sequential_scan(tmp_path):
+    # Chunks of 1-3 characters put most matches across a boundary, and
+    # force stitch() through runs that never merge inside a chunk
+    rng = random.Random(10)
+    for ours, compiled, texts in cases(seed=10, count=200):
+        dfa = DenseDFA.from_nfa(regex_to_nfa(ours), unanchored=True)
+        for text in texts + ["".join(rng.sample(texts, 6))]:
+            expected = [end for end in range(len(text) + 1)
+                        if any(compiled.fullmatch(text, start, end) for start in range(end + 1))]
+            assert dfa.match_ends(text) == expected, (ours, text)
+            for size in (1, 2, 3):
+                assert chunked_ends(dfa, text, size) == expected, (ours, text, size)
+                assert chunked_ends(dfa, text.encode("latin-1"), size) == expected, (ours, text, size)
+    # The process pool and the mapped file path, on a pattern longer than a chunk
+    dfa = DenseDFA.from_nfa(regex_to_nfa("abc[0-9]+"), unanchored=True)
+    data = b"xxabc12abcab9abc3" * 5
+    path = tmp_path / "chunks.txt"
+    path.write_bytes(data)
+    for size in (1, 2, 3):
+        assert scan_parallel(dfa, data, workers=2, chunk_size=size) == dfa.match_ends(data)
+        assert scan_file_parallel(dfa, path, workers=2, chunk_size=size) == dfa.match_ends(data)
+
+
+def test_match_many_against_single_matches():
+    # Batches mix lengths, so strings drop out of the running prefix of the
+    # state vector at different steps. "ž" is past latin-1 and takes the
+    # binary search over class bounds; bytes take the byte class table.
+    pytest.importorskip("numpy")
+    rng = random.Random(11)
+    for ours, _, texts in cases(seed=11, count=200):
+        dfa = DenseDFA.from_nfa(regex_to_nfa(ours))
+        wide = [text + "ž" * rng.randint(0, 1) + text for text in texts]
+        for batch in (texts, wide, ["".join(rng.sample(texts, 4))] + texts[:3]):
+            assert list(dfa.match_many(batch)) == [dfa.matches(text) for text in batch], (ours, batch)
+            longest = [-1 if end is None else end for end in map(dfa.longest, batch)]
+            assert list(dfa.match_many(batch, longest=True)) == longest, (ours, batch)
+        encoded = [text.encode("latin-1") for text in texts]
+        assert list(dfa.match_many(encoded)) == [dfa.matches(text) for text in texts], ours
+        assert list(dfa.match_many(encoded, longest=True)) == [-1 if end is None else end
+                                                               for end in map(dfa.longest, texts)], ours
+    assert len(DenseDFA.from_nfa(regex_to_nfa("a*")).match_many([])) == 0
+
+
+def grep(*args, stdin=b""):
+    return subprocess.run([sys.executable, "-m", "NFA_CLI", *args], input=stdin, capture_output=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_cli(tmp_path):
+    first, second, empty = tmp_path / "first.log", tmp_path / "second.log", tmp_path / "empty.log"
+    first.write_bytes("ok 1\nerror42 in bär\nfine\nerror7 error88\n".encode())
+    second.write_bytes(b"nothing here\nerror5")
+    empty.write_bytes(b"")
+    pattern = "error[0-9]+"
+
+    found = grep(pattern, str(first))
+    assert (found.returncode, found.stdout) == (0, "error42 in bär\nerror7 error88\n".encode())
+    found = grep("-o", pattern, str(first))
+    assert (found.returncode, found.stdout) == (0, b"error42\nerror7\nerror88\n")
+    found = grep("-c", pattern, str(first), str(second), str(empty))
+    assert found.stdout == f"{first}:2\n{second}:1\n{empty}:0\n".encode()
+    found = grep("-l", pattern, str(first), str(empty), str(second))
+    assert found.stdout == f"{first}\n{second}\n".encode()
+    found = grep(pattern, stdin=b"a\nerror1\n")
+    assert (found.returncode, found.stdout) == (0, b"error1\n")
+    # Worker processes print the same, in file order
+    for options in (["-c"], ["-l"], ["-o"], []):
+        files = [str(first), str(empty), str(second)] * 2
+        assert grep("-j", "2", *options, pattern, *files).stdout == grep(*options, pattern, *files).stdout, options
+
+    # 1: nothing matched; 2: a bad pattern or a file that can't be read
+    assert grep(pattern, str(empty)).returncode == 1
+    assert grep("-c", "warning", str(first)).returncode == 1
+    found = grep("error[0-9", str(first))
+    assert found.returncode == 2 and found.stdout == b"" and found.stderr.startswith(b"NFA_CLI: ")
+    found = grep(pattern, str(first), str(tmp_path / "missing.log"))
+    assert found.returncode == 2 and b"missing.log" in found.stderr and found.stdout.count(b"\n") == 2
+    assert grep("-j", "-1", pattern, str(first)).returncode == 2
+
+
+def test_graph_edges():
+    # Four symbols from 0 to 1 merge into one labelled edge; 1 -x-> 2 -y->
+    # 3 -ε-> 4 -z-> 5 is a chain that shares its ends with 1 -q-> 5 and
+    # 1 -" "-> 5; from accept 5 a chain of 30 states is cut off at
+    # MAX_EDGE_LABEL characters
+    nfa = NFA(0, 5)
+    for symbol in ("a", "b", None, CharClass([(ord("c"), ord("d"))])):
+        nfa.add_transition(0, symbol, 1)
+    for from_state, symbol, to_state in [(1, "x", 2), (2, "y", 3), (3, None, 4), (4, "z", 5), (1, "q", 5), (1, " ", 5),
+                                         (5, "a", 5)]:
+        nfa.add_transition(from_state, symbol, to_state)
+    tail = "abcdefghijklmnopqrstuvwxyz0123"
+    for k, char in enumerate(tail):
+        nfa.add_transition(100 + k - 1 if k else 5, char, 100 + k)
+
+    edges = aggregate_edges(nfa)
+    assert edges[(0, 1)] == "ε|[a-d]"
+    assert edges[(1, 5)] == "[\\u0020q]"
+    assert (edges[(1, 2)], edges[(3, 4)], edges[(5, 5)]) == ("x", "ε", "a")
+    assert len(edges) == 7 + len(tail)
+
+    collapsed = {(from_state, to_state): (label, hidden) for from_state, to_state, label, hidden
+                 in collapse_chains(nfa, edges)}
+    assert collapsed == {
+        (0, 1): ("ε|[a-d]", 0),
+        (1, 5): ("xyz|[\\u0020q]", 3),
+        (5, 5): ("a", 0),
+        (5, 100 + len(tail) - 1): (tail[:MAX_EDGE_LABEL - 1] + "…", len(tail) - 1),
+    }
+
+    source = nfa_to_dot(nfa, "collapsed").source
+    assert '1 -> 5 [label="xyz|\\[\\\\u0020q\\]" style=bold]' in source
+    assert "2 ->" not in source and source.count("style=bold") == 2
+    full = nfa_to_dot(nfa, "full").source
+    assert full.count(" -> ") == 1 + len(edges) and "style=bold" not in full
+    assert nfa_to_dot(nfa).source == full
+    with pytest.raises(ValueError):
+        nfa_to_dot(nfa, "none")
+
+
+def test_captures_from_threads():
+    # One cached Pattern, hence one PikeVM, shared by several threads:
+    # each search has to keep its thread lists and slots to itself
+    cache = PatternCache()
+    rng = random.Random(5)
+    texts = ["".join(rng.choice("ab12 ") for _ in range(rng.randint(0, 90))) for _ in range(200)]
+    expected = [PikeVM("([a-z]+)([0-9]+)").search(text) for text in texts]
+    failures = []
+
+    def worker():
+        try:
+            for _ in range(20):
+                found = [cache.compile("([a-z]+)([0-9]+)").captures(text) for text in texts]
+                if found != expected:
+                    failures.append(found)
+                    return
+        except Exception as error:
+            failures.append(error)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not failures
+
+
+def test_unrolled_size_is_capped():
+    # Nested bounds multiply: the first used to build 600k states, the
+    # second to exhaust memory. A single bound meets the same limit, and
+    # one too long to count in an int is refused just as quickly.
+    for regex in ("(a{1000}){300}", "(a{1000}){1000}{1000}", "(ab){200000,}", f"a{{{MAX_POSITIONS + 1}}}",
+                  f"a{{2,{10 ** 40}}}"):
+        began = time.perf_counter()
+        with pytest.raises(ValueError, match="Pattern unrolls to"):
+            regex_to_nfa(regex)
+        assert time.perf_counter() - began < 0.5
+    assert regex_to_nfa(f"a{{{MAX_POSITIONS}}}").matches("a" * MAX_POSITIONS)
+
+
+def test_binary_search_stays_mapped():
+    # A loaded pattern searches its mapped DFAs; the NFA's transitions
+    # are never rebuilt from the edge arrays
+    for regex, utf8, text in [("abc[0-9]+", False, "xabcabc12y"), ("(foo|bär)x*", True, "a bärxx foo".encode()),
+                              ("x?", False, "yyx")]:
+        pattern = Pattern(regex, regex_to_nfa(regex, utf8=utf8), utf8=utf8)
+        fd, path = tempfile.mkstemp(suffix=".nfab")
+        os.close(fd)
+        try:
+            pattern.save(path)
+            loaded = load(path)
+            assert loaded.search(text) == pattern.lazy_dfa.search(text)
+            assert loaded.search(text, 4) == pattern.lazy_dfa.search(text, 4)
+            assert repr(loaded.dense_search.prefilter) == repr(pattern.dense_search.prefilter)
+            assert "transitions" not in vars(loaded.nfa)
+        finally:
+            os.remove(path)
+    # Saved without DFAs, search falls back to the lazy DFA over the NFA
+    pattern = loads(dumps(Pattern("ab+", regex_to_nfa("ab+")), dfa=False))
+    assert pattern.search("xabbb") == (1, 5)